@@ -146,14 +146,14 @@ def get_pods(namespace: str):
         # Use adapter to get detailed information
         pod_details = []
         pod_info = kube_client.get_pod_info(namespace)
+        pod_objects = {pod.metadata.name: pod for pod in kube_client.list_pod_objects(namespace)}
         
         for pod_name in pod_names:
-            if pod_name in pod_info:
+            if pod_name in pod_info and pod_name in pod_objects:
                 info = pod_info[pod_name]
                 
-                # Get restart count (using native client)
-                v1 = client.CoreV1Api()
-                pod = v1.read_namespaced_pod(name=pod_name, namespace=namespace)
+                # Get restart count
+                pod = pod_objects[pod_name]
                 
                 restarts = 0
                 if pod.status.container_statuses:
@@ -200,10 +200,10 @@ def get_deployments(namespace: str):
         
         # Get deployment detailed information
         deployment_details = []
-        apps_v1 = client.AppsV1Api()
-        deployments = apps_v1.list_namespaced_deployment(namespace=namespace)
+        deployments = kube_client.list_deployment_objects(namespace)
+        replica_status = kube_client.get_replica_status(namespace)
         
-        for deployment in deployments.items:
+        for deployment in deployments:
             if deployment.metadata.name in deployment_names:
                 # Calculate deployment runtime
                 if deployment.metadata.creation_timestamp:
@@ -237,6 +237,8 @@ def get_deployments(namespace: str):
                     "status": status,
                     "currentReplicas": deployment.status.ready_replicas or 0,
                     "desiredReplicas": deployment.spec.replicas,
+                    "startingReplicas": replica_status.get(deployment.metadata.name, {}).get('starting', 0),
+                    "terminatingReplicas": replica_status.get(deployment.metadata.name, {}).get('terminating', 0),
                     "uptime": uptime_str
                 })
         
@@ -644,30 +646,18 @@ def get_all_metrics(namespace: str, pod_name: str):
             # Extract deployment name from pod_name
             deployment_name = prom_client.strip_pod_suffix(pod_name)
             deployments = [deployment_name]
-            resource_limits = kube_client.get_deployments_limit(deployments, namespace)
+            resource_limits = kube_client.get_resource_snapshot(namespace).get(deployments)
         except Exception as e:
             print(f"Failed to get resource limits: {e}")
             resource_limits = {}
         
-        # Format resource limits data
+        # Format resource limits data (cpu in millicores, memory in MiB, per pod)
         formatted_limits = {}
-        for svc, (cpu_limit, mem_limit) in resource_limits.items():
+        for svc, res in resource_limits.items():
             formatted_limits[svc] = {
-                "cpu_limit": None,
-                "mem_limit": None
+                "cpu_limit": res["cpu_limit"],
+                "mem_limit": res["mem_limit"]
             }
-            
-            if cpu_limit:
-                if 'm' in str(cpu_limit):
-                    formatted_limits[svc]["cpu_limit"] = float(str(cpu_limit)[:-1])
-                else:
-                    formatted_limits[svc]["cpu_limit"] = float(cpu_limit) * 1000
-                    
-            if mem_limit:
-                if 'Mi' in str(mem_limit):
-                    formatted_limits[svc]["mem_limit"] = float(str(mem_limit)[:-2])
-                elif 'Gi' in str(mem_limit):
-                    formatted_limits[svc]["mem_limit"] = float(str(mem_limit)[:-2]) * 1024
         
         # Manually build complete metrics data, using old version logic
         metrics_json = {
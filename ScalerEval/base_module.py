@@ -2,21 +2,31 @@ import asyncio
 import time
 from baselines.NoneScaler.scaler import NoneScaler
 from baselines.scaler_template import ScalerTemplate
-from utils.cloud.executor import KubernetesClient
-from utils.cloud.monitor import PrometheusClient
+from utils.cloud.applier import load_documents, manifest_files
+from utils.cloud.executor import KubernetesClient, create_kube_client
+from utils.cloud.monitor import PrometheusClient, PrometheusTransport
 from config.exp_config import Config
 from baselines.scaler_factory import ScalerFactory
-from utils.ssh_client import ssh_execute_command
+from utils.ssh_client import SSHExecutor, summarize_results
 
 def init_client(config: Config):
-    kube_client = KubernetesClient(config.kube_config)
-    prom_client = PrometheusClient(config.prom_url)
+    kube_client = create_kube_client(config.kube_config,
+                                     backend=config.kube_backend,
+                                     informer=config.kube_informer,
+                                     sim_options=config.kube_sim)
+    transport = PrometheusTransport(timeout=config.prom_timeout,
+                                    retries=config.prom_retries,
+                                    pool_size=config.prom_max_concurrency)
+    prom_client = PrometheusClient(config.prom_url,
+                                   max_concurrency=config.prom_max_concurrency,
+                                   transport=transport,
+                                   max_points=config.prom_max_points)
     return prom_client, kube_client
 
 
 def init_env(config: Config):
     kube_client: KubernetesClient
-    _, kube_client = init_client(config=config)
+    prom_client, kube_client = init_client(config=config)
     # restart prometheus
     kube_client.restart_deployment(name='prometheus', namespace='istio-system')
     namespace = config.benchmarks[config.select_benchmark]['namespace']
@@ -32,45 +42,160 @@ def init_env(config: Config):
     print(f'create virtual services from: {istio_yml}...')
     kube_client.create_istio_resource(istio_yml, namespace)
     # wait until all microservices are avaliable
-    while not kube_client.all_avaliable(kube_client.get_deployments(namespace), namespace):
-        print('wait until all microservices are avaliable ')
-        time.sleep(5)
+    print('wait until all microservices are avaliable ')
+    if not kube_client.wait_deployments_available(namespace, timeout=config.env_ready_timeout):
+        print(f'deployments in {namespace} are not avaliable after {config.env_ready_timeout}s')
+    if not kube_client.wait_pods_ready(namespace, sidecar=config.env_wait_sidecar, timeout=config.env_ready_timeout):
+        print(f'pods in {namespace} are not ready after {config.env_ready_timeout}s')
     print(f'all services in {namespace} are avaliable')
+    # prometheus was restarted above, its metrics are needed by the scalers and the stabilization check
+    kube_client.wait_deployments_available('istio-system', ['prometheus'], timeout=config.env_ready_timeout)
+    if config.kube_backend != 'sim':
+        # simulated pods have no warm-up
+        wait_stable(prom_client, namespace, config)
+
+
+def wait_stable(prom_client: PrometheusClient, namespace: str, config: Config):
+    '''
+        wait until the cpu usage of the namespace observed by prometheus settles,
+        instead of sleeping for a fixed time after the deployment
+    '''
+    deadline = time.time() + config.stable_timeout
+    samples = []
+    while time.time() < deadline:
+        try:
+            df = prom_client.get_resource_metric(namespace, range=False)
+            if 'namespace_vCPU' in df:
+                samples.append(float(df['namespace_vCPU'].iloc[-1]))
+        except Exception as e:
+            print(f'stabilization check failed: {e}')
+        recent = samples[-config.stable_samples:]
+        if len(recent) == config.stable_samples and \
+                max(recent) - min(recent) <= config.stable_tolerance * max(max(recent), 1e-3):
+            print(f'resource usage of {namespace} is stable')
+            return True
+        time.sleep(config.stable_interval)
+    print(f'resource usage of {namespace} is not stable after {config.stable_timeout}s, continue anyway')
+    return False
 
-    time.sleep(60)
-        
-    
+
+def env_drift(kube_client: KubernetesClient, namespace: str, docs: list):
+    '''
+        differences between the deployed benchmark and its manifests that a reset can not repair
+    '''
+    drift = []
+    try:
+        kube_client.core_api.read_namespace(name=namespace)
+    except Exception:
+        return [f'namespace {namespace} does not exist']
+    deployed = {item.metadata.name: item for item in kube_client.list_deployment_objects(namespace)}
+    for doc in docs:
+        if doc.get('kind') != 'Deployment':
+            continue
+        name = doc['metadata']['name']
+        if name not in deployed:
+            drift.append(f'deployment {name} is missing')
+            continue
+        images = [c.get('image') for c in doc['spec']['template']['spec']['containers']]
+        deployed_images = [c.image for c in deployed[name].spec.template.spec.containers]
+        if images != deployed_images:
+            drift.append(f'images of {name} changed: {deployed_images} != {images}')
+    return drift
+
+
+def reset_env(config: Config):
+    '''
+        restore the deployed benchmark to its initial state instead of recreating it:
+        HPAs removed, replicas of the manifests restored, pods optionally rolled and
+        stateful stores optionally restarted. Return False if the environment drifted
+        from its manifests, the caller should then recreate it with end_env/init_env
+    '''
+    kube_client: KubernetesClient
+    prom_client, kube_client = init_client(config=config)
+    namespace = config.benchmarks[config.select_benchmark]['namespace']
+    deploy_path = config.benchmarks[config.select_benchmark]['deploy_path']
+    docs = load_documents(manifest_files(deploy_path))
+    drift = env_drift(kube_client, namespace, docs)
+    if len(drift) > 0:
+        print(f'{namespace} drifted from {deploy_path}: ' + '; '.join(drift))
+        return False
+    print(f'reset {namespace}...')
+    kube_client.remove_HPAs(namespace)
+    replicas = {doc['metadata']['name']: doc['spec'].get('replicas', 1) for doc in docs if doc.get('kind') == 'Deployment'}
+    for deployment in kube_client.list_deployment_objects(namespace):
+        name = deployment.metadata.name
+        if name in replicas and deployment.spec.replicas != replicas[name]:
+            print(f'scale {name} back to {replicas[name]}')
+            kube_client.patch_scale(name, replicas[name], namespace, async_req=False)
+    deployments = kube_client.get_deployments(namespace)
+    restarts = []
+    if config.reset_restart_pods:
+        restarts = deployments
+    elif config.reset_flush_stores:
+        stateless = set(kube_client.get_deployments_without_state(namespace))
+        restarts = [name for name in deployments if name not in stateless]
+    # the generation of every restart, the wait ends only when these rollouts are complete
+    generations = {name: kube_client.restart_deployment(name=name, namespace=namespace) for name in restarts}
+    if not kube_client.wait_deployments_available(namespace, timeout=config.env_ready_timeout, generations=generations):
+        print(f'deployments in {namespace} are not avaliable after {config.env_ready_timeout}s')
+        return False
+    if not kube_client.wait_pods_ready(namespace, sidecar=config.env_wait_sidecar, timeout=config.env_ready_timeout):
+        print(f'pods in {namespace} are not ready after {config.env_ready_timeout}s')
+        return False
+    if config.kube_backend != 'sim':
+        wait_stable(prom_client, namespace, config)
+    print(f'{namespace} is reset')
+    return True
 
 
 def end_env(config):
     kube_client: KubernetesClient
     _, kube_client = init_client(config=config)
     namespace = config.benchmarks[config.select_benchmark]['namespace']
-    kube_client.delete_namespace(namespace)
+    kube_client.delete_namespace(namespace, timeout=config.env_ready_timeout)
 
     ## If you want to remove the volumes, execute the follow command
     # if config.select_benchmark == 'xxxxxx':
     #     clear_volumes('/tmp/volumes')
 
 
-def clear_volumes(path):
+def clear_volumes(path, executor: SSHExecutor = None, timeout=300):
     # complete the configuration (Please check carefully!!!)
     servers = [
         {"hostname": "192.168.31.68", "username": "xxxx", "password": "xxx"},
         {"hostname": "192.168.31.202", "username": "xxxx", "password": "xxx"}
     ]
-    # clear the volume
-    for server in servers:
-        print(f"clean files in {path} of {server['hostname']}...")
+    # clear the volume on all servers at once, pass an executor to reuse its connections across runs
+    own_executor = executor is None
+    if own_executor:
+        executor = SSHExecutor()
+    try:
+        print(f"clean files in {path} of {[server['hostname'] for server in servers]}...")
         command = f"sudo rm -rf {path}/*"
-        ssh_execute_command(server, command)
+        results = executor.execute_all(servers, command, timeout=timeout)
+    finally:
+        if own_executor:
+            executor.close()
 
-    print("all volumes are cleaned.")
+    if summarize_results(results):
+        print("all volumes are cleaned.")
+    return results
 
 
 
 def register_scaler(config: Config):
     scaler_name = config.select_scaler
     scaler = ScalerFactory.create_scaler(scaler_name, config)
-    task = asyncio.create_task(scaler.register())
-    return scaler, task
\ No newline at end of file
+    task = asyncio.create_task(run_scaler(scaler))
+    return scaler, task
+
+
+async def run_scaler(scaler):
+    '''
+        the task of a scaler ends after cancel() once its last scale actions are sent,
+        so awaiting it keeps them from racing with the reset of the environment
+    '''
+    try:
+        await scaler.register()
+    finally:
+        await scaler.closed()
\ No newline at end of file
@@ -5,6 +5,11 @@ class KHPAConfig(ScalerConfig):
     def __init__(self, config):
         super().__init__(config)
         self.CPU_threshold = 80
+        # autoscaling/v2 options, None keeps the kubernetes default
+        self.memory_threshold = None # target average memory utilization (%) besides cpu
+        self.scale_up_window = None # stabilization window (s) of scaling up, default 0
+        self.scale_down_window = None # stabilization window (s) of scaling down, default 300
+        self.hpa_workers = 8 # HPAs created concurrently
 
     def set_cpu_threshold(self, threshold):
-        self.CPU_threshold = threshold
\ No newline at end of file
+        self.CPU_threshold = threshold
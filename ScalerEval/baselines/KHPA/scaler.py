@@ -15,16 +15,20 @@ class KHPAScaler(ScalerTemplate):
     async def register(self):
         self.logger.info(f'Register KHPA-{self.cfg.CPU_threshold}...')
         deployments = self.executor.get_deployments_without_state(self.cfg.namespace)
-        for idx, deployment in enumerate(deployments):
-            self.executor.create_default_HPA(
-                namespace=self.cfg.namespace, 
-                deployment=deployment, 
-                min_replicas=self.cfg.min_count,
-                max_replicas=self.cfg.max_count,
-                cpu_th=self.cfg.CPU_threshold
-            )
+        hpas = [self.executor.build_HPA(
+                    deployment=deployment,
+                    min_replicas=self.cfg.min_count,
+                    max_replicas=self.cfg.max_count,
+                    cpu_th=self.cfg.CPU_threshold,
+                    mem_th=self.cfg.memory_threshold,
+                    scale_up_window=self.cfg.scale_up_window,
+                    scale_down_window=self.cfg.scale_down_window
+                ) for deployment in deployments]
+        failed = self.executor.create_HPAs(self.cfg.namespace, hpas, max_workers=self.cfg.hpa_workers)
+        if len(failed) > 0:
+            self.logger.error(f'failed to create HPAs for {failed}')
 
     def cancel(self):
         self.logger.info('Remove KHPA...')
-        self.executor.remove_default_HPA(self.cfg.namespace)
+        self.executor.remove_HPAs(self.cfg.namespace)
         
@@ -8,7 +8,15 @@ class PBScalerConfig(ScalerConfig):
         self.ab_check_interval = 10
         self.waste_check_interval = 60
         self.optimize_all_interval = 240
+        self.job_workers = 3 # the three periodic jobs above can run at the same time
         self.alpha = 0
         self.beta = 0.9
         self.k = 4 if self.namespace == 'online-boutique' else 2
-        self.predictor_path = f'baselines/PBScaler/{self.namespace}.pkl'
\ No newline at end of file
+        self.predictor_path = f'baselines/PBScaler/{self.namespace}.pkl'
+        self.predictor_mmap = False # map the arrays of the compiled predictor from a joblib dump shared by the scaler processes (the sklearn forest is always unpickled)
+        self.predictor_compiled = True # evaluate the GA populations with the flat-array CompiledForest (same predictions as sklearn)
+        self.compiled_max_rows = 512 # larger batches (e.g. the enumeration) are predicted by sklearn, faster from ~500 rows on
+        self.fitness_cache_size = 4096 # fitness of the replica vectors already evaluated during one optimization
+        self.exhaustive_limit = 4096 # enumerate the whole search space instead of running the GA when it has at most this many vectors
+        self.eval_workers = 1 # >1: evaluate large populations over a pool of that many processes
+        self.eval_pool_min_rows = 2048 # smaller batches are evaluated in the scaler process
\ No newline at end of file
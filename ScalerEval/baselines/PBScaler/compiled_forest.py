@@ -0,0 +1,156 @@
+'''
+    inference engine for the random forest of Predictor: the trees are compiled into flat numpy
+    tables (feature, threshold, children and leaf probabilities of every node of every tree) and
+    a whole GA population is routed through all the trees with one vectorized step per depth level
+    (the pairs that reached a leaf drop out of the next steps), instead of the per-call validation
+    and tree-by-tree dispatch of sklearn. It pays off for population-sized inputs (up to a few hundred
+    samples), sklearn stays faster on large batches.
+
+    usage: python -m baselines.PBScaler.compiled_forest --predictor baselines/PBScaler/sockshop.pkl
+    benchmarks it against RandomForestClassifier.predict on population-sized inputs
+'''
+import argparse
+import time
+import numpy as np
+
+
+class CompiledForest:
+    '''
+        predictions are bit-identical to RandomForestClassifier.predict/predict_proba: the inputs
+        are cast to float32 like sklearn, compared with the float64 thresholds, and the leaf
+        probabilities of the trees are summed in the order of the estimators before the division.
+        Only single-output classifiers are supported.
+    '''
+    def __init__(self, feature, threshold, left, right, proba, roots, classes, n_features, max_depth):
+        self.feature = feature      # (n_nodes,) split feature, 0 on the leaves
+        self.threshold = threshold  # (n_nodes,) split threshold (float64)
+        self.left = left            # (n_nodes,) global index of the left child, the node itself on the leaves
+        self.right = right          # (n_nodes,) global index of the right child, the node itself on the leaves
+        self.proba = proba          # (n_nodes, n_classes) class probabilities of the node
+        self.roots = roots          # (n_trees,) global index of the root of every tree
+        self.classes_ = classes
+        self.n_features_in_ = n_features
+        self.max_depth = max_depth
+        self.is_leaf = self.left == np.arange(len(self.left))
+
+    @classmethod
+    def from_sklearn(cls, forest):
+        '''
+            compile a fitted RandomForestClassifier (or a Predictor wrapping one)
+        '''
+        forest = getattr(forest, 'predictor', forest)
+        if forest.n_outputs_ != 1:
+            raise ValueError(f'only single-output forests can be compiled, got {forest.n_outputs_} outputs')
+        n_classes = forest.n_classes_
+        features, thresholds, lefts, rights, probas, roots = [], [], [], [], [], []
+        offset, max_depth = 0, 0
+        for estimator in forest.estimators_:
+            tree = estimator.tree_
+            nodes = np.arange(tree.node_count)
+            leaf = tree.children_left == -1
+            roots.append(offset)
+            features.append(np.where(leaf, 0, tree.feature))
+            thresholds.append(tree.threshold)
+            # a leaf points to itself, so the traversal can run max_depth steps for every tree
+            lefts.append(np.where(leaf, nodes, tree.children_left) + offset)
+            rights.append(np.where(leaf, nodes, tree.children_right) + offset)
+            # what DecisionTreeClassifier.predict_proba returns for the samples of this leaf
+            probas.append(tree.value[:, 0, :n_classes])
+            offset += tree.node_count
+            max_depth = max(max_depth, tree.max_depth)
+        return cls(
+            feature=np.concatenate(features).astype(np.intp),
+            threshold=np.concatenate(thresholds).astype(np.float64),
+            left=np.concatenate(lefts).astype(np.intp),
+            right=np.concatenate(rights).astype(np.intp),
+            proba=np.ascontiguousarray(np.concatenate(probas), dtype=np.float64),
+            roots=np.array(roots, dtype=np.intp),
+            classes=forest.classes_,
+            n_features=forest.n_features_in_,
+            max_depth=max_depth
+        )
+
+    def apply(self, X):
+        '''
+            (n_samples, n_trees) global index of the leaf reached by every sample in every tree
+        '''
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features_in_:
+            raise ValueError(f'X should have shape (n_samples, {self.n_features_in_}), got {X.shape}')
+        n_samples, n_trees = X.shape[0], len(self.roots)
+        values = np.ascontiguousarray(X).ravel()
+        # one (sample, tree) pair per entry, offsets of the sample rows in `values`
+        nodes = np.tile(self.roots, n_samples)
+        row_offsets = np.repeat(np.arange(n_samples) * X.shape[1], n_trees)
+        active = np.arange(nodes.size)
+        for _ in range(self.max_depth):
+            current = nodes[active]
+            go_left = values[row_offsets[active] + self.feature[current]] <= self.threshold[current]
+            current = np.where(go_left, self.left[current], self.right[current])
+            nodes[active] = current
+            # only the pairs that are not on a leaf yet go one level deeper
+            active = active[~self.is_leaf[current]]
+            if active.size == 0:
+                break
+        return nodes.reshape(n_samples, n_trees)
+
+    def predict_proba(self, X):
+        leaves = self.apply(X)
+        proba = np.zeros((leaves.shape[0], self.proba.shape[1]), dtype=np.float64)
+        # tree by tree, the float sum is then the same as sklearn's
+        for t in range(leaves.shape[1]):
+            proba += self.proba[leaves[:, t]]
+        proba /= leaves.shape[1]
+        return proba
+
+    def predict(self, X):
+        return self.classes_.take(np.argmax(self.predict_proba(X), axis=1), axis=0)
+
+
+def random_inputs(forest, n_samples, rng):
+    '''
+        replica counts in 1..8 for the services and workloads in 0..200 qps, the shape of the
+        inputs built by ScalingProblem.evalVars
+    '''
+    n_svcs = forest.n_features_in_ // 2
+    replicas = rng.integers(1, 9, size=(n_samples, n_svcs))
+    workloads = rng.uniform(0, 200, size=(n_samples, forest.n_features_in_ - n_svcs))
+    return np.hstack([replicas, workloads])
+
+
+def best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        st = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - st)
+    return min(times)
+
+
+def benchmark(predictor_path, sizes, repeat, seed=0):
+    from utils.io_util import load_pkl
+    forest = load_pkl(predictor_path)
+    forest = getattr(forest, 'predictor', forest)
+    st = time.perf_counter()
+    compiled = CompiledForest.from_sklearn(forest)
+    print(f'compiled {len(compiled.roots)} trees, {len(compiled.feature)} nodes, '
+          f'max depth {compiled.max_depth} in {(time.perf_counter() - st) * 1000:.1f}ms')
+    rng = np.random.default_rng(seed)
+    print(f"{'samples':>8} {'sklearn(ms)':>12} {'compiled(ms)':>13} {'speedup':>8} {'identical':>10}")
+    for n_samples in sizes:
+        X = random_inputs(forest, n_samples, rng)
+        identical = np.array_equal(forest.predict_proba(X), compiled.predict_proba(X)) \
+            and np.array_equal(forest.predict(X), compiled.predict(X))
+        sk_time = best_time(lambda: forest.predict(X), repeat)
+        compiled_time = best_time(lambda: compiled.predict(X), repeat)
+        print(f'{n_samples:>8} {sk_time * 1000:>12.2f} {compiled_time * 1000:>13.2f} '
+              f'{sk_time / compiled_time:>7.1f}x {str(identical):>10}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark the compiled forest against sklearn')
+    parser.add_argument('--predictor', default='baselines/PBScaler/sockshop.pkl', help='pickled RandomForestClassifier')
+    parser.add_argument('--sizes', default='1,10,50,500,5000', help='comma separated numbers of samples')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    benchmark(args.predictor, [int(size) for size in args.sizes.split(',')], args.repeat)
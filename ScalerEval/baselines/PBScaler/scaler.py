@@ -5,20 +5,23 @@ import asyncio
 import sys
 import time
 import traceback
-from threading import Thread
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import math
-import schedule
 import networkx as nx
 import scipy
 
 from baselines.PBScaler.cfg import PBScalerConfig
 from baselines.PBScaler.rf_predictor import Predictor
+from baselines.PBScaler.compiled_forest import CompiledForest
+from baselines.scaler_runtime import JobScheduler
 from baselines.scaler_template import ScalerTemplate
 from utils.exception_uitl import exception_handler
 from utils.logger import get_logger
-from utils.io_util import load_pkl
+from utils.model_registry import ModelRegistry
 
 
 class PBScaler(ScalerTemplate):
@@ -29,28 +32,33 @@ class PBScaler(ScalerTemplate):
         deployments = self.executor.get_deployments_without_state(self.namespace)
         self.mss = sorted(deployments)
         self.logger = get_logger('./logs', 'PBScaler')
+        self.scheduler = None
+        self.eval_pool = None
         
 
     @exception_handler
     async def register(self):
         self.logger.info('Register PBScaler horizontal scaler...')
         self.is_running = True
-        schedule.clear()
-        schedule.every(self.cfg.ab_check_interval).seconds.do(self.anomaly_detect)
-        schedule.every(self.cfg.waste_check_interval).seconds.do(self.waste_detection)
-        # schedule.every(self.optimize_all_interval).seconds.do(self.optimize_all_mss)
-        self.thread = Thread(target=self.run_schedule)
-        self.thread.start()
-
-    def run_schedule(self):
-        while self.is_running:
-            schedule.run_pending()
-        schedule.clear()
+        # the jobs run on their own workers, a slow GA in one job does not delay the anomaly detection
+        self.scheduler = JobScheduler(max_workers=self.cfg.job_workers, logger=self.logger)
+        self.scheduler.every(self.cfg.ab_check_interval, self.anomaly_detect, name='anomaly_detect', policy='skip')
+        self.scheduler.every(self.cfg.waste_check_interval, self.waste_detection, name='waste_detection', policy='skip')
+        self.scheduler.every(self.cfg.optimize_all_interval, self.optimize_all_mss, name='optimize_all_mss', policy='skip')
+        self.scheduler.start()
 
 
     def cancel(self):
         self.logger.info('Remove PBScaler horizontal scaler...')
         self.is_running = False
+        if self.scheduler is not None:
+            # running jobs finish in the background
+            self.scheduler.stop(wait=False)
+            self.logger.info(f'job statistics: {self.scheduler.report()}')
+        if self.eval_pool is not None:
+            self.eval_pool.shutdown(wait=False, cancel_futures=True)
+            self.eval_pool = None
+        super().cancel()
 
 
     @exception_handler
@@ -171,40 +179,68 @@ class PBScaler(ScalerTemplate):
         optimizing with genetic algorithms
         only optimize the root services
         '''
-        predictor = load_pkl(self.cfg.predictor_path)
+        # loaded once per process and reloaded only when the file changes
+        registry = ModelRegistry.shared(mmap=self.cfg.predictor_mmap)
+        predictor = registry.get(self.cfg.predictor_path)
+        compiled = registry.get(self.cfg.predictor_path, transform=CompiledForest.from_sklearn) \
+            if self.cfg.predictor_compiled else None
         problem = ScalingProblem(
-            predictor=predictor, mask=mask, replicas=replicas, workloads=workloads, lowerBounds=min_array, upperBounds=max_array
-        )
-        algorithm = ea.soea_SGA_templet(
-            problem=problem,
-            population=ea.Population(Encoding="BG", NIND=50),
-            MAXGEN=10,
-            logTras=0
+            predictor=predictor, mask=mask, replicas=replicas, workloads=workloads, lowerBounds=min_array, upperBounds=max_array,
+            compiled=compiled, compiled_max_rows=self.cfg.compiled_max_rows,
+            cache_size=self.cfg.fitness_cache_size, pool=self.get_eval_pool(), pool_workers=self.cfg.eval_workers,
+            predictor_spec=(self.cfg.predictor_path, self.cfg.predictor_mmap, self.cfg.predictor_compiled, self.cfg.compiled_max_rows),
+            pool_min_rows=self.cfg.eval_pool_min_rows
         )
         st = time.time()
-        res = ea.optimize(
-            algorithm,
-            verbose=False,
-            drawing=0,
-            outputMsg=False,
-            drawLog=False,
-            saveFlag=False,
-        )
+        if 0 < problem.space_size() <= self.cfg.exhaustive_limit:
+            # small search space: every vector is evaluated in one batch, the optimum is exact
+            method = 'enumeration'
+            best_vars, fitness = problem.enumerate()
+            vars = best_vars.tolist()
+        else:
+            method = 'GA'
+            algorithm = ea.soea_SGA_templet(
+                problem=problem,
+                population=ea.Population(Encoding="BG", NIND=50),
+                MAXGEN=10,
+                logTras=0
+            )
+            res = ea.optimize(
+                algorithm,
+                verbose=False,
+                drawing=0,
+                outputMsg=False,
+                drawLog=False,
+                saveFlag=False,
+            )
+            vars = res["Vars"].flatten().tolist()
+            fitness = res["ObjV"].flatten().tolist()[0]
         ed = time.time()
-        vars = res["Vars"].flatten().tolist()
-        fitness = res["ObjV"].flatten().tolist()[0]
         self.logger.debug(f'the workloads is {workloads}')
         self.logger.debug(f'the replicas is {replicas}')
         self.logger.debug(f'the mask is {mask}')
         self.logger.debug(f'the vars is {vars}')
-        self.logger.debug(f"the fitness of GA is {fitness:.2f}")
-        self.logger.debug(f"the time cost of GA is {(ed-st):.2f}")
+        self.logger.debug(f"the fitness of {method} is {fitness:.2f}")
+        self.logger.debug(f"the time cost of {method} is {(ed-st):.2f}, "
+                          f"{problem.evaluated}/{problem.requested} vectors evaluated by the predictor")
         actions = {}
         for i in range(len(vars)):
             actions[target_svcs[i]] = vars[i]
 
         self.execute_task(actions)
 
+    def get_eval_pool(self):
+        '''
+            worker processes for the fitness of large populations, created on first use.
+            The workers are started by a forkserver: forking this process, whose scheduler, dispatcher
+            and informer threads may hold locks, could deadlock them. They load the predictor themselves
+        '''
+        # no new pool once cancel() has shut it down
+        if self.eval_pool is None and self.cfg.eval_workers > 1 and self.is_running:
+            self.eval_pool = ProcessPoolExecutor(max_workers=self.cfg.eval_workers,
+                                                 mp_context=multiprocessing.get_context('forkserver'))
+        return self.eval_pool
+
     @exception_handler
     def build_abnormal_subgraph(self, calls):
         """
@@ -294,20 +330,55 @@ class PBScaler(ScalerTemplate):
 import geatpy as ea
 np.set_printoptions(suppress=True)
 
+def predict_rows(predictor_spec, rows):
+    '''
+        predictions of a chunk of inputs in a worker process, the predictor is loaded once per worker
+        predictor_spec: (path, mmap, compiled, compiled_max_rows)
+    '''
+    path, mmap, compiled, compiled_max_rows = predictor_spec
+    use_compiled = compiled and len(rows) < compiled_max_rows
+    predictor = ModelRegistry.shared(mmap=mmap).get(path, transform=CompiledForest.from_sklearn if use_compiled else None)
+    return predictor.predict(rows)
+
+
 class ScalingProblem(ea.Problem):
+    '''
+        fitness of the replica vectors of the target services: only the unique vectors that were not
+        evaluated yet reach the predictor (the fitness of the others comes from a bounded LRU cache),
+        and large batches are split over `pool` when one is given.
+        Batches smaller than compiled_max_rows are predicted by `compiled` (a CompiledForest of the
+        predictor) when given, larger ones by the sklearn predictor, which is faster on them.
+    '''
     def __init__(self,
                  predictor: Predictor,
                  mask,
                  replicas,
                  workloads,
                  lowerBounds,
-                 upperBounds):
+                 upperBounds,
+                 compiled=None,
+                 compiled_max_rows=512,
+                 cache_size=4096,
+                 pool=None,
+                 pool_workers=1,
+                 predictor_spec=None,
+                 pool_min_rows=2048):
         name = 'ScalingProblem'
         self.predictor = predictor
+        self.compiled = compiled
+        self.compiled_max_rows = compiled_max_rows
         self.mask = np.array(mask)
         self.replicas = np.array(replicas)
         self.workloads = np.array(workloads)
         self.total_max_num = np.sum(upperBounds)
+        self.cache = OrderedDict()  # replica vector -> fitness
+        self.cache_size = cache_size
+        self.pool = pool
+        self.pool_workers = pool_workers
+        self.predictor_spec = predictor_spec
+        self.pool_min_rows = pool_min_rows
+        self.evaluated = 0  # vectors sent to the predictor
+        self.requested = 0  # vectors asked by the algorithm
         M = 1  # number of objective
         maxormins = [-1]  # -1: maximize; 1: minimize
         Dim = len(lowerBounds)
@@ -324,9 +395,20 @@ class ScalingProblem(ea.Problem):
                             upperBounds,
                             lbin,
                             ubin)
+        # integer bounds for the enumeration of the search space
+        self.lower_bounds = np.array(lowerBounds, dtype=int)
+        self.upper_bounds = np.array(upperBounds, dtype=int)
 
 
-    def evalVars(self, Vars):
+    def predict(self, final_input):
+        if self.pool is None or self.predictor_spec is None or len(final_input) < self.pool_min_rows:
+            if self.compiled is not None and len(final_input) < self.compiled_max_rows:
+                return self.compiled.predict(final_input)
+            return self.predictor.predict(final_input)
+        chunks = np.array_split(final_input, self.pool_workers)
+        return np.concatenate(list(self.pool.map(predict_rows, [self.predictor_spec] * len(chunks), chunks)))
+
+    def fitness(self, Vars):
         # fill the mask
         expanded_replicas = np.tile(self.replicas, (Vars.shape[0], 1))
         expanded_workloads = np.tile(self.workloads, (Vars.shape[0], 1))
@@ -336,7 +418,47 @@ class ScalingProblem(ea.Problem):
         final_svc_count = np.where(expanded_mask == 1, new_values_matrix, expanded_replicas)
         final_input = np.hstack([final_svc_count, expanded_workloads])
 
-        R1 = 1-self.predictor.predict(final_input)
+        R1 = 1-self.predict(final_input)
         R2 = (1 - (Vars.sum(axis=1) / self.total_max_num))
         alpha, beta = 0.5, 0.5
-        return (alpha * R1 + beta * R2).reshape(-1,1)
\ No newline at end of file
+        return alpha * R1 + beta * R2
+
+    def evalVars(self, Vars):
+        Vars = np.asarray(Vars).astype(int)
+        self.requested += len(Vars)
+        # the GA decodes the same vectors again and again across generations
+        uniques, inverse = np.unique(Vars, axis=0, return_inverse=True)
+        keys = [tuple(row) for row in uniques.tolist()]
+        fitness = np.empty(len(uniques))
+        missing = []
+        for i, key in enumerate(keys):
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                fitness[i] = self.cache[key]
+            else:
+                missing.append(i)
+        if len(missing) > 0:
+            fitness[missing] = self.fitness(uniques[missing])
+            self.evaluated += len(missing)
+            for i in missing:
+                self.cache[keys[i]] = fitness[i]
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return fitness[inverse.reshape(-1)].reshape(-1, 1)
+
+    def space_size(self):
+        return int(np.prod(np.clip(self.upper_bounds - self.lower_bounds + 1, 0, None), dtype=float))
+
+    def enumerate(self):
+        '''
+            evaluate every replica vector between the bounds, return the best one and its fitness.
+            Vectors with the same fitness have the same predicted class and the same total of replicas,
+            the first of them in lexicographic order wins (the fewest replicas on the first services)
+        '''
+        axes = [np.arange(lb, ub + 1) for lb, ub in zip(self.lower_bounds, self.upper_bounds)]
+        Vars = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, len(axes))
+        fitness = self.fitness(Vars)
+        self.requested += len(Vars)
+        self.evaluated += len(Vars)
+        best = int(np.argmax(fitness))
+        return Vars[best], float(fitness[best])
@@ -16,4 +16,5 @@ class ShowarConfig(ScalerConfig):
                         'payment': 10, 'queue-master': 10, 'user': 10}
         
         self.alpha = 0.1
-        self.beta = 1
\ No newline at end of file
+        self.beta = 1
+        self.interval = 3 # control tick (s)
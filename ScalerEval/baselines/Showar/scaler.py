@@ -7,6 +7,7 @@ import asyncio
 import math
 
 from baselines.Showar.cfg import ShowarConfig
+from baselines.scaler_runtime import ScalerRuntime
 from baselines.scaler_template import ScalerTemplate
 from utils.logger import get_logger
 
@@ -18,50 +19,58 @@ class ShowarScaler(ScalerTemplate):
 
         self.is_running = False
         self.logger = get_logger('./logs', 'Showar')
+        # created here so that a cancel() racing with register() still stops it
+        self.runtime = ScalerRuntime(self.cfg.interval, self.logger)
 
     async def register(self):
         self.logger.info('Register Showar horizontal scaler...')
         self.is_running = True
-        PIDs = {}
+        self.PIDs = {}
         SLOs: dict = self.cfg.SLOs
         self.logger.debug(SLOs)
         for deployment, target in SLOs.items():
-            PIDs[deployment] = PID(10, 0, 10, setpoint=target)
+            self.PIDs[deployment] = PID(10, 0, 10, setpoint=target)
+        # the queries run in worker threads, the event loop stays free for the load injection
+        await self.runtime.run(self.tick)
 
-        while self.is_running:
-            p95_df = self.monitor.get_latency(self.deployments, self.namespace, p=0.95, range=False)
-            pod_df = self.monitor.get_pod_num(self.deployments, self.namespace, range=False)
-            for deployment, target in SLOs.items():
-                try:
-                    latency_col = f'{deployment}&0.95'
-                    p95 = 0 if latency_col not in p95_df.columns else p95_df[latency_col][0]
-                    RM = int(pod_df[f'{deployment}&count'][0])
-                    target = SLOs[deployment]
-                    controller = PIDs[deployment]
-                    min_replicas, max_replicas = self.cfg.min_count, self.cfg.max_count
-                    output = -1 * controller(p95)
-                    
-                    if output > target * (1 + (self.cfg.alpha / 2)):
-                        new_RM = math.ceil(RM + max(1, RM * self.cfg.beta))
-                    elif output < target * (1 - (self.cfg.alpha / 2)):
-                        new_RM = math.ceil(RM - max(1, RM * self.cfg.beta))
-                    else:
-                        new_RM = RM
-
-                    if (RM != new_RM) and (min_replicas <= new_RM <= max_replicas):
-                        self.logger.info(f'{deployment} latency is: {p95}')
-                        self.logger.info(f'{deployment} PID score is: {output}')
-                        self.logger.info(f'{deployment} is scaled to {new_RM}')
-                        self.logger.info('=====================================================')
-                        super().scale(deployment, int(new_RM))
-                except:
-                    self.logger.error(f'encounter some errors in scaling {deployment}...')
+    async def tick(self):
+        if not self.is_running:
+            return
+        SLOs: dict = self.cfg.SLOs
+        p95_df, pod_df = await asyncio.gather(
+            self.amonitor.get_latency(self.deployments, self.namespace, p=0.95, range=False),
+            self.amonitor.get_pod_num(self.deployments, self.namespace, range=False))
+        for deployment, target in SLOs.items():
+            try:
+                latency_col = f'{deployment}&0.95'
+                p95 = 0 if latency_col not in p95_df.columns else p95_df[latency_col][0]
+                RM = int(pod_df[f'{deployment}&count'][0])
+                target = SLOs[deployment]
+                controller = self.PIDs[deployment]
+                min_replicas, max_replicas = self.cfg.min_count, self.cfg.max_count
+                output = -1 * controller(p95)
+                
+                if output > target * (1 + (self.cfg.alpha / 2)):
+                    new_RM = math.ceil(RM + max(1, RM * self.cfg.beta))
+                elif output < target * (1 - (self.cfg.alpha / 2)):
+                    new_RM = math.ceil(RM - max(1, RM * self.cfg.beta))
+                else:
+                    new_RM = RM
 
-            await asyncio.sleep(3)
+                if (RM != new_RM) and (min_replicas <= new_RM <= max_replicas):
+                    self.logger.info(f'{deployment} latency is: {p95}')
+                    self.logger.info(f'{deployment} PID score is: {output}')
+                    self.logger.info(f'{deployment} is scaled to {new_RM}')
+                    self.logger.info('=====================================================')
+                    super().scale(deployment, int(new_RM))
+            except:
+                self.logger.error(f'encounter some errors in scaling {deployment}...')
                     
     def cancel(self):
         self.logger.info('Remove Showar horizontal scaler...')
         self.is_running = False
+        self.runtime.stop()
+        super().cancel()
 
         
         
@@ -4,7 +4,23 @@ from config.exp_config import Config
 class ScalerConfig:
     def __init__(self, config: Config):
         self.monitor_url = config.prom_url
+        # control loops query frequently, fail fast and retry instead of blocking a tick
+        self.monitor_timeout = 5
+        self.monitor_retries = 2
+        # cache shared by the control loops, identical queries within the ttl (s) hit prometheus once,
+        # off by default (cached samples can be up to ttl old), a scaler opts in by setting a ttl > 0
+        self.monitor_cache_ttl = 0
+        self.monitor_cache_size = 256
         self.excutor_cfg = config.kube_config
+        self.excutor_informer = config.kube_informer
+        self.excutor_backend = config.kube_backend
+        self.excutor_sim = config.kube_sim
+        # scale actions of a deployment within the window (s) are coalesced, the last one wins
+        self.scale_window = 0.5
+        self.scale_workers = 4
+        # max scale patches per second (and burst) in the namespace
+        self.scale_rate = 10
+        self.scale_burst = 10
         self.scaler_name = config.select_scaler
         self.namespace = config.benchmarks[config.select_benchmark]['namespace']
         self.min_count = 1
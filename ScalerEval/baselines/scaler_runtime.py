@@ -0,0 +1,188 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ScalerRuntime:
+    '''
+        Run the control ticks of a scaler on a fixed cadence inside the event loop.
+        Ticks are scheduled on the grid start + k * interval, so the time spent in a tick
+        does not accumulate as drift. A tick running past its slot is an overrun: the
+        missed slots are skipped (never run back to back) and reported to the logger.
+    '''
+    def __init__(self, interval: float, logger=None):
+        self.interval = interval
+        self.logger = logger
+        self.is_running = False
+        self.stopped = False
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.max_lateness = 0.0
+
+    async def run(self, tick):
+        '''
+            await tick() every interval seconds until stop() is called,
+            return at once if stop() was called before
+        '''
+        loop = asyncio.get_running_loop()
+        if self.stopped:
+            return
+        self.is_running = True
+        next_time = loop.time()
+        while self.is_running:
+            lateness = loop.time() - next_time
+            self.max_lateness = max(self.max_lateness, lateness)
+            try:
+                await tick()
+            except Exception as e:
+                self.log('error', f'tick {self.ticks} failed: {e}')
+            self.ticks += 1
+            next_time += self.interval
+            now = loop.time()
+            if now > next_time:
+                missed = int((now - next_time) // self.interval) + 1
+                self.overruns += 1
+                self.skipped += missed
+                self.log('warning', f'tick {self.ticks - 1} overran its slot by {now - next_time:.2f}s, skip {missed} tick(s)')
+                next_time += missed * self.interval
+            await asyncio.sleep(max(0.0, next_time - loop.time()))
+
+    def stop(self):
+        self.stopped = True
+        self.is_running = False
+
+    def log(self, level, message):
+        if self.logger is not None:
+            getattr(self.logger, level)(message)
+        else:
+            print(message)
+
+
+class Job:
+    def __init__(self, name: str, func, interval: float, policy: str):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.policy = policy
+        self.running = 0
+        self.runs = 0
+        self.skipped = 0
+        self.failed = 0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+
+
+class JobScheduler:
+    '''
+        Periodic jobs of a scaler: a timer thread sleeps until the next due job and hands it
+        to a bounded pool, so a slow job does not delay the others. When a job is still
+        running at its next due time its policy decides: 'skip' drops that run, 'overlap'
+        runs it anyway. Slots missed while the scheduler was late are skipped to stay on the
+        grid. Lateness (start - due time, including the wait for a free worker) is kept per job.
+    '''
+    POLICIES = ('skip', 'overlap')
+
+    def __init__(self, max_workers=4, logger=None):
+        self.max_workers = max_workers
+        self.logger = logger
+        self.jobs = []
+        self.heap = []
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.is_running = False
+        self.thread = None
+        self.pool = None
+
+    def every(self, interval: float, func, name=None, policy='skip', first_delay=None):
+        '''
+            run func every interval seconds, the first run is after first_delay (default: interval)
+        '''
+        if policy not in self.POLICIES:
+            raise ValueError(f'unknown policy {policy}, expected one of {self.POLICIES}')
+        job = Job(name or func.__name__, func, interval, policy)
+        due = time.monotonic() + (interval if first_delay is None else first_delay)
+        with self.cond:
+            self.jobs.append(job)
+            heapq.heappush(self.heap, (due, next(self.seq), job))
+            self.cond.notify()
+        return job
+
+    def start(self):
+        with self.cond:
+            if self.is_running:
+                return
+            self.is_running = True
+            self.pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self, wait=False):
+        '''
+            stop scheduling, wait=True also waits for the running jobs
+        '''
+        with self.cond:
+            self.is_running = False
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        if self.pool is not None:
+            self.pool.shutdown(wait=wait)
+
+    def run(self):
+        with self.cond:
+            while self.is_running:
+                if len(self.heap) == 0:
+                    self.cond.wait()
+                    continue
+                due, _, job = self.heap[0]
+                now = time.monotonic()
+                if due > now:
+                    self.cond.wait(due - now)
+                    continue
+                heapq.heappop(self.heap)
+                if job.running > 0 and job.policy == 'skip':
+                    job.skipped += 1
+                else:
+                    job.running += 1
+                    self.pool.submit(self.execute, job, due)
+                next_due = due + job.interval
+                if next_due <= now:
+                    missed = int((now - next_due) // job.interval) + 1
+                    job.skipped += missed
+                    next_due += missed * job.interval
+                heapq.heappush(self.heap, (next_due, next(self.seq), job))
+
+    def execute(self, job: Job, due: float):
+        lateness = time.monotonic() - due
+        try:
+            job.func()
+        except Exception as e:
+            job.failed += 1
+            self.log('error', f'job {job.name} failed: {e}')
+        finally:
+            with self.cond:
+                job.running -= 1
+                job.runs += 1
+                job.total_lateness += lateness
+                job.max_lateness = max(job.max_lateness, lateness)
+
+    def report(self):
+        '''
+            {job: {'runs', 'skipped', 'failed', 'mean_lateness', 'max_lateness'}}
+        '''
+        with self.cond:
+            return {job.name: {'runs': job.runs,
+                               'skipped': job.skipped,
+                               'failed': job.failed,
+                               'mean_lateness': job.total_lateness / job.runs if job.runs > 0 else 0.0,
+                               'max_lateness': job.max_lateness} for job in self.jobs}
+
+    def log(self, level, message):
+        if self.logger is not None:
+            getattr(self.logger, level)(message)
+        else:
+            print(message)
@@ -1,6 +1,9 @@
+import asyncio
 from baselines.scaler_config_template import ScalerConfig
-from utils.cloud.executor import KubernetesClient
-from utils.cloud.monitor import PrometheusClient
+from utils.cloud.aio import AsyncClient
+from utils.cloud.dispatcher import ScaleDispatcher
+from utils.cloud.executor import create_kube_client
+from utils.cloud.monitor import PrometheusClient, PrometheusTransport, PromQueryCache
 
 
 class ScalerTemplate:
@@ -8,17 +11,49 @@ class ScalerTemplate:
         self.name = name
         self.cfg = cfg
         self.namespace = cfg.namespace
-        self.monitor = PrometheusClient(cfg.monitor_url)
-        self.executor = KubernetesClient(cfg.excutor_cfg)
+        cache = None
+        if cfg.monitor_cache_ttl > 0:
+            cache = PromQueryCache.shared(cfg.monitor_url, cfg.monitor_cache_ttl, cfg.monitor_cache_size)
+        self.monitor = PrometheusClient(cfg.monitor_url,
+                                        transport=PrometheusTransport(timeout=cfg.monitor_timeout,
+                                                                      retries=cfg.monitor_retries),
+                                        cache=cache)
+        self.executor = create_kube_client(cfg.excutor_cfg,
+                                           backend=cfg.excutor_backend,
+                                           informer=cfg.excutor_informer,
+                                           sim_options=cfg.excutor_sim)
+        self.dispatcher = ScaleDispatcher(self.executor, self.namespace,
+                                          window=cfg.scale_window,
+                                          max_workers=cfg.scale_workers,
+                                          rate=cfg.scale_rate,
+                                          burst=cfg.scale_burst,
+                                          on_result=self.on_scaled)
+        # awaitable views for the control loops running in the event loop
+        self.amonitor = AsyncClient(self.monitor)
+        self.aexecutor = AsyncClient(self.executor)
 
     async def register(self):
         # register the scaler
         pass
 
     def cancel(self):
-        # remove the scaler
-        pass
+        # remove the scaler, the pending scale actions are still sent in the background (see closed)
+        self.dispatcher.close(wait=False)
+
+    async def closed(self):
+        # wait in a worker thread until the scale actions sent after cancel are acknowledged
+        await asyncio.to_thread(self.dispatcher.join)
 
     def scale(self, ms, replica_num):
-        # scaling the replcas of a microservice to the expected count
-        self.executor.patch_scale(ms, int(replica_num), self.namespace, async_req=True)
+        # scaling the replcas of a microservice to the expected count, never blocks the caller
+        self.dispatcher.submit(ms, int(replica_num))
+
+    def on_scaled(self, ms, replica_num, error):
+        logger = getattr(self, 'logger', None)
+        if error is None:
+            return
+        message = f'failed to scale {ms} to {replica_num}: {error}'
+        if logger is not None:
+            logger.error(message)
+        else:
+            print(message)
@@ -5,12 +5,32 @@ class Config:
         self.locust_exp_name = 'wiki'
         self.locust_exp_time = 1200
         self.locust_load_dist = '1'
+        self.latency_quantiles = [0.5, 0.9, 0.95, 0.99] # quantiles of latency recorded in record.csv
+        self.record_during_load = True # record metrics in the background during the load instead of after it
+        self.record_interval = 30 # interval (s) of pulling fresh samples
+        self.record_delay = 15 # lag (s) behind now, at least one scrape interval of prometheus
 
         # Prometheus config
         self.prom_url=f'http://192.168.31.130:30001'
+        self.prom_max_concurrency = 8 # max number of in-flight queries when collecting metrics concurrently
+        self.prom_timeout = 30 # timeout (s) of a single query
+        self.prom_retries = 3 # retries on 5xx responses and timeouts
+        self.prom_max_points = 11000 # longer range queries are split into chunks fetched in parallel
 
         # Kubernetes config
         self.kube_config = './config/kube.yaml'
+        self.kube_backend = 'cluster' # 'cluster': the cluster of kube_config, 'sim': in-process simulator without a cluster
+        self.kube_sim = {'speedup': 60, 'startup_delay': 20, 'termination_delay': 10} # simulated seconds per second, pod start/stop delays (s)
+        self.kube_informer = False # serve deployment/pod/hpa reads from watch-fed local caches instead of LIST calls
+        self.env_ready_timeout = 900 # timeout (s) of waiting for deployments available, pods ready and namespace terminated
+        self.env_wait_sidecar = True # also wait for the istio-proxy sidecar of every pod to be ready
+        self.stable_interval = 10 # interval (s) between two samples of the stabilization check
+        self.stable_samples = 3 # number of consecutive samples that should agree
+        self.stable_tolerance = 0.2 # max relative spread of the namespace cpu usage among the samples
+        self.stable_timeout = 120 # give up the stabilization check after it (s)
+        self.env_reset = True # reuse the deployed benchmark between runs (reset_env), recreate it only when it drifted
+        self.reset_restart_pods = False # roll all pods on reset
+        self.reset_flush_stores = True # restart the stateful stores (redis, mongo, db...) on reset to drop their data
 
         # benchmark config
         self.benchmarks = {
@@ -3,12 +3,48 @@ from base_module import init_client
 from config.exp_config import Config
 from functools import reduce
 import pandas as pd
+import threading
 import time
 from utils.cloud.monitor import PrometheusClient
 from utils.cloud.executor import KubernetesClient
+from utils.cloud.resources import attach_limits
 from utils import io_util
 
+def query_record(prom_client: PrometheusClient, deployments: list, namespace: str, config: Config, how='inner'):
+    '''
+        query all columns of record.csv in the time range of prom_client,
+        how='outer' keeps the timestamps where only some of the series have samples
+    '''
+    # send all queries at once, the collection takes as long as the slowest query
+    queries = {
+        'pod': (prom_client.get_pod_num, (deployments, namespace), {'range': True}),
+        'qps': (prom_client.get_complete_qps, (deployments, namespace), {'range': True}),
+        'metric': (prom_client.get_metrics, (deployments, namespace), {'range': True}),
+        # all latency quantiles are computed from one fetch of the histogram buckets
+        'latency': (prom_client.get_latencies, (deployments, namespace, config.latency_quantiles), {'range': True}),
+        'node_metric': (prom_client.get_node_metric, (), {'range': True}),
+        'namespace_resource': (prom_client.get_resource_metric, (namespace,), {'range': True}),
+    }
+    dfs = prom_client.collect_concurrently(queries)
+    # a query without any series yet (e.g. istio metrics before the first requests) has no columns to merge
+    dfs = [df for df in dfs.values() if not df.empty]
+    if len(dfs) == 0:
+        return pd.DataFrame(columns=['timestamp'])
+    data_df = reduce(lambda left, right: pd.merge(left, right, on='timestamp', how=how), dfs)
+    return data_df.sort_values('timestamp', ignore_index=True) if how == 'outer' else data_df
+
+
 def collect_metrics(config: Config):
+    load_dist = config.locust_load_dist
+    exp_name = config.locust_exp_name
+    scaler_name = config.select_scaler
+    benchmark = config.select_benchmark
+    resultPath = f"tmp/{benchmark}/dist{load_dist}/{exp_name}/{scaler_name}"
+    if config.record_during_load and os.path.exists(f'{resultPath}/record.csv'):
+        # MetricRecorder removes the old record when it starts and finalizes the new one when the load ends
+        print(f'metrics were recorded during the load in {resultPath}, skip the post-run collection')
+        return
+
     kube_client: KubernetesClient
     prom_client: PrometheusClient
     prom_client, kube_client = init_client(config)
@@ -21,42 +57,10 @@ def collect_metrics(config: Config):
     deployments = kube_client.get_deployments(namespace)
     print(f'microservices in {namespace}: {deployments}')
 
-    pod_df = prom_client.get_pod_num(deployments, namespace, range=True)
-    qps_df = prom_client.get_complete_qps(deployments, namespace, range=True)
-    metric_df = prom_client.get_metrics(deployments, namespace, range=True)
-    node_metric_df = prom_client.get_node_metric(range=True)
-    P50_df = prom_client.get_latency(deployments, namespace, 0.50, range=True)
-    P90_df = prom_client.get_latency(deployments, namespace, 0.90, range=True)
-    P95_df = prom_client.get_latency(deployments, namespace, 0.95, range=True)
-    P99_df = prom_client.get_latency(deployments, namespace, 0.99, range=True)
-    namespace_resource_df = prom_client.get_resource_metric(namespace, range=True)
-    metric_limits = kube_client.get_deployments_limit(deployments, namespace)
-
-    data_df = reduce(lambda left, right: pd.merge(left, right, on='timestamp'), 
-                    [pod_df, qps_df, metric_df, P50_df, P90_df, P95_df, P99_df, node_metric_df, namespace_resource_df])
-    
-    for svc, (cpu_limit, mem_limit) in metric_limits.items():
-        if cpu_limit is None:
-            data_df[f'{svc}&cpu_limit'] = None
-        elif 'm' in cpu_limit:
-            data_df[f'{svc}&cpu_limit'] = float(cpu_limit[:-1])
-        else:
-            data_df[f'{svc}&cpu_limit'] = float(cpu_limit) * 1000
-        
-        if mem_limit is None:
-            data_df[f'{svc}&mem_limit'] = None
-        else:
-            if 'Mi' in mem_limit:
-                data_df[f'{svc}&mem_limit'] = float(mem_limit[:-2])
-            elif 'Gi' in mem_limit:
-                data_df[f'{svc}&mem_limit'] = float(mem_limit[:-2]) * 1024
-        
+    data_df = query_record(prom_client, deployments, namespace, config)
+    metric_limits = kube_client.get_resource_snapshot(namespace).get(deployments)
+    data_df = attach_limits(data_df, metric_limits)
     
-    load_dist = config.locust_load_dist
-    exp_name = config.locust_exp_name
-    scaler_name = config.select_scaler
-    benchmark = config.select_benchmark
-    resultPath = f"tmp/{benchmark}/dist{load_dist}/{exp_name}/{scaler_name}"
     if not os.path.isdir(resultPath):
         os.makedirs(resultPath)
 
@@ -64,6 +68,95 @@ def collect_metrics(config: Config):
     io_util.save_json(f'{resultPath}/limit.json', metric_limits)
 
 
+class MetricRecorder:
+    '''
+        record metrics in the background while the load is injected,
+        fresh samples are appended to record.csv.part every `interval` seconds
+        and the file is renamed to record.csv when the load ends.
+        The header is the union of the columns seen so far: when a series appears later
+        (istio metrics only exist after the first requests), the part file is rewritten
+        with the new columns, empty in the earlier rows
+    '''
+    def __init__(self, config: Config):
+        self.config = config
+        self.prom_client, self.kube_client = init_client(config)
+        self.namespace = config.benchmarks[config.select_benchmark]['namespace']
+        self.interval = config.record_interval
+        # samples newer than now - delay may not be scraped by prometheus yet
+        self.delay = config.record_delay
+        load_dist = config.locust_load_dist
+        exp_name = config.locust_exp_name
+        scaler_name = config.select_scaler
+        benchmark = config.select_benchmark
+        self.result_path = f"tmp/{benchmark}/dist{load_dist}/{exp_name}/{scaler_name}"
+        self.part_path = f'{self.result_path}/record.csv.part'
+        self.columns = None
+        self.last_end = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        os.makedirs(self.result_path, exist_ok=True)
+        for path in [f'{self.result_path}/record.csv', self.part_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        self.deployments = self.kube_client.get_deployments(self.namespace)
+        # the snapshot follows the deployments through a watch, limits changed during the load are recorded
+        self.limits = self.kube_client.get_resource_snapshot(self.namespace, watch=True)
+        self.metric_limits = self.limits.get(self.deployments)
+        self.last_end = int(round(time.time())) - 1
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        print(f'[MetricRecorder] recording metrics of {self.namespace} every {self.interval}s...')
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.record(int(round(time.time())) - self.delay)
+
+    def record(self, end: int):
+        if end <= self.last_end:
+            return
+        self.prom_client.set_time_range(self.last_end + 1, end, 1)
+        try:
+            data_df = query_record(self.prom_client, self.deployments, self.namespace, self.config, how='outer')
+        except Exception as e:
+            # the window is queried again in the next round
+            print(f'[MetricRecorder] failed to record metrics in ({self.last_end}, {end}]: {e}')
+            return
+        self.metric_limits = self.limits.get(self.deployments)
+        if len(data_df) > 0:
+            data_df = attach_limits(data_df, self.metric_limits)
+            self.append(data_df)
+        self.last_end = end
+
+    def append(self, data_df: pd.DataFrame):
+        if self.columns is None:
+            self.columns = list(data_df.columns)
+            data_df.to_csv(self.part_path, index=False)
+            return
+        new_cols = [col for col in data_df.columns if col not in self.columns]
+        if len(new_cols) > 0:
+            print(f'[MetricRecorder] new columns, rewrite the header of {self.part_path}: {new_cols}')
+            self.columns = self.columns + new_cols
+            recorded_df = pd.read_csv(self.part_path)
+            tmp_path = f'{self.part_path}.tmp'
+            recorded_df.reindex(columns=self.columns).to_csv(tmp_path, index=False)
+            os.replace(tmp_path, self.part_path)
+        data_df.reindex(columns=self.columns).to_csv(self.part_path, mode='a', header=False, index=False)
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.record(int(round(time.time())))
+        # no watch is left behind by a benchmark cell
+        self.limits.close()
+        if os.path.exists(self.part_path):
+            os.replace(self.part_path, f'{self.result_path}/record.csv')
+            io_util.save_json(f'{self.result_path}/limit.json', self.metric_limits)
+            print(f'[MetricRecorder] metrics are saved in {self.result_path}/record.csv')
+
+
 def SLA_violation(config: Config,):
     load_dist = config.locust_load_dist
     exp_name = config.locust_exp_name
@@ -34,12 +34,14 @@
 
 import asyncio
 from config.exp_config import Config
+from eval import MetricRecorder
 import os
 import subprocess
 import time
 
 class LoadInjector():
     def __init__(self, config: Config):
+        self.config = config
         self.exp_name = config.locust_exp_name
         self.scaler_name = config.select_scaler
         self.benchmark = config.select_benchmark
@@ -68,14 +70,22 @@ class LoadInjector():
         print('[LoadInjector] Injecting workloads...')
         print(f'[LoadInjector] Command: {" ".join(locust_cmd)}')
         
+        loop = asyncio.get_event_loop()
+        recorder = None
+        if self.config.record_during_load:
+            recorder = MetricRecorder(self.config)
+            await loop.run_in_executor(None, recorder.start)
+
         try:
             # 🔧 使用线程池执行，避免Windows异步subprocess问题
-            loop = asyncio.get_event_loop()
             await loop.run_in_executor(None, self._run_locust_sync, locust_cmd, resultPath)
             
         except Exception as e:
             print(f'[LoadInjector] Error during workload injection: {str(e)}')
             raise
+        finally:
+            if recorder is not None:
+                await loop.run_in_executor(None, recorder.stop)
         
         print('[LoadInjector] Load injection process finished')
 
@@ -2,7 +2,7 @@
 import time
 import os
 import asyncio
-from base_module import end_env, init_env, register_scaler
+from base_module import end_env, init_env, register_scaler, reset_env
 from config.exp_config import Config
 from load.load import LoadInjector
 from eval import collect_metrics, SLA_violation, resource_consumption, succ_rate
@@ -10,12 +10,17 @@ from eval import collect_metrics, SLA_violation, resource_consumption, succ_rate
 async def performance_comparison_flow():
     config = Config()
     for benchmark in ['hipster', 'sockshop']:
+        deployed = False
         for scaler in ['None','KHPA-20', 'KHPA-50', 'KHPA-80', 'Showar', 'PBScaler']:
             config.select_benchmark = benchmark
             config.select_scaler = scaler
 
-            # init microservices
-            init_env(config)
+            # init microservices, reuse the ones of the previous run if they can be reset
+            if not (deployed and config.env_reset and reset_env(config)):
+                if deployed:
+                    end_env(config)
+                init_env(config)
+            deployed = True
 
             # register autoscaler
             scaler, task = register_scaler(config)
@@ -32,9 +37,13 @@ async def performance_comparison_flow():
             if task != None:
                 await task
 
-            # stop microservices
+            # stop microservices, end_env returns once the namespace is terminated
+            # and init_env waits for the next benchmark to be ready and stable
+            if not config.env_reset:
+                end_env(config)
+                deployed = False
+        if deployed:
             end_env(config)
-            time.sleep(60)
 
 
 async def performance_eval_flow():
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+
+from baselines.PBScaler.compiled_forest import CompiledForest, random_inputs
+
+
+@pytest.fixture(scope='module')
+def forest():
+    # the shape of the inputs of Predictor: replica counts then workloads of 4 services
+    rng = np.random.default_rng(0)
+    replicas = rng.integers(1, 9, size=(600, 4))
+    workloads = rng.uniform(0, 200, size=(600, 4))
+    labels = (workloads.sum(axis=1) / replicas.sum(axis=1) > 40).astype(int)
+    return RandomForestClassifier(n_estimators=20, random_state=0).fit(np.hstack([replicas, workloads]), labels)
+
+
+@pytest.mark.parametrize('n_samples', [1, 7, 100, 1000])
+def test_predictions_are_bit_identical_to_sklearn(forest, n_samples):
+    compiled = CompiledForest.from_sklearn(forest)
+    X = random_inputs(forest, n_samples, np.random.default_rng(n_samples))
+    assert np.array_equal(compiled.predict_proba(X), forest.predict_proba(X))
+    assert np.array_equal(compiled.predict(X), forest.predict(X))
+
+
+def test_leaves_match_sklearn_apply(forest):
+    compiled = CompiledForest.from_sklearn(forest)
+    X = random_inputs(forest, 50, np.random.default_rng(1))
+    offsets = np.concatenate([[0], np.cumsum([estimator.tree_.node_count for estimator in forest.estimators_])[:-1]])
+    assert np.array_equal(compiled.apply(X), forest.apply(X.astype(np.float32)) + offsets)
+
+
+def test_thresholds_are_compared_like_sklearn(forest):
+    compiled = CompiledForest.from_sklearn(forest)
+    # inputs exactly on the split thresholds take the same branch as in sklearn
+    tree = forest.estimators_[0].tree_
+    X = np.tile(random_inputs(forest, 1, np.random.default_rng(2)), (8, 1))
+    for i, node in enumerate(np.flatnonzero(tree.children_left != -1)[:8]):
+        X[i, tree.feature[node]] = tree.threshold[node]
+    assert np.array_equal(compiled.predict_proba(X), forest.predict_proba(X))
+
+
+def test_wrong_input_shape(forest):
+    with pytest.raises(ValueError):
+        CompiledForest.from_sklearn(forest).predict(np.zeros((3, 5)))
@@ -0,0 +1,84 @@
+import itertools
+import threading
+from types import SimpleNamespace
+
+from utils.cloud.dispatcher import ScaleDispatcher
+
+namespaces = itertools.count()
+
+
+class FakeExecutor:
+    '''
+        the deployments of a namespace and the patches sent to them
+    '''
+    def __init__(self, replicas, failing=()):
+        self.replicas = dict(replicas)
+        self.failing = set(failing)
+        self.patches = []
+        self.lock = threading.Lock()
+
+    def list_deployment_objects(self, namespace):
+        return [SimpleNamespace(metadata=SimpleNamespace(name=name), spec=SimpleNamespace(replicas=count))
+                for name, count in self.replicas.items()]
+
+    def patch_scale(self, deployment, replicas, namespace, async_req=False):
+        with self.lock:
+            self.patches.append((deployment, replicas))
+        if deployment in self.failing:
+            raise RuntimeError('conflict')
+        self.replicas[deployment] = replicas
+
+
+def make_dispatcher(executor, **kwargs):
+    results = []
+    # a fresh namespace per test, the rate limiter is shared per namespace
+    dispatcher = ScaleDispatcher(executor, f'test-{next(namespaces)}', window=0.05, rate=1000, burst=1000,
+                                 on_result=lambda *result: results.append(result), **kwargs)
+    return dispatcher, results
+
+
+def test_actions_are_coalesced_and_known_counts_skipped():
+    executor = FakeExecutor({'carts': 1, 'orders': 2})
+    dispatcher, results = make_dispatcher(executor)
+    dispatcher.submit('carts', 2)
+    dispatcher.submit('carts', 3)
+    dispatcher.submit('orders', 2)
+    dispatcher.close()
+    assert executor.patches == [('carts', 3)]
+    assert results == [('carts', 3, None)]
+    stats = dispatcher.stats
+    assert (stats['submitted'], stats['coalesced'], stats['skipped'], stats['succeeded']) == (3, 1, 1, 1)
+
+
+def test_submit_after_close_is_rejected():
+    executor = FakeExecutor({'carts': 1})
+    dispatcher, _ = make_dispatcher(executor)
+    dispatcher.close()
+    assert not dispatcher.submit('carts', 2)
+    assert dispatcher.stats['rejected'] == 1
+    assert executor.patches == []
+
+
+def test_failed_patch_is_reported_and_not_skipped_later():
+    executor = FakeExecutor({'carts': 1}, failing={'carts'})
+    dispatcher, results = make_dispatcher(executor)
+    dispatcher.submit('carts', 2)
+    dispatcher.close()
+    assert len(results) == 1 and isinstance(results[0][2], RuntimeError)
+    assert dispatcher.stats['failed'] == 1
+    # the count is unknown after a failure, the same action is sent again
+    dispatcher, _ = make_dispatcher(executor)
+    dispatcher.submit('carts', 2)
+    dispatcher.close()
+    assert executor.patches == [('carts', 2), ('carts', 2)]
+
+
+def test_close_without_wait_sends_pending_actions():
+    executor = FakeExecutor({name: 1 for name in 'abcd'})
+    dispatcher, _ = make_dispatcher(executor)
+    for name in 'abcd':
+        dispatcher.submit(name, 2)
+    dispatcher.close(wait=False)
+    dispatcher.join(timeout=5)
+    assert sorted(executor.patches) == [(name, 2) for name in 'abcd']
+    assert dispatcher.pool._shutdown
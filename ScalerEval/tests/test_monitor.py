@@ -0,0 +1,91 @@
+import math
+
+import numpy as np
+import pytest
+
+from utils.cloud.monitor import MetricSpec, histogram_quantile, merge_chunk_results, plan_queries, scatter_results
+
+INF = float('inf')
+
+
+def test_histogram_quantile_interpolates_inside_buckets():
+    les = [1, 2, 4, INF]
+    buckets = [[10, 20, 30, 40]]
+    result = histogram_quantile([0.25, 0.5, 0.6], les, buckets)
+    # rank 10 ends the first bucket, rank 20 the second, rank 24 is 4/10 into (2, 4]
+    np.testing.assert_allclose(result, [[1.0, 2.0, 2.8]])
+
+
+def test_histogram_quantile_edge_cases():
+    les = [1, 2, 4, INF]
+    # the rank falls into +Inf: upper bound of the second highest bucket
+    assert histogram_quantile([0.9], les, [[10, 20, 30, 40]])[0, 0] == 4.0
+    # no observation, out of range and NaN quantiles follow prometheus
+    assert np.isnan(histogram_quantile([0.5], les, [[0, 0, 0, 0]])[0, 0])
+    result = histogram_quantile([-0.1, 1.1, math.nan], les, [[10, 20, 30, 40]])
+    assert result[0, 0] == -INF and result[0, 1] == INF and np.isnan(result[0, 2])
+    # without a +Inf bucket the quantile is undefined
+    assert np.isnan(histogram_quantile([0.5], [1, 2, 4], [[10, 20, 30]])[0, 0])
+
+
+def test_histogram_quantile_fixes_non_monotonic_buckets():
+    les = [1, 2, 4, INF]
+    np.testing.assert_allclose(histogram_quantile([0.5], les, [[10, 9, 30, 40]]),
+                               histogram_quantile([0.5], les, [[10, 10, 30, 40]]))
+
+
+def test_histogram_quantile_is_vectorized_over_samples():
+    les = [1, 2, 4, INF]
+    buckets = [[10, 20, 30, 40], [0, 0, 0, 0], [40, 40, 40, 40]]
+    result = histogram_quantile([0.5, 0.6], les, buckets)
+    for i, row in enumerate(buckets):
+        np.testing.assert_allclose(result[i], histogram_quantile([0.5, 0.6], les, [row])[0])
+
+
+def test_merge_chunk_results_deduplicates_boundaries():
+    first = [{'metric': {'a': '1'}, 'values': [[0, '1'], [15, '2']]},
+             {'metric': {'a': '2'}, 'values': [[0, '5']]}]
+    second = [{'metric': {'a': '1'}, 'values': [[15, '9'], [30, '3']]}]
+    merged = merge_chunk_results([first, second])
+    assert merged == [{'metric': {'a': '1'}, 'values': [[0, '1'], [15, '2'], [30, '3']]},
+                      {'metric': {'a': '2'}, 'values': [[0, '5']]}]
+
+
+def test_plan_queries_merges_one_query_per_family():
+    specs = [MetricSpec('qps', 'workload'), MetricSpec('qps', 'workload'),
+             MetricSpec('tcp_recv', 'workload'), MetricSpec('latency', 'gateway', 0.5)]
+    planned = plan_queries(specs, 'ns')
+    assert [family for _, family in planned] == ['counter', 'histogram']
+    counter_sql = planned[0][0]
+    assert counter_sql.count(' or ') == 1
+    assert 'namespace="ns"' in counter_sql
+    assert '"metric_col", "qps"' in counter_sql and '"metric_col", "tcp_recv"' in counter_sql
+
+
+def series(labels, values):
+    return {'metric': labels, 'values': [[100, str(values[0])], [115, str(values[1])]]}
+
+
+def test_scatter_results_builds_columns_in_spec_order():
+    specs = [MetricSpec('qps', 'workload'), MetricSpec('latency', 'gateway', 0.5),
+             MetricSpec('latency', 'workload', 0.9)]
+    planned = plan_queries(specs, 'ns')
+    gateway = {'source_workload': 'istio-ingressgateway', 'metric_col': 'latency'}
+    carts = {'destination_workload': 'carts', 'metric_col': 'latency'}
+    counter = [series({'destination_workload': 'carts', 'metric_col': 'qps'}, [1, 2]),
+               # not a deployment of the namespace
+               series({'destination_workload': 'other', 'metric_col': 'qps'}, [3, 4])]
+    histogram = [series(dict(gateway, le='10'), [5, 5]), series(dict(gateway, le='20'), [10, 10]),
+                 series(dict(gateway, le='+Inf'), [10, 10]),
+                 series(dict(carts, le='10'), [1, 1]), series(dict(carts, le='20'), [10, 10]),
+                 series(dict(carts, le='+Inf'), [10, 10])]
+    df = scatter_results(specs, planned, [counter, histogram], ['carts'])
+    assert list(df.columns) == ['timestamp', 'carts&qps', 'istio-ingressgateway&0.5', 'carts&0.9']
+    assert df['carts&qps'].tolist() == [1.0, 2.0]
+    assert df['istio-ingressgateway&0.5'].tolist() == [10.0, 10.0]
+    assert df['carts&0.9'].tolist() == pytest.approx([10 + 10 * 8 / 9] * 2)
+
+
+def test_scatter_results_without_data():
+    specs = [MetricSpec('qps', 'workload')]
+    assert scatter_results(specs, plan_queries(specs, 'ns'), [[]], ['carts']).empty
@@ -0,0 +1,95 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from baselines.scaler_runtime import JobScheduler, ScalerRuntime
+
+
+class Concurrency:
+    '''
+        a job that sleeps `duration` seconds and records how many of its runs overlap
+    '''
+    def __init__(self, duration):
+        self.duration = duration
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.duration)
+        with self.lock:
+            self.running -= 1
+
+
+def run_scheduler(policy, duration, interval=0.05, period=0.5):
+    job = Concurrency(duration)
+    scheduler = JobScheduler(max_workers=8)
+    scheduler.every(interval, job, name='job', policy=policy, first_delay=0)
+    scheduler.start()
+    time.sleep(period)
+    scheduler.stop(wait=True)
+    return job, scheduler.report()['job']
+
+
+def test_skip_policy_never_overlaps():
+    job, report = run_scheduler('skip', duration=0.2)
+    assert job.max_running == 1
+    assert report['skipped'] > 0
+    assert 1 <= report['runs'] <= 3
+
+
+def test_overlap_policy_runs_concurrently():
+    job, report = run_scheduler('overlap', duration=0.2)
+    assert job.max_running > 1
+    assert report['runs'] > 3
+
+
+def test_failed_job_is_counted():
+    def fail():
+        raise RuntimeError('boom')
+    scheduler = JobScheduler(logger=None)
+    scheduler.log = lambda level, message: None
+    scheduler.every(0.05, fail, first_delay=0)
+    scheduler.start()
+    time.sleep(0.2)
+    scheduler.stop(wait=True)
+    report = scheduler.report()['fail']
+    assert report['failed'] == report['runs'] > 0
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        JobScheduler().every(1, lambda: None, policy='queue')
+
+
+def test_runtime_skips_missed_slots():
+    runtime = ScalerRuntime(interval=0.05)
+    runtime.log = lambda level, message: None
+
+    async def tick():
+        # the second tick overruns by two slots and a half
+        await asyncio.sleep(0.125 if runtime.ticks == 1 else 0)
+        if runtime.ticks == 3:
+            runtime.stop()
+
+    asyncio.run(runtime.run(tick))
+    assert runtime.ticks == 4
+    assert runtime.overruns == 1
+    assert runtime.skipped == 2
+
+
+def test_runtime_stopped_before_run_returns_at_once():
+    runtime = ScalerRuntime(interval=0.05)
+    runtime.stop()
+    calls = []
+
+    async def tick():
+        calls.append(1)
+
+    asyncio.run(asyncio.wait_for(runtime.run(tick), timeout=1))
+    assert calls == []
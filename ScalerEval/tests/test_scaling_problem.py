@@ -0,0 +1,78 @@
+import itertools
+
+import numpy as np
+import pytest
+
+pytest.importorskip('geatpy')
+from baselines.PBScaler.compiled_forest import CompiledForest
+from baselines.PBScaler.scaler import ScalingProblem
+from sklearn.ensemble import RandomForestClassifier
+
+
+class CountingPredictor:
+    '''
+        a random forest that counts the rows it is asked to predict
+    '''
+    def __init__(self, forest):
+        self.forest = forest
+        self.rows = 0
+
+    def predict(self, X):
+        self.rows += len(X)
+        return self.forest.predict(X)
+
+
+@pytest.fixture(scope='module')
+def forest():
+    rng = np.random.default_rng(0)
+    replicas = rng.integers(1, 6, size=(400, 3))
+    workloads = rng.uniform(0, 100, size=(400, 3))
+    labels = (workloads.sum(axis=1) / replicas.sum(axis=1) > 30).astype(int)
+    return RandomForestClassifier(n_estimators=10, random_state=0).fit(np.hstack([replicas, workloads]), labels)
+
+
+def make_problem(forest, **kwargs):
+    # the first and the last services are scaled, the second one keeps its 2 replicas
+    return ScalingProblem(CountingPredictor(forest), mask=[1, 0, 1], replicas=[1, 2, 1], workloads=[80, 50, 60],
+                          lowerBounds=[1, 1], upperBounds=[5, 4], **kwargs)
+
+
+def test_eval_vars_predicts_each_vector_once(forest):
+    problem = make_problem(forest)
+    Vars = np.array([[1, 1], [2, 3], [1, 1], [5, 4], [2, 3]])
+    first = problem.evalVars(Vars)
+    assert first.shape == (5, 1)
+    assert problem.predictor.rows == 3 and problem.evaluated == 3
+    again = problem.evalVars(Vars[::-1])
+    assert problem.predictor.rows == 3
+    assert np.array_equal(again, first[::-1])
+    assert problem.requested == 10
+    np.testing.assert_array_equal(first[:, 0], problem.fitness(Vars))
+
+
+def test_eval_vars_cache_is_bounded(forest):
+    problem = make_problem(forest, cache_size=2)
+    problem.evalVars(np.array([[1, 1], [2, 2], [3, 3]]))
+    assert list(problem.cache) == [(2, 2), (3, 3)]
+    # a hit moves the vector to the end, the oldest one is evicted next
+    problem.evalVars(np.array([[2, 2]]))
+    problem.evalVars(np.array([[4, 4]]))
+    assert list(problem.cache) == [(2, 2), (4, 4)]
+
+
+def test_compiled_forest_gives_the_same_fitness(forest):
+    plain = make_problem(forest)
+    compiled = make_problem(forest, compiled=CompiledForest.from_sklearn(forest))
+    Vars = np.array(list(itertools.product(range(1, 6), range(1, 5))))
+    assert np.array_equal(plain.evalVars(Vars), compiled.evalVars(Vars))
+
+
+def test_enumerate_matches_brute_force(forest):
+    problem = make_problem(forest)
+    assert problem.space_size() == 20
+    best, best_fitness = problem.enumerate()
+    candidates = [np.array(vector) for vector in itertools.product(range(1, 6), range(1, 5))]
+    fitness = [problem.fitness(vector[None, :])[0] for vector in candidates]
+    assert best_fitness == max(fitness)
+    # the first best vector in lexicographic order
+    assert np.array_equal(best, candidates[int(np.argmax(fitness))])
@@ -0,0 +1,154 @@
+import time
+
+from utils.ssh_client import SSHExecutor, summarize_results
+
+
+class FakeChannel:
+    '''
+        replays `chunks` of output, one per `delay` seconds, then exits with `exit_code`
+        (never exits when exit_code is None)
+    '''
+    def __init__(self, chunks, exit_code=0, delay=0.0):
+        self.chunks = list(chunks)
+        self.exit_code = exit_code
+        self.delay = delay
+        self.next_at = time.time() + delay
+        self.closed = False
+
+    def settimeout(self, timeout):
+        pass
+
+    def recv_ready(self):
+        return len(self.chunks) > 0 and time.time() >= self.next_at
+
+    def recv(self, size):
+        self.next_at = time.time() + self.delay
+        return self.chunks.pop(0).encode()
+
+    def exit_status_ready(self):
+        return len(self.chunks) == 0 and self.exit_code is not None
+
+    def recv_exit_status(self):
+        return self.exit_code
+
+    def close(self):
+        self.closed = True
+
+
+class FakeStdout:
+    def __init__(self, channel):
+        self.channel = channel
+
+
+class FakeTransport:
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+
+class FakeClient:
+    '''
+        a paramiko.SSHClient whose commands are answered by `channels` (command -> FakeChannel factory)
+    '''
+    instances = []
+
+    def __init__(self, channels):
+        self.channels = channels
+        self.transport = FakeTransport()
+        self.commands = []
+        self.closed = False
+        FakeClient.instances.append(self)
+
+    def set_missing_host_key_policy(self, policy):
+        pass
+
+    def connect(self, hostname, **kwargs):
+        if hostname == 'unreachable':
+            raise OSError('connection refused')
+
+    def get_transport(self):
+        return self.transport
+
+    def exec_command(self, command, **kwargs):
+        self.commands.append(command)
+        return None, FakeStdout(self.channels[command]()), None
+
+    def close(self):
+        self.closed = True
+        self.transport.active = False
+
+
+SERVER = {'hostname': 'node-1', 'username': 'user', 'password': 'secret'}
+
+
+def make_executor(channels, **kwargs):
+    FakeClient.instances = []
+    output = []
+    executor = SSHExecutor(client_factory=lambda: FakeClient(channels),
+                           on_output=lambda hostname, line: output.append((hostname, line)),
+                           poll_interval=0.01, **kwargs)
+    return executor, output
+
+
+def test_execute_success_streams_lines():
+    executor, output = make_executor({'ls': lambda: FakeChannel(['a\nb', '\nc'])})
+    result = executor.execute(SERVER, 'ls')
+    assert result.exit_code == 0
+    assert result.error is None
+    assert result.output == 'a\nb\nc'
+    assert output == [('node-1', 'a\n'), ('node-1', 'b\n'), ('node-1', 'c')]
+
+
+def test_execute_non_zero_exit_code():
+    executor, _ = make_executor({'false': lambda: FakeChannel(['failed\n'], exit_code=1)})
+    result = executor.execute(SERVER, 'false')
+    assert result.exit_code == 1
+    assert result.output == 'failed\n'
+    assert not summarize_results([result])
+
+
+def test_execute_timeout_on_silent_command():
+    executor, _ = make_executor({'sleep': lambda: FakeChannel([], exit_code=None)})
+    begin = time.time()
+    result = executor.execute(SERVER, 'sleep', timeout=0.2)
+    assert result.exit_code is None
+    assert result.error.startswith('timeout')
+    assert time.time() - begin < 2
+
+
+def test_execute_timeout_on_chatty_command():
+    # a line every 50ms never lets a per-read timeout expire, the deadline still applies
+    executor, _ = make_executor({'tail': lambda: FakeChannel(['tick\n'] * 1000, exit_code=None, delay=0.05)})
+    begin = time.time()
+    result = executor.execute(SERVER, 'tail', timeout=0.3)
+    assert result.exit_code is None
+    assert result.error.startswith('timeout')
+    assert 'tick\n' in result.output
+    assert time.time() - begin < 2
+
+
+def test_connection_is_pooled_and_dead_one_discarded():
+    executor, _ = make_executor({'ls': lambda: FakeChannel(['ok\n']),
+                                 'sleep': lambda: FakeChannel([], exit_code=None)})
+    executor.execute(SERVER, 'ls')
+    executor.execute(SERVER, 'ls')
+    assert len(FakeClient.instances) == 1
+    # the timed out channel is dead, its connection is closed and the next command reconnects
+    executor.execute(SERVER, 'sleep', timeout=0.05)
+    assert FakeClient.instances[0].closed
+    result = executor.execute(SERVER, 'ls')
+    assert result.exit_code == 0
+    assert len(FakeClient.instances) == 2
+    executor.close()
+    assert FakeClient.instances[1].closed
+
+
+def test_execute_all_keeps_server_order_and_reports_errors():
+    executor, _ = make_executor({'ls': lambda: FakeChannel(['ok\n'])})
+    servers = [SERVER, dict(SERVER, hostname='unreachable'), dict(SERVER, hostname='node-2')]
+    results = executor.execute_all(servers, 'ls')
+    assert [result.hostname for result in results] == ['node-1', 'unreachable', 'node-2']
+    assert [result.exit_code for result in results] == [0, None, 0]
+    assert 'connection refused' in results[1].error
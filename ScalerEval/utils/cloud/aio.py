@@ -0,0 +1,27 @@
+import asyncio
+import functools
+
+
+class AsyncClient:
+    '''
+        Awaitable facade of a blocking client (PrometheusClient, KubernetesClient): every method
+        runs in a worker thread through asyncio.to_thread, so a slow query never stalls the
+        event loop that also drives the load injection and the dashboard websockets.
+        Attributes that are not methods are read from the wrapped client as they are, and the
+        methods setting per-context state (set_time_range) run directly in the caller's context,
+        which asyncio.to_thread then carries into the worker thread.
+    '''
+    SYNC_METHODS = {'set_time_range'}
+
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr) or name in self.SYNC_METHODS:
+            return attr
+
+        @functools.wraps(attr)
+        async def call(*args, **kwargs):
+            return await asyncio.to_thread(attr, *args, **kwargs)
+        return call
@@ -0,0 +1,113 @@
+import threading
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from kubernetes.dynamic import DynamicClient
+
+
+# kinds applied before the others, a tier only starts when the previous one is done
+APPLY_TIERS = [
+    ['Namespace', 'CustomResourceDefinition', 'PriorityClass', 'StorageClass'],
+    ['ServiceAccount', 'ConfigMap', 'Secret', 'PersistentVolume', 'PersistentVolumeClaim',
+     'ClusterRole', 'Role', 'LimitRange', 'ResourceQuota'],
+    ['ClusterRoleBinding', 'RoleBinding', 'Service'],
+    # workloads and everything unknown (e.g. istio resources) go to the next tier
+]
+KIND_TIER = {kind: tier for tier, kinds in enumerate(APPLY_TIERS) for kind in kinds}
+DEFAULT_TIER = len(APPLY_TIERS)
+
+
+def load_documents(paths: list):
+    '''
+        parse all yaml documents of the files once, `kind: List` is expanded into its items
+    '''
+    docs = []
+    for path in paths:
+        with open(path, 'r') as file:
+            for doc in yaml.safe_load_all(file):
+                if not doc:
+                    continue
+                if doc.get('kind', '').endswith('List') and 'items' in doc:
+                    docs.extend(item for item in doc['items'] if item)
+                else:
+                    docs.append(doc)
+    return docs
+
+
+def manifest_files(path: str):
+    path = Path(path)
+    if path.is_dir():
+        return sorted(path.glob('**/*.yaml')) + sorted(path.glob('**/*.yml'))
+    return [path]
+
+
+def tier_documents(docs: list):
+    '''
+        group documents by dependency tier, keep the order of the documents within a tier
+    '''
+    tiers = [[] for _ in range(DEFAULT_TIER + 1)]
+    for doc in docs:
+        tiers[KIND_TIER.get(doc.get('kind'), DEFAULT_TIER)].append(doc)
+    return [tier for tier in tiers if len(tier) > 0]
+
+
+class ManifestApplier:
+    '''
+        Bulk apply engine: all documents are parsed once, ordered by dependency tiers and
+        each tier is applied concurrently with server-side apply, so re-runs are idempotent.
+    '''
+    def __init__(self, api_client, max_workers=8, field_manager='scaler-eval'):
+        self.api_client = api_client
+        self.max_workers = max_workers
+        self.field_manager = field_manager
+        self.dynamic_client = None
+        self.lock = threading.Lock()
+
+    def get_dynamic_client(self):
+        # the discovery of the api groups is done once and shared by the workers
+        with self.lock:
+            if self.dynamic_client is None:
+                self.dynamic_client = DynamicClient(self.api_client)
+            return self.dynamic_client
+
+    def apply_paths(self, paths: list, namespace: str):
+        files = [f for path in paths for f in manifest_files(path)]
+        for f in files:
+            print(f"Processing file: {f}")
+        return self.apply(load_documents(files), namespace)
+
+    def apply(self, docs: list, namespace: str):
+        '''
+            apply the documents tier by tier, return the list of (document, exception) that failed
+        '''
+        dynamic_client = self.get_dynamic_client()
+        errors = []
+        for tier in tier_documents(docs):
+            # resolve the resources serially, the discovery cache is not thread safe
+            resources = []
+            for doc in tier:
+                try:
+                    resources.append(dynamic_client.resources.get(api_version=doc['apiVersion'], kind=doc['kind']))
+                except Exception as e:
+                    print(f"Error resolving {doc.get('kind')}: {e}")
+                    errors.append((doc, e))
+                    resources.append(None)
+            jobs = [(resource, doc) for resource, doc in zip(resources, tier) if resource is not None]
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                results = list(pool.map(lambda job: self.apply_one(*job, namespace), jobs))
+            errors.extend(error for error in results if error is not None)
+        return errors
+
+    def apply_one(self, resource, doc: dict, namespace: str):
+        name = doc['metadata']['name']
+        try:
+            if resource.namespaced:
+                doc = dict(doc, metadata=dict(doc['metadata'], namespace=namespace))
+            self.dynamic_client.server_side_apply(resource, body=doc, name=name,
+                                                  namespace=namespace if resource.namespaced else None,
+                                                  field_manager=self.field_manager, force_conflicts=True)
+            print(f"Applied {doc['kind']} {name}")
+            return None
+        except Exception as e:
+            print(f"Error applying {doc['kind']} {name}: {e}")
+            return (doc, e)
@@ -0,0 +1,200 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class RateLimiter:
+    '''
+        token bucket, `rate` tokens per second and at most `burst` tokens saved up
+    '''
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, key, rate: float, burst: int):
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(rate, burst)
+            return cls._shared[key]
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class ScaleDispatcher:
+    '''
+        Scale actions of a namespace are coalesced per deployment (last writer wins within
+        `window` seconds), actions equal to the known replica count are skipped and the
+        remaining patches are sent by a bounded pool, rate limited per namespace.
+        At most one patch per deployment is in flight, so the patches of a deployment keep their order.
+        The known replica counts are read from the deployments (outside the lock, submit never waits
+        for the api server) when the dispatcher starts and again when they are older than `replicas_ttl`
+        seconds, so changes made by others (HPA, reset_env) are picked up.
+        on_result(deployment, replicas, error) is called after every patch, error is None on success.
+        Actions submitted after close() are ignored.
+    '''
+    def __init__(self, executor, namespace: str, window=0.5, max_workers=4, rate=10.0, burst=10, on_result=None,
+                 replicas_ttl=5.0):
+        self.executor = executor
+        self.namespace = namespace
+        self.window = window
+        self.limiter = RateLimiter.shared(namespace, rate, burst)
+        self.on_result = on_result
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.pending = {}  # deployment -> replicas
+        self.in_flight = set()
+        self.replicas = None  # deployment -> spec.replicas, None until read
+        self.replicas_ttl = replicas_ttl
+        self.replicas_time = 0
+        self.acked = None  # patches finished while the replicas are read, None for a failed one
+        self.cond = threading.Condition()
+        self.is_running = False
+        self.closed = False
+        self.thread = None
+        self.stats = {'submitted': 0, 'coalesced': 0, 'skipped': 0, 'succeeded': 0, 'failed': 0, 'rejected': 0}
+
+    def start(self):
+        # called with self.cond held
+        if self.is_running:
+            return
+        self.is_running = True
+        # the counts may have been changed by others since the last run
+        self.replicas = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def refresh_replicas(self):
+        '''
+            read spec.replicas of the deployments, called by the dispatcher thread without the lock
+        '''
+        with self.cond:
+            if self.replicas is not None and time.monotonic() - self.replicas_time < self.replicas_ttl:
+                return
+            self.acked = {}
+        try:
+            objects = self.executor.list_deployment_objects(self.namespace)
+            replicas = {item.metadata.name: item.spec.replicas for item in objects}
+        except Exception as e:
+            print(f'failed to read the replicas of {self.namespace}: {e}')
+            # nothing is skipped until the next read
+            replicas = {}
+        with self.cond:
+            # a patch finished during the list is newer than what the list returned
+            for deployment, count in self.acked.items():
+                if count is None:
+                    replicas.pop(deployment, None)
+                else:
+                    replicas[deployment] = count
+            self.acked = None
+            self.replicas = replicas
+            self.replicas_time = time.monotonic()
+
+    def submit(self, deployment: str, replicas: int):
+        with self.cond:
+            if self.closed:
+                self.stats['rejected'] += 1
+                return False
+            self.stats['submitted'] += 1
+            if deployment in self.pending:
+                self.stats['coalesced'] += 1
+            self.pending[deployment] = replicas
+            self.start()
+            self.cond.notify()
+            return True
+
+    def run(self):
+        try:
+            self.dispatch()
+        finally:
+            # only this thread submits to the pool, it shuts the pool down once it is done
+            self.pool.shutdown(wait=True)
+
+    def dispatch(self):
+        while True:
+            with self.cond:
+                while self.is_running and len(self.pending) == 0:
+                    self.cond.wait()
+                if not self.is_running and len(self.pending) == 0:
+                    return
+            # let the actions of this tick arrive, only the last one of a deployment is sent
+            time.sleep(self.window)
+            self.refresh_replicas()
+            with self.cond:
+                batch = {}
+                for deployment, replicas in list(self.pending.items()):
+                    if deployment in self.in_flight:
+                        continue
+                    del self.pending[deployment]
+                    if self.replicas.get(deployment) == replicas:
+                        self.stats['skipped'] += 1
+                        continue
+                    self.in_flight.add(deployment)
+                    batch[deployment] = replicas
+                if len(batch) == 0 and len(self.pending) > 0:
+                    # only in-flight deployments are pending, wait for one of them to finish
+                    self.cond.wait(self.window)
+            for deployment, replicas in batch.items():
+                self.limiter.acquire()
+                self.pool.submit(self.patch, deployment, replicas)
+
+    def patch(self, deployment: str, replicas: int):
+        error = None
+        try:
+            self.executor.patch_scale(deployment, replicas, self.namespace, async_req=False)
+        except Exception as e:
+            error = e
+        with self.cond:
+            self.in_flight.discard(deployment)
+            if error is None:
+                self.stats['succeeded'] += 1
+                self.replicas[deployment] = replicas
+                if self.acked is not None:
+                    self.acked[deployment] = replicas
+            else:
+                self.stats['failed'] += 1
+                # the real count is unknown now, never skip the next action of this deployment
+                self.replicas.pop(deployment, None)
+                if self.acked is not None:
+                    self.acked[deployment] = None
+            self.cond.notify_all()
+        if self.on_result is not None:
+            self.on_result(deployment, replicas, error)
+
+    def close(self, wait=True):
+        '''
+            send the pending actions and stop, later submits are rejected.
+            With wait=False the actions are sent in the background, join() waits for them
+        '''
+        with self.cond:
+            self.closed = True
+            self.is_running = False
+            thread = self.thread
+            self.cond.notify_all()
+        if thread is None:
+            # never started, no thread will submit to the pool
+            self.pool.shutdown(wait=False)
+        elif wait:
+            thread.join()
+
+    def join(self, timeout=None):
+        '''
+            wait until the dispatcher is closed and its last patch is acknowledged
+        '''
+        if self.thread is not None:
+            self.thread.join(timeout)
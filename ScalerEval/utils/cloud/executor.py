@@ -1,22 +1,204 @@
 import datetime
 import os
 import time
-from kubernetes import client, config, utils
+from concurrent.futures import ThreadPoolExecutor
+from kubernetes import client, config, watch
 import pytz
 from kubernetes.client.rest import ApiException
-import yaml
-from pathlib import Path
+from utils.cloud.applier import ManifestApplier
+from utils.cloud.informer import Informer
+from utils.cloud.resources import ResourceSnapshot
+
+
+# HPAs created by the testbed carry this label, only they are removed by remove_HPAs
+HPA_OWNER_LABEL = ('app.kubernetes.io/managed-by', 'scaler-eval')
+
+
+def deployment_available(deployment):
+    '''
+        the rollout of the deployment is complete and all of its replicas are ready (as kubectl rollout status)
+    '''
+    status = deployment.status
+    replicas = deployment.spec.replicas
+    if (status.observed_generation or 0) < (deployment.metadata.generation or 0):
+        return False
+    return (status.updated_replicas or 0) == replicas and (status.ready_replicas or 0) == replicas \
+        and (status.available_replicas or 0) == replicas and (status.replicas or 0) == replicas
+
+
+def pod_ready(pod, sidecar=False):
+    '''
+        the pod is Ready, with sidecar=True the istio-proxy sidecar should also be injected and ready,
+        either as a regular container or as a native sidecar (an init container that keeps running)
+    '''
+    if pod.metadata.deletion_timestamp is not None:
+        return False
+    conditions = pod.status.conditions or []
+    if not any(c.type == 'Ready' and c.status == 'True' for c in conditions):
+        return False
+    if sidecar:
+        statuses = pod.status.container_statuses or []
+        if any(s.name == 'istio-proxy' and s.ready for s in statuses):
+            return True
+        init_statuses = pod.status.init_container_statuses or []
+        return any(s.name == 'istio-proxy' and (s.ready or s.started) for s in init_statuses)
+    return True
+
+
+def deployment_of(pod):
+    '''
+        name of the deployment owning the pod through its replicaset, None if there is no such owner
+    '''
+    template_hash = (pod.metadata.labels or {}).get('pod-template-hash')
+    for owner in pod.metadata.owner_references or []:
+        if owner.kind == 'ReplicaSet' and template_hash and owner.name.endswith('-' + template_hash):
+            return owner.name[:-len(template_hash) - 1]
+    return None
+
+
+def create_kube_client(kube_config: str, backend='cluster', informer=False, sim_options=None):
+    '''
+        backend: 'cluster' for the cluster of kube_config, 'sim' for the in-process simulator
+    '''
+    if backend == 'sim':
+        from utils.cloud.simulator import SimKubernetesClient
+        return SimKubernetesClient(**(sim_options or {}))
+    return KubernetesClient(kube_config, informer=informer)
 
 
 class KubernetesClient():
     def __init__(self, 
-                 config_url: str):
+                 config_url: str,
+                 informer=False,
+                 informer_sync_timeout=10,
+                 apply_workers=8):
         self.k8s_yaml = config_url
         config.kube_config.load_kube_config(config_file=config_url)
         self.core_api = client.CoreV1Api()  # namespace, pod, service, pv, pvc
         self.apps_api = client.AppsV1Api()  # deployment
         self.scale_api = client.AutoscalingV1Api()
+        self.hpa_api = client.AutoscalingV2Api()
         self.api_client = client.ApiClient()
+        # serve deployment/pod/hpa reads from watch-fed caches instead of LIST calls
+        self.informer = informer
+        self.informer_sync_timeout = informer_sync_timeout
+        self.applier = ManifestApplier(self.api_client, max_workers=apply_workers)
+        self.snapshots = {}
+
+    def get_informer(self, kind: str, namespace: str, force=False):
+        '''
+            the shared informer of a kind in a namespace, None if the informer mode is
+            off (unless forced) or the cache is not synced yet (the caller falls back to a LIST call)
+        '''
+        if not (self.informer or force):
+            return None
+        list_funcs = {
+            'deployment': self.apps_api.list_namespaced_deployment,
+            'pod': self.core_api.list_namespaced_pod,
+            'hpa': self.scale_api.list_namespaced_horizontal_pod_autoscaler
+        }
+        informer = Informer.shared((self.k8s_yaml, kind, namespace), list_funcs[kind], namespace)
+        if not informer.wait_synced(self.informer_sync_timeout):
+            return None
+        return informer
+
+    def list_deployment_objects(self, namespace: str):
+        informer = self.get_informer('deployment', namespace)
+        if informer is not None:
+            return informer.list()
+        return self.apps_api.list_namespaced_deployment(namespace).items
+
+    def list_pod_objects(self, namespace: str):
+        informer = self.get_informer('pod', namespace)
+        if informer is not None:
+            return informer.list()
+        return self.core_api.list_namespaced_pod(namespace).items
+
+    def list_hpa_objects(self, namespace: str):
+        informer = self.get_informer('hpa', namespace)
+        if informer is not None:
+            return informer.list()
+        return self.scale_api.list_namespaced_horizontal_pod_autoscaler(namespace).items
+
+    def stop_informer(self, kind: str, namespace: str):
+        Informer.stop_key((self.k8s_yaml, kind, namespace))
+
+    def stop_informers(self):
+        Informer.stop_shared()
+
+    def watch_until(self, list_func, condition, timeout=600, **kwargs):
+        '''
+            block until condition(objects) holds, objects (name -> object) are kept up to date by a watch
+            return False if the condition still does not hold after timeout (s)
+        '''
+        deadline = time.time() + timeout
+        resource_version = None
+        objects = {}
+        while True:
+            if resource_version is None:
+                ret = list_func(**kwargs)
+                objects = {i.metadata.name: i for i in ret.items}
+                resource_version = ret.metadata.resource_version
+            if condition(objects):
+                return True
+            remaining = int(deadline - time.time())
+            if remaining <= 0:
+                return False
+            watcher = watch.Watch()
+            try:
+                for event in watcher.stream(list_func, resource_version=resource_version,
+                                            timeout_seconds=remaining, **kwargs):
+                    obj = event['object']
+                    if event['type'] == 'DELETED':
+                        objects.pop(obj.metadata.name, None)
+                    elif event['type'] in ('ADDED', 'MODIFIED'):
+                        objects[obj.metadata.name] = obj
+                    resource_version = obj.metadata.resource_version
+                    if condition(objects):
+                        watcher.stop()
+                        return True
+            except ApiException as e:
+                if e.status != 410:
+                    raise
+                resource_version = None  # expired, relist
+
+    def wait_deployments_available(self, namespace: str, deployments: list = None, timeout=600, generations: dict = None):
+        '''
+            wait until the deployments (all but loadgenerator by default) are available,
+            generations: deployment -> generation its rollout should have reached (e.g. of restart_deployment)
+        '''
+        generations = generations or {}
+
+        def condition(objects):
+            names = deployments
+            if names is None:
+                names = [name for name in objects if name != 'loadgenerator']
+                if len(names) == 0:
+                    return False
+            return all(name in objects and deployment_available(objects[name])
+                       and (objects[name].metadata.generation or 0) >= generations.get(name, 0) for name in names)
+        return self.watch_until(self.apps_api.list_namespaced_deployment, condition, timeout, namespace=namespace)
+
+    def wait_pods_ready(self, namespace: str, sidecar=False, timeout=600):
+        '''
+            wait until all running pods of the namespace are ready and no pod is terminating
+        '''
+        def condition(objects):
+            pods = [pod for pod in objects.values() if pod.status.phase not in ('Succeeded', 'Failed')]
+            return len(pods) > 0 and all(pod_ready(pod, sidecar) for pod in pods)
+        return self.watch_until(self.core_api.list_namespaced_pod, condition, timeout, namespace=namespace)
+
+    def wait_namespace_active(self, name: str, timeout=300):
+        def condition(objects):
+            return name in objects and objects[name].status.phase == 'Active'
+        return self.watch_until(self.core_api.list_namespace, condition, timeout,
+                                field_selector=f'metadata.name={name}')
+
+    def wait_namespace_deleted(self, name: str, timeout=600):
+        def condition(objects):
+            return name not in objects
+        return self.watch_until(self.core_api.list_namespace, condition, timeout,
+                                field_selector=f'metadata.name={name}')
 
     ## Sanqine-add
     def list_namespaces(self):
@@ -47,13 +229,12 @@ class KubernetesClient():
 
     ## Sanqine-add
     def get_pod_info(self, namespace: str):
-        pod_list = self.core_api.list_namespaced_pod(namespace=namespace)
         pod_info = {}
 
         # Get China timezone
         china_tz = pytz.timezone("Asia/Shanghai")
 
-        for pod in pod_list.items:
+        for pod in self.list_pod_objects(namespace):
             pod_name = pod.metadata.name
             node_name = pod.spec.node_name 
             node_ip = pod.status.host_ip 
@@ -88,8 +269,7 @@ class KubernetesClient():
 
     ## Sanqine-add
     def list_pods_in_namespace(self, namespace):
-        ret = self.core_api.list_namespaced_pod(namespace)
-        pods = [i.metadata.name for i in ret.items if i.metadata.name != 'loadgenerator']
+        pods = [i.metadata.name for i in self.list_pod_objects(namespace) if i.metadata.name != 'loadgenerator']
         pods.sort()
         return pods
     
@@ -103,66 +283,80 @@ class KubernetesClient():
     
     # Get all microservices
     def get_deployments(self, namespace: str):
-        ret = self.apps_api.list_namespaced_deployment(namespace)
-        deployments = [i.metadata.name for i in ret.items if i.metadata.name != 'loadgenerator']
+        deployments = [i.metadata.name for i in self.list_deployment_objects(namespace) if i.metadata.name != 'loadgenerator']
         deployments.sort()
         return deployments
 
     # Get stateless microservices (exclude redis, mq, mongo, db)
     def get_deployments_without_state(self, namespace: str):
-        ret = self.apps_api.list_namespaced_deployment(namespace)
         def judge_state_deployment(deployment):
             state_deployments = ['redis', 'rabbitmq', 'mongo', 'mysql', 'loadgenerator', 'db', 'gateway', 'cache', 'consul', 'jaeger', 'queue']
             for state_deployment in state_deployments:
                 if state_deployment in deployment:
                     return True
             return False
-        deployments = [i.metadata.name for i in ret.items if not judge_state_deployment(i.metadata.name)]
+        deployments = [i.metadata.name for i in self.list_deployment_objects(namespace) if not judge_state_deployment(i.metadata.name)]
         deployments.sort()
         return deployments
 
 
-    def get_deployments_counts(self, namespace: str):
-        dic = {}
-        pod_ret=self.core_api.list_namespaced_pod(namespace, watch=False)
-        deployments = self.get_deployments(namespace)
-        for deployment in deployments:
-            dic[deployment] = 0
-            for i in pod_ret.items:
-                if i.metadata.name.find(deployment)!=-1:
-                    dic[deployment] = dic[deployment] + 1
-        return dic
+    def get_replica_status(self, namespace: str):
+        '''
+            deployment -> {'ready', 'starting', 'terminating', 'total'} pods, grouped in one pass over
+            one pod list. A pod belongs to the deployment owning its replicaset (owner reference and
+            pod-template-hash), pods without owner fall back to the label selectors of the deployments
+        '''
+        deployments = {item.metadata.name: item for item in self.list_deployment_objects(namespace)
+                       if item.metadata.name != 'loadgenerator'}
+        selectors = [(name, item.spec.selector.match_labels.items())
+                     for name, item in deployments.items()
+                     if item.spec.selector is not None and item.spec.selector.match_labels]
+        status = {name: {'ready': 0, 'starting': 0, 'terminating': 0, 'total': 0} for name in sorted(deployments)}
+        for pod in self.list_pod_objects(namespace):
+            if pod.status.phase in ('Succeeded', 'Failed'):
+                continue
+            owner = deployment_of(pod)
+            if owner not in status:
+                labels = pod.metadata.labels or {}
+                owner = next((name for name, match in selectors
+                              if all(labels.get(k) == v for k, v in match)), None)
+                if owner is None:
+                    continue
+            if pod.metadata.deletion_timestamp is not None:
+                status[owner]['terminating'] += 1
+            elif pod_ready(pod):
+                status[owner]['ready'] += 1
+            else:
+                status[owner]['starting'] += 1
+            status[owner]['total'] += 1
+        return status
 
     def get_deployment_count(self, deployment: str, namespace: str):
         ret_deployment = self.apps_api.read_namespaced_deployment_scale(deployment, namespace)
         return ret_deployment.spec.replicas
     
-    def get_deployments_limit(self, deployments: list, namespace: str):
-        res = {}
-        for deployment in deployments:
-            try:
-                dep_yaml = self.apps_api.read_namespaced_deployment(name=deployment, namespace=namespace)
-            except:
-                continue
-            for container in dep_yaml.spec.template.spec.containers:
-                resources = container.resources
-                if resources.limits is not None:
-                    res[deployment] = (resources.limits.get('cpu', None), resources.limits.get('memory', None))
-                else:
-                    res[deployment] = (None, None)
-        return res
+    def get_resource_snapshot(self, namespace: str, watch=False):
+        '''
+            parsed limits/requests per container and per pod of the deployments, see ResourceSnapshot.
+            The snapshot of a namespace is shared, it starts watching once a caller asks for watch=True
+        '''
+        snapshot = self.snapshots.get(namespace)
+        if snapshot is None:
+            snapshot = self.snapshots.setdefault(namespace, ResourceSnapshot(self, namespace, watch=watch))
+        if watch and not snapshot.watch:
+            # the parsed deployments stay valid, they are keyed by resourceVersion
+            snapshot.watch = True
+        return snapshot
 
     # Determine the status of all service (available?)
     def all_avaliable(self, deployments: list, namespace: str):
-        ret = self.apps_api.list_namespaced_deployment(namespace)
-        for item in ret.items:
+        for item in self.list_deployment_objects(namespace):
             if item.metadata.name in deployments and item.status.ready_replicas != item.spec.replicas:
                 return False
         return True
     
     def svc_avaliable(self, svc: str, namespace: str):
-        ret = self.apps_api.list_namespaced_deployment(namespace)
-        for item in ret.items:
+        for item in self.list_deployment_objects(namespace):
             if item.metadata.name == svc:
                 if item.status.ready_replicas == item.spec.replicas:
                     return True
@@ -190,143 +384,152 @@ class KubernetesClient():
 
 
     def create_from_yaml(self, deploy_path: str, namespace: str):
-        path = Path(deploy_path)
-        
-        if path.is_dir():
-            for yaml_file in path.glob("**/*.yaml"):
-                print(f"Processing file: {yaml_file}")
-                utils.create_from_yaml(
-                    k8s_client=self.api_client,
-                    yaml_file=str(yaml_file),  
-                    namespace=namespace
-                )
-            for yaml_file in path.glob("**/*.yml"): 
-                print(f"Processing file: {yaml_file}")
-                utils.create_from_yaml(
-                    k8s_client=self.api_client,
-                    yaml_file=str(yaml_file), 
-                    namespace=namespace
-                )
-        else:
-            print(f"Processing single file: {deploy_path}")
-            utils.create_from_yaml(
-                k8s_client=self.api_client,
-                yaml_file=deploy_path,
-                namespace=namespace
-            )
+        '''
+            apply all manifests of a file or a directory, see ManifestApplier
+        '''
+        errors = self.applier.apply_paths([deploy_path], namespace)
+        if len(errors) > 0:
+            raise Exception(f"failed to apply {len(errors)} resources from {deploy_path}: "
+                            + ', '.join(f"{doc.get('kind')}/{doc.get('metadata', {}).get('name')}" for doc, _ in errors))
+
+    def apply_yaml(self, yaml_path: str, namespace: str):
+        self.create_from_yaml(yaml_path, namespace)
 
-        
-        
     def create_istio_resource(self, yaml_pth: str, namespace: str):
-        with open(yaml_pth, 'r') as file:
-            resources = yaml.safe_load_all(file)
-            for resource in resources:
-                custom_objects_api = client.CustomObjectsApi()
-                group = resource['apiVersion'].split('/')[0]
-                version = resource['apiVersion'].split('/')[-1]
-                plural = resource['kind'].lower() + 's'
-                
-                try:
-                    custom_objects_api.create_namespaced_custom_object(
-                        group=group,
-                        version=version,
-                        namespace=namespace,
-                        plural=plural,
-                        body=resource
-                    )
-                    print(f"Created {resource['kind']} {resource['metadata']['name']}")
-                except client.exceptions.ApiException as e:
-                    print(f"Error creating {resource['kind']}: {e}")
-        
-    def create_namespace(self, name: str):
+        # errors are reported per resource, the others are still applied
+        self.applier.apply_paths([yaml_pth], namespace)
+
+    def create_namespace(self, name: str, timeout=300):
         new_namespace = client.V1Namespace(
             metadata=client.V1ObjectMeta(
                 name=name
             )
         )
         self.core_api.create_namespace(new_namespace)
-        while True:
-            try:
-                self.core_api.read_namespace(name=name)
+        print(f"creating namespace {name}...")
+        try:
+            if self.wait_namespace_active(name, timeout):
                 return True
-            except ApiException as e:
-                if e.status == 404:
-                    print(f"creating namespace {name}...")
-                    time.sleep(5)
-                else:
-                    print(f"Unexpected ApiException: {e}")
-                    return False
+            print(f"namespace {name} is not active after {timeout}s")
+        except ApiException as e:
+            print(f"Unexpected ApiException: {e}")
+        return False
 
-    def delete_namespace(self, name: str):
-        self.core_api.delete_namespace(name=name)
-        while True:
-            try:
-                self.core_api.read_namespace(name=name)
-                print(f'deleting namespace {name}...')
-                time.sleep(5)
-            except ApiException as e:
-                if e.status == 404:
-                    print(f"namespace {name} was deleted.")
-                    return True
-                else:
-                    print(f"Unexpected ApiException: {e}")
-                    return False
+    def delete_namespace(self, name: str, timeout=600):
+        try:
+            self.core_api.delete_namespace(name=name)
+        except ApiException as e:
+            if e.status == 404:
+                print(f"namespace {name} does not exist.")
+                return True
+            raise
+        print(f'deleting namespace {name}...')
+        try:
+            if self.wait_namespace_deleted(name, timeout):
+                print(f"namespace {name} was deleted.")
+                return True
+            print(f"namespace {name} is still terminating after {timeout}s")
+        except ApiException as e:
+            print(f"Unexpected ApiException: {e}")
+        return False
         
 
     def restart_deployment(self, name: str, namespace: str):
+        '''
+            roll the pods of the deployment (as kubectl rollout restart), return the generation
+            of the patched deployment: the restart is rolled out once status.observedGeneration reaches it
+        '''
         # update `spec.template.metadata` section
-        # to add `kubectl.kubernetes.io/restartedAt` annotation
-        deployment = self.apps_api.read_namespaced_deployment(name=name, namespace=namespace)
-        deployment.spec.template.metadata.annotations = {
-            "kubectl.kubernetes.io/restartedAt": datetime.datetime.now(tz=pytz.UTC)
-            .isoformat()
-        }
+        # to add `kubectl.kubernetes.io/restartedAt` annotation, the other annotations are kept
+        body = {'spec': {'template': {'metadata': {'annotations': {
+            "kubectl.kubernetes.io/restartedAt": datetime.datetime.now(tz=pytz.UTC).isoformat()
+        }}}}}
 
-        # patch the deployment
-        self.apps_api.patch_namespaced_deployment(
-            name=name, namespace=namespace, body=deployment, async_req=True
-        )
+        # patch the deployment, synchronously so that a wait started afterwards sees the new generation
+        deployment = self.apps_api.patch_namespaced_deployment(name=name, namespace=namespace, body=body)
+        return deployment.metadata.generation
 
-    def create_default_HPA(self, 
-                           namespace: str,
-                           deployment: str,
-                           min_replicas: int,
-                           max_replicas: int,
-                           cpu_th: float):
-        hpa_spec = client.V1HorizontalPodAutoscaler(
-            metadata=client.V1ObjectMeta(name=deployment),
-            spec=client.V1HorizontalPodAutoscalerSpec(
-                scale_target_ref=client.V1CrossVersionObjectReference(
+    def build_HPA(self,
+                  deployment: str,
+                  min_replicas: int,
+                  max_replicas: int,
+                  cpu_th: float,
+                  mem_th: float = None,
+                  scale_up_window: int = None,
+                  scale_down_window: int = None):
+        '''
+            autoscaling/v2 HPA of a deployment, mem_th adds a memory utilization target,
+            the windows (s) set the stabilization of the scaling behavior (None: kubernetes default)
+        '''
+        def utilization(resource, target):
+            return client.V2MetricSpec(
+                type='Resource',
+                resource=client.V2ResourceMetricSource(
+                    name=resource,
+                    target=client.V2MetricTarget(type='Utilization', average_utilization=int(target))
+                )
+            )
+        metrics = [utilization('cpu', cpu_th)]
+        if mem_th is not None:
+            metrics.append(utilization('memory', mem_th))
+        behavior = None
+        if scale_up_window is not None or scale_down_window is not None:
+            behavior = client.V2HorizontalPodAutoscalerBehavior(
+                scale_up=None if scale_up_window is None else client.V2HPAScalingRules(
+                    stabilization_window_seconds=scale_up_window),
+                scale_down=None if scale_down_window is None else client.V2HPAScalingRules(
+                    stabilization_window_seconds=scale_down_window)
+            )
+        return client.V2HorizontalPodAutoscaler(
+            api_version='autoscaling/v2',
+            kind='HorizontalPodAutoscaler',
+            metadata=client.V1ObjectMeta(name=deployment, labels={HPA_OWNER_LABEL[0]: HPA_OWNER_LABEL[1]}),
+            spec=client.V2HorizontalPodAutoscalerSpec(
+                scale_target_ref=client.V2CrossVersionObjectReference(
                     kind="Deployment",
                     name=deployment,
                     api_version="apps/v1"
                 ),
-                min_replicas=min_replicas,  
+                min_replicas=min_replicas,
                 max_replicas=max_replicas,
-                target_cpu_utilization_percentage=cpu_th
+                metrics=metrics,
+                behavior=behavior
             )
         )
 
-        # create horizontal scaler
+    def create_HPAs(self, namespace: str, hpas: list, max_workers=8):
+        '''
+            create the HPAs (see build_HPA) concurrently, existing ones are replaced,
+            return the names of the HPAs that failed
+        '''
+        def create(hpa):
+            name = hpa.metadata.name
+            try:
+                try:
+                    self.hpa_api.create_namespaced_horizontal_pod_autoscaler(namespace=namespace, body=hpa)
+                except ApiException as e:
+                    if e.status != 409:
+                        raise
+                    self.hpa_api.replace_namespaced_horizontal_pod_autoscaler(name=name, namespace=namespace, body=hpa)
+                print(f"HPA for {name} created.")
+                return None
+            except ApiException as e:
+                print(f"Exception when creating HPA {name}: {e.status} {e.reason}")
+                return name
+        if len(hpas) == 0:
+            return []
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return [name for name in pool.map(create, hpas) if name is not None]
+
+    def remove_HPAs(self, namespace: str):
+        '''
+            delete the HPAs created by the testbed with one request, other HPAs are kept
+        '''
         try:
-            api_response = self.scale_api.create_namespaced_horizontal_pod_autoscaler(
+            self.hpa_api.delete_collection_namespaced_horizontal_pod_autoscaler(
                 namespace=namespace,
-                body=hpa_spec
+                label_selector=f'{HPA_OWNER_LABEL[0]}={HPA_OWNER_LABEL[1]}'
             )
-            print(f"HPA for {deployment} created. Status: {api_response.status}")
-        except client.ApiException as e:
-            print(f"Exception when calling AutoscalingV1Api->create_namespaced_horizontal_pod_autoscaler: {e}")
-
-    def remove_default_HPA(self, namespace: str):
-        try:
-            hpa_list = self.scale_api.list_namespaced_horizontal_pod_autoscaler(namespace)
-            for hpa in hpa_list.items:
-                print(f"Deleting HPA: {hpa.metadata.name}")
-                self.scale_api.delete_namespaced_horizontal_pod_autoscaler(
-                    name=hpa.metadata.name,
-                    namespace=namespace,
-                    body=client.V1DeleteOptions()
-                )
-            print("All HPAs have been deleted.")
-        except client.exceptions.ApiException as e:
-            print(f"Exception when calling AutoscalingV1Api->list_namespaced_horizontal_pod_autoscaler: {e}")
\ No newline at end of file
+            print(f"HPAs of {namespace} have been deleted.")
+        except ApiException as e:
+            print(f"Exception when calling AutoscalingV2Api->delete_collection_namespaced_horizontal_pod_autoscaler: {e}")
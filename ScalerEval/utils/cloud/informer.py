@@ -0,0 +1,122 @@
+import random
+import threading
+import time
+from kubernetes import watch
+from kubernetes.client.rest import ApiException
+
+
+class Informer:
+    '''
+        Local cache of one kind of object (deployments, pods, hpas...) in a namespace.
+        The cache is filled by one LIST and kept fresh by a WATCH resumed from the last
+        seen resourceVersion, so reads never reach the api server. When the
+        resourceVersion is too old (410 Gone) the cache is rebuilt by a new LIST.
+    '''
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, list_func, namespace: str, watch_timeout=300, backoff=1.0):
+        self.list_func = list_func  # e.g. AppsV1Api().list_namespaced_deployment
+        self.namespace = namespace
+        self.watch_timeout = watch_timeout
+        self.backoff = backoff
+        self.objects = {}
+        self.resource_version = None
+        self.lock = threading.Lock()
+        self.synced = threading.Event()
+        self.is_running = False
+        self.watcher = None
+        self.thread = None
+
+    @classmethod
+    def shared(cls, key, list_func, namespace: str):
+        '''
+            one informer per key, reused by every client created in this process
+        '''
+        with cls._shared_lock:
+            informer = cls._shared.get(key)
+            if informer is None:
+                informer = cls(list_func, namespace)
+                informer.start()
+                cls._shared[key] = informer
+            return informer
+
+    @classmethod
+    def stop_key(cls, key):
+        '''
+            stop and forget the shared informer of key, if any
+        '''
+        with cls._shared_lock:
+            informer = cls._shared.pop(key, None)
+        if informer is not None:
+            informer.stop()
+
+    @classmethod
+    def stop_shared(cls):
+        with cls._shared_lock:
+            for informer in cls._shared.values():
+                informer.stop()
+            cls._shared.clear()
+
+    def start(self):
+        if self.is_running:
+            return
+        self.is_running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.is_running = False
+        if self.watcher is not None:
+            self.watcher.stop()
+
+    def wait_synced(self, timeout=None):
+        return self.synced.wait(timeout)
+
+    def relist(self):
+        ret = self.list_func(self.namespace)
+        with self.lock:
+            self.objects = {item.metadata.name: item for item in ret.items}
+            self.resource_version = ret.metadata.resource_version
+        self.synced.set()
+
+    def run(self):
+        while self.is_running:
+            try:
+                if self.resource_version is None:
+                    self.relist()
+                self.watcher = watch.Watch()
+                for event in self.watcher.stream(self.list_func, self.namespace,
+                                                 resource_version=self.resource_version,
+                                                 timeout_seconds=self.watch_timeout,
+                                                 allow_watch_bookmarks=True):
+                    self.handle(event['type'], event['object'])
+                    if not self.is_running:
+                        break
+            except ApiException as e:
+                if e.status == 410:
+                    # resourceVersion expired, the events in between are lost
+                    self.resource_version = None
+                    continue
+                print(f'informer of {self.namespace} failed: {e.status} {e.reason}, rewatch...')
+                time.sleep(self.backoff * (1 + random.random()))
+            except Exception as e:
+                print(f'informer of {self.namespace} failed: {e}, rewatch...')
+                time.sleep(self.backoff * (1 + random.random()))
+
+    def handle(self, event_type: str, obj):
+        with self.lock:
+            if event_type in ('ADDED', 'MODIFIED'):
+                self.objects[obj.metadata.name] = obj
+            elif event_type == 'DELETED':
+                self.objects.pop(obj.metadata.name, None)
+            # BOOKMARK events only move the resourceVersion forward
+            self.resource_version = obj.metadata.resource_version
+
+    def list(self):
+        with self.lock:
+            return list(self.objects.values())
+
+    def get(self, name: str):
+        with self.lock:
+            return self.objects.get(name)
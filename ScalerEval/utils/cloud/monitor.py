@@ -1,147 +1,574 @@
+import contextvars
+import random
 import re
-from copy import deepcopy
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache, reduce
 
+import numpy as np
 import requests
 import pandas as pd
+from requests.adapters import HTTPAdapter
+
+# suffix appended by kubernetes to the owner name, e.g. the replicaset hash of `carts-5d9f8c7b4`
+REPLICASET_HASH_PATTERN = re.compile(r'-(?:[a-fA-F0-9]{1,})$')
+# the replicaset hash and the instance identifier of a pod, e.g. `-5d9f8c7b4-x2k8p` of `carts-5d9f8c7b4-x2k8p`
+POD_SUFFIX_PATTERN = re.compile(r'(?:-[a-zA-Z0-9]+){1,2}$')
+
+
+@lru_cache(maxsize=8192)
+def strip_pod_suffix(pod_name):
+    return POD_SUFFIX_PATTERN.sub('', pod_name, count=1)
+
+
+def decode_results(groups: list, fill_value=0.0):
+    '''
+        decode prometheus matrix/vector results into one DataFrame in a single step
+        groups: [(results, name_of), ...], name_of maps the labels of a series to its column name
+                (None drops the series, a repeated name overwrites the previous series)
+        all series are aligned on the union of their timestamps, missing samples are filled with fill_value
+    '''
+    columns = {}
+    for results, name_of in groups:
+        for result in results:
+            name = name_of(result['metric'])
+            if name is None:
+                continue
+            samples = np.array(result['values'] if 'values' in result else [result['value']], dtype=object)
+            columns[name] = (samples[:, 0].astype(np.float64), samples[:, 1].astype(np.float64))
+    if len(columns) == 0:
+        return pd.DataFrame()
+
+    stamps = [timestamp for timestamp, _ in columns.values()]
+    timestamp = stamps[0]
+    if not all(len(other) == len(timestamp) and np.array_equal(other, timestamp) for other in stamps[1:]):
+        timestamp = np.unique(np.concatenate(stamps))
+
+    data = np.full((len(timestamp), len(columns)), np.nan)
+    for i, (stamp, values) in enumerate(columns.values()):
+        if len(stamp) == len(timestamp):
+            data[:, i] = values
+        else:
+            data[np.searchsorted(timestamp, stamp), i] = values
+    if fill_value is not None:
+        data[np.isnan(data)] = fill_value
+
+    df = pd.DataFrame(data, columns=list(columns.keys()))
+    df.insert(0, 'timestamp', pd.Series(timestamp).astype('datetime64[s]'))
+    return df
+
+
+def merge_chunk_results(chunk_results: list):
+    '''
+        stitch the results of consecutive range queries, series are matched by their labels
+        and samples on the chunk boundaries are de-duplicated
+    '''
+    series = {}
+    for results in chunk_results:
+        for result in results:
+            key = tuple(sorted(result['metric'].items()))
+            if key not in series:
+                series[key] = {'metric': result['metric'], 'values': {}}
+            for timestamp, value in result['values']:
+                series[key]['values'].setdefault(timestamp, value)
+    return [{'metric': s['metric'], 'values': sorted([timestamp, value] for timestamp, value in s['values'].items())}
+            for s in series.values()]
+
+
+def histogram_quantile(qs, les, buckets):
+    '''
+        compute several quantiles from cumulative histogram buckets, following prometheus' histogram_quantile
+        qs: quantiles, les: sorted upper bounds of the buckets, buckets: (n_samples, n_buckets) cumulative counts
+        return (n_samples, len(qs)), NaN where prometheus would return NaN
+    '''
+    qs = np.asarray(qs, dtype=np.float64)
+    les = np.asarray(les, dtype=np.float64)
+    buckets = np.nan_to_num(np.asarray(buckets, dtype=np.float64), nan=0.0)
+    n_samples, n_buckets = buckets.shape
+    result = np.full((n_samples, len(qs)), np.nan)
+    if n_buckets < 2 or not np.isposinf(les[-1]):
+        return result
+
+    # the counts of buckets must be monotonic, prometheus fixes small inconsistencies in the same way
+    buckets = np.maximum.accumulate(buckets, axis=1)
+    observations = buckets[:, -1]
+    rank = qs[None, :] * observations[:, None]
+    # index of the first bucket whose count >= rank
+    b = np.minimum((buckets[:, None, :] < rank[:, :, None]).sum(axis=2), n_buckets - 1)
+
+    rows = np.arange(n_samples)[:, None]
+    bucket_end = les[b]
+    bucket_start = np.where(b > 0, les[np.maximum(b - 1, 0)], 0.0)
+    prev_count = np.where(b > 0, buckets[rows, np.maximum(b - 1, 0)], 0.0)
+    count = buckets[rows, b] - prev_count
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = bucket_start + (bucket_end - bucket_start) * ((rank - prev_count) / count)
+    # the quantile falls into the +Inf bucket: return the upper bound of the second highest bucket
+    result = np.where(b == n_buckets - 1, les[-2], result)
+    # the lowest bucket has a non-positive upper bound: return it
+    result = np.where((b == 0) & (les[0] <= 0), les[0], result)
+    result = np.where(observations[:, None] > 0, result, np.nan)
+    result = np.where(qs[None, :] < 0, -np.inf, result)
+    result = np.where(qs[None, :] > 1, np.inf, result)
+    return np.where(np.isnan(qs)[None, :], np.nan, result)
+
+
+# metric -> (family, PromQL template with (selector, group label), {aggregation: selector})
+# family `counter` results are used as-is, family `histogram` results are buckets turned into quantiles
+PLANNER_METRICS = {
+    'qps': ('counter', 'sum(rate(istio_requests_total{%s}[1m])) by (%s)',
+            {'workload': 'reporter="destination",namespace="%(namespace)s"',
+             'gateway': 'reporter="source",source_workload="istio-ingressgateway"'}),
+    'tcp_recv': ('counter', 'sum(rate(istio_tcp_received_bytes_total{%s}[1m])) by (%s)/1024/1024',
+                 {'workload': 'reporter="destination",namespace="%(namespace)s"'}),
+    'tcp_sent': ('counter', 'sum(rate(istio_tcp_sent_bytes_total{%s}[1m])) by (%s)/1024/1024',
+                 {'workload': 'reporter="destination",namespace="%(namespace)s"'}),
+    'tcp_conn': ('counter', 'sum(rate(istio_tcp_connections_opened_total{%s}[1m])) by (%s)',
+                 {'workload': 'reporter="destination",namespace="%(namespace)s"'}),
+    'latency': ('histogram', 'sum(irate(istio_request_duration_milliseconds_bucket{%s}[1m])) by (%s,le)',
+                {'workload': 'reporter="destination", destination_workload_namespace="%(namespace)s"',
+                 'gateway': 'reporter="source",source_workload="istio-ingressgateway"'}),
+}
+# aggregation -> label of the workload
+PLANNER_GROUP_LABELS = {'workload': 'destination_workload', 'gateway': 'source_workload'}
+# label added by label_replace to tell the merged series apart
+PLANNER_TAG = 'metric_col'
+
+# a column (or a set of columns) requested from the planner,
+# e.g. MetricSpec('qps', 'workload') -> `svc&qps`, MetricSpec('latency', 'gateway', 0.9) -> `istio-ingressgateway&0.9`
+MetricSpec = namedtuple('MetricSpec', ['metric', 'aggregation', 'quantile'], defaults=[None])
+
+
+def plan_queries(specs: list, namespace: str):
+    '''
+        build the minimal set of PromQL queries for specs: one query per family that merges
+        every (metric, aggregation) with `or`, tagged by label_replace
+        return [(prom_sql, family), ...]
+    '''
+    terms = {}
+    for metric, aggregation in dict.fromkeys((spec.metric, spec.aggregation) for spec in specs):
+        family, template, selectors = PLANNER_METRICS[metric]
+        inner = template % (selectors[aggregation] % {'namespace': namespace}, PLANNER_GROUP_LABELS[aggregation])
+        terms.setdefault(family, []).append(f'label_replace({inner}, "{PLANNER_TAG}", "{metric}", "", "")')
+    return [(' or '.join(family_terms), family) for family, family_terms in terms.items()]
+
+
+def scatter_results(specs: list, planned: list, responses: list, deployments: list):
+    '''
+        scatter the results of the planned queries back into `svc&metric` columns in the order of specs
+    '''
+    requested = {(spec.metric, spec.aggregation) for spec in specs}
+
+    def name_of(metric, with_le=False):
+        for aggregation, label in PLANNER_GROUP_LABELS.items():
+            if label in metric:
+                break
+        else:
+            return None
+        name = metric[label]
+        if (metric.get(PLANNER_TAG), aggregation) not in requested:
+            return None
+        if aggregation == 'workload' and name not in deployments:
+            return None
+        if aggregation == 'gateway' and name != 'istio-ingressgateway':
+            return None
+        return name + '&' + (metric['le'] if with_le else metric[PLANNER_TAG])
+
+    dfs, columns = [], {}
+    for (prom_sql, family), response in zip(planned, responses):
+        if family == 'counter':
+            df = decode_results([(response, name_of)])
+        else:
+            df = quantiles_from_buckets(decode_results([(response, lambda metric: name_of(metric, with_le=True))], fill_value=None),
+                                        sorted({spec.quantile for spec in specs if spec.metric == 'latency'}))
+        if df.empty:
+            continue
+        dfs.append(df)
+        for col in df.columns[1:]:
+            columns[col] = True
+    if len(dfs) == 0:
+        return pd.DataFrame()
+    df = reduce(lambda left, right: pd.merge(left, right, on='timestamp'), dfs)
+
+    # order the columns by specs, then by the order of series
+    ordered = ['timestamp']
+    for spec in specs:
+        suffix = '&' + (str(spec.quantile) if spec.metric == 'latency' else spec.metric)
+        for col in columns:
+            name = col[:-len(suffix)]
+            if col.endswith(suffix) and ((name == 'istio-ingressgateway') == (spec.aggregation == 'gateway')) and col not in ordered:
+                ordered.append(col)
+    return df[ordered]
+
+
+def quantiles_from_buckets(bucket_df: pd.DataFrame, ps: list):
+    '''
+        bucket_df: columns `name&le` of cumulative bucket rates, return columns `name&p`
+    '''
+    if bucket_df.empty:
+        return pd.DataFrame()
+    # name -> {upper bound: [columns]}, buckets with the same upper bound are merged
+    histograms = {}
+    for col in bucket_df.columns[1:]:
+        name, le = col.rsplit('&', 1)
+        histograms.setdefault(name, {}).setdefault(float(le), []).append(col)
+    quantiles = {}
+    for name, histogram in histograms.items():
+        les = sorted(histogram.keys())
+        buckets = np.stack([np.nansum(bucket_df[histogram[le]].to_numpy(dtype=np.float64), axis=1) for le in les], axis=1)
+        quantiles[name] = histogram_quantile(ps, les, buckets)
+
+    latency_df = pd.DataFrame({name + '&' + str(p): values[:, i] for i, p in enumerate(ps) for name, values in quantiles.items()})
+    latency_df = latency_df.fillna(0.0)
+    latency_df.insert(0, 'timestamp', bucket_df['timestamp'])
+    return latency_df
+
+
+class PrometheusQueryError(Exception):
+    pass
+
+
+class PrometheusTransport:
+    '''
+        HTTP transport for prometheus: pooled keep-alive sessions, per-query timeout,
+        jittered retries on 5xx/timeouts, gzip negotiation and per-query latency counters
+    '''
+    def __init__(self,
+                 timeout: float = 30,
+                 retries: int = 3,
+                 backoff: float = 0.5,
+                 pool_size: int = 8):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Accept-Encoding': 'gzip'})
+        # prom_sql -> {'count', 'failures', 'retries', 'total_latency', 'max_latency'}
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+    def get(self, url: str, params: dict, timeout: float = None):
+        '''
+            send the query and return the `data` field of the prometheus response
+        '''
+        prom_sql = params.get('query')
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                self.record(prom_sql, retried=True)
+                time.sleep(self.backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+            st = time.time()
+            try:
+                response = self.session.get(url, params=params, timeout=timeout or self.timeout)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                error = e
+                continue
+            if response.status_code >= 500:
+                error = PrometheusQueryError(f'prometheus returned {response.status_code}: {response.text[:200]}')
+                continue
+            self.record(prom_sql, latency=time.time() - st)
+            try:
+                body = response.json()
+            except ValueError:
+                raise PrometheusQueryError(f'prometheus returned {response.status_code} with a non-json body')
+            if response.status_code != 200 or body.get('status') != 'success':
+                raise PrometheusQueryError(f"query `{prom_sql}` failed ({response.status_code}): {body.get('error')}")
+            return body['data']
+        self.record(prom_sql, failed=True)
+        raise PrometheusQueryError(f'query `{prom_sql}` failed after {self.retries + 1} attempts: {error}')
+
+    def record(self, prom_sql, latency=None, retried=False, failed=False):
+        with self.stats_lock:
+            stat = self.stats.setdefault(prom_sql, {'count': 0, 'failures': 0, 'retries': 0,
+                                                    'total_latency': 0.0, 'max_latency': 0.0})
+            if latency is not None:
+                stat['count'] += 1
+                stat['total_latency'] += latency
+                stat['max_latency'] = max(stat['max_latency'], latency)
+            if retried:
+                stat['retries'] += 1
+            if failed:
+                stat['failures'] += 1
+
+    def get_latency_stats(self):
+        '''
+            return a DataFrame of per-query latency counters (seconds)
+        '''
+        with self.stats_lock:
+            stats_df = pd.DataFrame.from_dict(self.stats, orient='index')
+        if len(stats_df) > 0:
+            stats_df['mean_latency'] = stats_df['total_latency'] / stats_df['count'].where(stats_df['count'] > 0)
+        return stats_df
+
+    def close(self):
+        self.session.close()
+
+
+class PromQueryCache:
+    '''
+        TTL cache of prometheus results keyed by (prom_sql, time bucket) with LRU eviction,
+        concurrent identical queries are collapsed into one in-flight request
+    '''
+    shared_caches = {}
+    shared_lock = threading.Lock()
+
+    def __init__(self, ttl: float = 2, max_entries: int = 256):
+        if ttl <= 0:
+            raise ValueError(f'the ttl of PromQueryCache should be > 0, got {ttl}')
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> (expire time, result)
+        self.in_flight = {} # key -> Future
+        self.lock = threading.Lock()
+        self.hits, self.misses, self.coalesced = 0, 0, 0
+
+    @classmethod
+    def shared(cls, name: str, ttl: float = 2, max_entries: int = 256):
+        '''
+            get the cache shared by all clients of the same prometheus (e.g. several control loops)
+        '''
+        with cls.shared_lock:
+            if name not in cls.shared_caches:
+                cls.shared_caches[name] = cls(ttl, max_entries)
+            return cls.shared_caches[name]
+
+    def make_key(self, prom_sql, range, start=None, end=None, step=None):
+        if range:
+            return (prom_sql, int(end // self.ttl), end - start, step)
+        return (prom_sql, int(time.time() // self.ttl))
+
+    def get_or_fetch(self, key, fetch):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            future = self.in_flight.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self.in_flight[key] = future
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not is_owner:
+            return future.result()
+
+        try:
+            result = fetch()
+        except Exception as e:
+            with self.lock:
+                self.in_flight.pop(key, None)
+            future.set_exception(e)
+            raise
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.in_flight.pop(key, None)
+        future.set_result(result)
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
 
 class PrometheusClient:
     def __init__(self, 
-                 base_url: str):
+                 base_url: str,
+                 max_concurrency: int = 8,
+                 transport: PrometheusTransport = None,
+                 max_points: int = 11000,
+                 cache: PromQueryCache = None):
         self.prom_no_range_url = f'{base_url}/api/v1/query'
         self.prom_range_url = f'{base_url}/api/v1/query_range'
+        # limit the number of in-flight queries when they are sent concurrently
+        self.max_concurrency = max_concurrency
+        self.query_slots = threading.BoundedSemaphore(max_concurrency)
+        self.transport = transport if transport is not None else PrometheusTransport(pool_size=max_concurrency)
+        # prometheus rejects range queries with more than 11,000 points, longer ranges are split into chunks
+        self.max_points = max_points
+        # optional cache in front of prometheus, results must be treated as read-only
+        self.cache = cache
+        # the time range is per thread (and per asyncio task), jobs of a scaler running at the same time
+        # query their own windows
+        self.time_range_var = contextvars.ContextVar(f'prom_time_range_{id(self)}', default=(None, None, None))
 
 
     def set_time_range(self, start: int, end: int, step: int):
-        self.start = start
-        self.end = end
-        self.step = step
+        self.time_range_var.set((start, end, step))
+
+    @property
+    def time_range(self):
+        return self.time_range_var.get()
+
+    @property
+    def start(self):
+        return self.time_range[0]
+
+    @property
+    def end(self):
+        return self.time_range[1]
+
+    @property
+    def step(self):
+        return self.time_range[2]
+
+    def bind_time_range(self, func):
+        '''
+            func running with the time range of the calling thread, for work handed to a pool
+        '''
+        time_range = self.time_range
+        def bound(*args, **kwargs):
+            self.time_range_var.set(time_range)
+            return func(*args, **kwargs)
+        return bound
 
     def execute_prom(self, prom_sql, range=True):
         '''
             execute prom_sql
         '''
+        if self.cache is None:
+            return self.fetch_prom(prom_sql, range)
         if range:
-            response = requests.get(self.prom_range_url,
-                                    params={'query': prom_sql,
-                                            'start': self.start,
-                                            'end': self.end,
-                                            'step': self.step})
-        else:
-            response = requests.get(self.prom_no_range_url,
-                                    params={'query': prom_sql})
-        return response.json()['data']['result']
+            start, end, step = self.start, self.end, self.step
+            key = self.cache.make_key(prom_sql, range, start, end, step)
+            return self.cache.get_or_fetch(key, lambda: self.fetch_prom(prom_sql, range, (start, end, step)))
+        return self.cache.get_or_fetch(self.cache.make_key(prom_sql, range), lambda: self.fetch_prom(prom_sql, range))
+
+    def fetch_prom(self, prom_sql, range=True, time_range=None):
+        if range:
+            start, end, step = time_range if time_range is not None else (self.start, self.end, self.step)
+            chunks = self.split_time_range(start, end, step)
+            if len(chunks) == 1:
+                return self.query_range(prom_sql, *chunks[0])
+            with ThreadPoolExecutor(max_workers=min(len(chunks), self.max_concurrency)) as pool:
+                chunk_results = list(pool.map(lambda chunk: self.query_range(prom_sql, *chunk), chunks))
+            return merge_chunk_results(chunk_results)
+        with self.query_slots:
+            data = self.transport.get(self.prom_no_range_url,
+                                      params={'query': prom_sql})
+        return data['result']
+
+    def query_range(self, prom_sql, start, end, step):
+        with self.query_slots:
+            data = self.transport.get(self.prom_range_url,
+                                      params={'query': prom_sql,
+                                              'start': start,
+                                              'end': end,
+                                              'step': step})
+        return data['result']
+
+    def split_time_range(self, start, end, step):
+        '''
+            split [start, end] into chunks of at most max_points points on the same step grid
+            return [(chunk_start, chunk_end, step), ...]
+        '''
+        chunks = []
+        chunk_span = step * self.max_points
+        chunk_start = start
+        while chunk_start <= end:
+            chunks.append((chunk_start, min(end, chunk_start + chunk_span - step), step))
+            chunk_start += chunk_span
+        return chunks if len(chunks) > 0 else [(start, end, step)]
+
+    def execute_proms(self, prom_sqls: list, range=True):
+        '''
+            execute several prom_sqls concurrently, the results keep the order of prom_sqls
+        '''
+        if len(prom_sqls) == 1:
+            return [self.execute_prom(prom_sqls[0], range)]
+        with ThreadPoolExecutor(max_workers=len(prom_sqls)) as pool:
+            return list(pool.map(self.bind_time_range(lambda prom_sql: self.execute_prom(prom_sql, range)), prom_sqls))
+
+    def collect_concurrently(self, queries: dict):
+        '''
+            run several getters at the same time, the number of in-flight queries is limited by max_concurrency
+            queries: {name: (getter, args, kwargs)}, e.g. {'pod': (self.get_pod_num, (deployments, namespace), {'range': True})}
+            return {name: result of the getter}
+        '''
+        with ThreadPoolExecutor(max_workers=max(1, len(queries))) as pool:
+            futures = {name: pool.submit(self.bind_time_range(getter), *args, **kwargs)
+                       for name, (getter, args, kwargs) in queries.items()}
+            return {name: future.result() for name, future in futures.items()}
+
+    def query_specs(self, specs: list, deployments, namespace, range=True):
+        '''
+            query the columns described by specs (see MetricSpec) with the minimal set of PromQL queries
+        '''
+        planned = plan_queries(specs, namespace)
+        responses = self.execute_proms([prom_sql for prom_sql, _ in planned], range)
+        return scatter_results(specs, planned, responses, deployments)
 
     def get_call_latency(self, namespace, p=0.5, range=True):
         prom_sql = 'histogram_quantile(%f, sum(irate(istio_request_duration_milliseconds_bucket{reporter="destination", destination_workload_namespace="%s"}[1m])) by (destination_workload, source_workload, le))' % (p, namespace)
         responses = self.execute_prom(prom_sql, range)
-        latency_df = pd.DataFrame()
-        def handle(result, latency_df):
-            if 'values' in result.keys():
-                values = result['values']
-            else:
-                values = [[result['value'][0], result['value'][1]]]
-            key =  result['metric']['source_workload'] + '_' + result['metric']['destination_workload']
-            values = list(zip(*values))
-            if 'timestamp' not in latency_df:
-                timestamp = values[0]
-                latency_df['timestamp'] = timestamp
-                latency_df['timestamp'] = latency_df['timestamp'].astype('datetime64[s]')
-            metric = values[1]
-            latency_df[key] = pd.Series(metric)
-            latency_df[key] = latency_df[key].astype('float64')
-            latency_df[key] = latency_df[key].fillna(0.0)
-
-        [handle(result, latency_df) for result in responses]
-        return latency_df
+        def name_of(metric):
+            return metric['source_workload'] + '_' + metric['destination_workload']
+        return decode_results([(responses, name_of)])
     
     
     def get_pod_num(self, deployments, namespace, range=True):
-        instance_df = pd.DataFrame()
         qps_sql = 'count(kube_pod_info{namespace="%s"}) by (created_by_name)' % namespace # need kube-state-metric
         response = self.execute_prom(qps_sql, range)
-        def handle(result, instance_df):
-            if 'created_by_name' in result['metric']:
-                pattern = r'-(?:[a-fA-F0-9]{1,})$'
-                name = re.sub(pattern, '', result['metric']['created_by_name'])
-                if name not in deployments:
-                    return
-                name = name + '&count'
-                if 'values' in result.keys():
-                    values = result['values']
-                else:
-                    values = [[result['value'][0], result['value'][1]]]
-                values = list(zip(*values))
-                if 'timestamp' not in instance_df:
-                    timestamp = values[0]
-                    instance_df['timestamp'] = timestamp
-                    instance_df['timestamp'] = instance_df['timestamp'].astype('datetime64[s]')
-                metric = values[1]
-                instance_df[name] = pd.Series(metric)
-                instance_df[name] = instance_df[name].astype('float64')
-
-        [handle(result, instance_df) for result in response]
-        return instance_df
+        def name_of(metric):
+            if 'created_by_name' not in metric:
+                return None
+            name = REPLICASET_HASH_PATTERN.sub('', metric['created_by_name'])
+            if name not in deployments:
+                return None
+            return name + '&count'
+        return decode_results([(response, name_of)], fill_value=None)
 
     def get_e2e_latency(self, p=0.5, range=True):
-        latency_df = pd.DataFrame()
         e2e_sql = 'histogram_quantile(%f, sum(irate(istio_request_duration_milliseconds_bucket{reporter="source",source_workload="istio-ingressgateway"}[1m])) by (source_workload,le))' % (p)
         e2e_responses = self.execute_prom(e2e_sql, range)
-        def handle(result, latency_df):
-            name = result['metric']['source_workload']   
-            if 'values' in result.keys():
-                values = result['values']
-            else:
-                values = [[result['value'][0], result['value'][1]]]
-            values = list(zip(*values))
-            if 'timestamp' not in latency_df:
-                timestamp = values[0]
-                latency_df['timestamp'] = timestamp
-                latency_df['timestamp'] = latency_df['timestamp'].astype('datetime64[s]')
-            metric = values[1]
-            key = name + '&' + str(p)
-            latency_df[key] = pd.Series(metric)
-            latency_df[key] = latency_df[key].astype('float64')
-            latency_df[key] = latency_df[key].fillna(0.0)
-        [handle(result, latency_df) for result in e2e_responses]
-        return latency_df
+        def name_of(metric):
+            return metric['source_workload'] + '&' + str(p)
+        return decode_results([(e2e_responses, name_of)])
 
 
     
     def get_latency(self, deployments, namespace, p=0.5, range=True):
-        latency_df = pd.DataFrame()
-        prom_sql = 'histogram_quantile(%f, sum(irate(istio_request_duration_milliseconds_bucket{reporter="destination", destination_workload_namespace="%s"}[1m])) by (destination_workload,le))' % (p, namespace)
-        responses = self.execute_prom(prom_sql, range)
-        
+        '''
+            range queries fetch the buckets through the planner, the instant queries of the control loops
+            compute the single quantile in prometheus (one series per workload instead of one per bucket)
+        '''
+        if range:
+            specs = [MetricSpec('latency', 'workload', p), MetricSpec('latency', 'gateway', p)]
+            return self.query_specs(specs, deployments, namespace, range)
+        _, template, selectors = PLANNER_METRICS['latency']
+        prom_sqls = ['histogram_quantile(%s, %s)' % (p, template % (selectors[aggregation] % {'namespace': namespace},
+                                                                   PLANNER_GROUP_LABELS[aggregation]))
+                     for aggregation in ['workload', 'gateway']]
+        workload_response, gateway_response = self.execute_proms(prom_sqls, range=False)
 
-        e2e_sql = 'histogram_quantile(%f, sum(irate(istio_request_duration_milliseconds_bucket{reporter="source",source_workload="istio-ingressgateway"}[1m])) by (source_workload,le))' % (p)
-        e2e_responses = self.execute_prom(e2e_sql, range)
+        def workload_name_of(metric):
+            name = metric.get('destination_workload')
+            return name + '&' + str(p) if name in deployments else None
 
-        def handle(result, latency_df):
-            try:
-                name = result['metric']['destination_workload']
-            except:
-                name = result['metric']['source_workload']
-            if name not in deployments and name != 'istio-ingressgateway':
-                return
-            if 'values' in result.keys():
-                values = result['values']
-            else:
-                values = [[result['value'][0], result['value'][1]]]
-            values = list(zip(*values))
-            if 'timestamp' not in latency_df:
-                timestamp = values[0]
-                latency_df['timestamp'] = timestamp
-                latency_df['timestamp'] = latency_df['timestamp'].astype('datetime64[s]')
-            metric = values[1]
-            key = name + '&' + str(p)
-            latency_df[key] = pd.Series(metric)
-            latency_df[key] = latency_df[key].astype('float64')
-            latency_df[key] = latency_df[key].fillna(0.0)
+        def gateway_name_of(metric):
+            name = metric.get('source_workload')
+            return name + '&' + str(p) if name == 'istio-ingressgateway' else None
+
+        return decode_results([(workload_response, workload_name_of), (gateway_response, gateway_name_of)])
 
-        [handle(result, latency_df) for result in responses]
-        [handle(result, latency_df) for result in e2e_responses]
 
-        return latency_df
+    def get_latencies(self, deployments, namespace, ps=(0.5, 0.9, 0.95, 0.99), range=True):
+        '''
+            fetch the latency histogram buckets once and compute all quantiles in ps locally,
+            the columns are the same as calling get_latency for each p
+        '''
+        specs = [MetricSpec('latency', aggregation, p) for p in ps for aggregation in ['workload', 'gateway']]
+        return self.query_specs(specs, deployments, namespace, range)
 
 
     def get_self_latency(self, deployments, namespace, range=True):
@@ -157,126 +584,33 @@ class PrometheusClient:
                 (rate(istio_request_duration_milliseconds_count{namespace="%s"}[1m]) or vector(1)),\
                 "app", "$1", "source_app", "(.*)"))'% (namespace, namespace, namespace, namespace)
         response = self.execute_prom(sql, range)
-        latency_df = pd.DataFrame()
-        def handle(result, df):
-            name = result['metric']['app']
+        def name_of(metric):
+            name = metric['app']
             if name not in deployments:
-                return
-            if 'values' in result.keys():
-                values = result['values']
-            else:
-                values = [[result['value'][0], result['value'][1]]]
-            values = list(zip(*values))
-            if 'timestamp' not in df:
-                timestamp = values[0]
-                df['timestamp'] = timestamp
-                df['timestamp'] = df['timestamp'].astype('datetime64[s]')
-            metric = values[1]
-            col = name + '&' + 'latency'
-            df[col] = pd.Series(metric)
-            df[col] = df[col].astype('float64')
-            df[col] = df[col].fillna(0.0)
-        [handle(result, latency_df) for result in response]
-        return latency_df
+                return None
+            return name + '&' + 'latency'
+        return decode_results([(response, name_of)])
 
 
     def get_svc_qps(self, deployments, namespace, range=True):
         '''
             Get qps for microservices
         '''
-        qps_sql = 'sum(rate(istio_requests_total{reporter="destination",namespace="%s"}[1m])) by (destination_workload)' % namespace
-        response = self.execute_prom(qps_sql, range)
-        qps_df = pd.DataFrame()
-
-        tmp_depoyments = deepcopy(deployments)
-        def handle(result, qps_df, metric_name):
-            try:
-                name = result['metric']['destination_workload']
-            except:
-                name = result['metric']['source_workload']
-            if name not in tmp_depoyments:
-                return
-            if 'values' in result.keys():
-                values = result['values']
-            else:
-                values = [[result['value'][0], result['value'][1]]]
-            values = list(zip(*values))
-            if 'timestamp' not in qps_df:
-                timestamp = values[0]
-                qps_df['timestamp'] = timestamp
-                qps_df['timestamp'] = qps_df['timestamp'].astype('datetime64[s]')
-            metric = values[1]
-            col = name + '&' + metric_name
-            qps_df[col] = pd.Series(metric)
-            qps_df[col] = qps_df[col].astype('float64')
-            qps_df[col] = qps_df[col].fillna(0.0)
-
-        [handle(result, qps_df, 'qps') for result in response]
-        return qps_df
+        return self.query_specs([MetricSpec('qps', 'workload')], deployments, namespace, range)
     
     def get_complete_qps(self, deployments, namespace, range=True):
         '''
             Get qps for microservices
+            tcp_recv/tcp_sent: TCP receive/sent (MB/s), tcp_conn: TCP connection
         '''
-        qps_sql = 'sum(rate(istio_requests_total{reporter="destination",namespace="%s"}[1m])) by (destination_workload)' % namespace
-        response = self.execute_prom(qps_sql, range)
-        qps_df = pd.DataFrame()
-
-        gateway_sql = 'sum(rate(istio_requests_total{reporter="source",source_workload="istio-ingressgateway"}[1m])) by (source_workload)'
-        gateway_response = self.execute_prom(gateway_sql, range)
-
-        # TCP receive
-        tcp_recv_sql = 'sum(rate(istio_tcp_received_bytes_total{reporter="destination",namespace="%s"}[1m])) by (destination_workload)/1024/1024' % (
-            namespace)
-        # TCP sent
-        tcp_sent_sql = 'sum(rate(istio_tcp_sent_bytes_total{reporter="destination",namespace="%s"}[1m])) by (destination_workload)/1024/1024' % (
-            namespace)
-        # TCP connection
-        tcp_conn_sql = 'sum(rate(istio_tcp_connections_opened_total{reporter="destination",namespace="%s"}[1m])) by (destination_workload)' % (
-            namespace)
-
-        tcp_recv = self.execute_prom(tcp_recv_sql, range)
-        tcp_sent = self.execute_prom(tcp_sent_sql, range)
-        tcp_conn= self.execute_prom(tcp_conn_sql, range)
-
-        tmp_depoyments = deepcopy(deployments)
-        tmp_depoyments.append('istio-ingressgateway')
-
-        def handle(result, qps_df, metric_name):
-            try:
-                name = result['metric']['destination_workload']
-            except:
-                name = result['metric']['source_workload']
-            if name not in tmp_depoyments:
-                return
-            if 'values' in result.keys():
-                values = result['values']
-            else:
-                values = [[result['value'][0], result['value'][1]]]
-            values = list(zip(*values))
-            if 'timestamp' not in qps_df:
-                timestamp = values[0]
-                qps_df['timestamp'] = timestamp
-                qps_df['timestamp'] = qps_df['timestamp'].astype('datetime64[s]')
-            metric = values[1]
-            col = name + '&' + metric_name
-            qps_df[col] = pd.Series(metric)
-            qps_df[col] = qps_df[col].astype('float64')
-            qps_df[col] = qps_df[col].fillna(0.0)
-
-        [handle(result, qps_df, 'qps') for result in response]
-        [handle(result, qps_df, 'qps') for result in gateway_response]
-        [handle(result, qps_df, 'tcp_recv') for result in tcp_recv]
-        [handle(result, qps_df, 'tcp_sent') for result in tcp_sent]
-        [handle(result, qps_df, 'tcp_conn') for result in tcp_conn]
-        return qps_df
+        specs = [MetricSpec('qps', 'workload'), MetricSpec('qps', 'gateway'),
+                 MetricSpec('tcp_recv', 'workload'), MetricSpec('tcp_sent', 'workload'), MetricSpec('tcp_conn', 'workload')]
+        return self.query_specs(specs, deployments, namespace, range)
 
     def get_metrics(self, deployments, namespace, range=True):
         '''
             Get CPU,memory,fs,network for microservices
         '''
-        df = pd.DataFrame()
-
         # CPU usage (m) note: this metric don't include the resoure of isto-proxy
         cpu_usage_sql = '(sum(rate(container_cpu_usage_seconds_total{namespace="%s",container!~\'POD|istio-proxy|\'}[1m])) by(pod)) * 1000' % (
             namespace)
@@ -291,125 +625,62 @@ class PrometheusClient:
             namespace)
         
 
-        cpu_usage = self.execute_prom(cpu_usage_sql, range)
-        mem_usage = self.execute_prom(mem_usage_sql, range)
+        cpu_usage, mem_usage = self.execute_proms([cpu_usage_sql, mem_usage_sql], range)
         # cpu_limit = self.execute_prom(cpu_limit_sql, range)
         # mem_limit = self.execute_prom(mem_limit_sql, range)
-        
-        tempdfs = []
 
-        def handle(result, tempdfs, col):
-            name = result['metric']['pod'] + '&' + col
-            if 'values' in result.keys():
-                values = result['values']
-            else:
-                values = [[result['value'][0], result['value'][1]]]
-            values = list(zip(*values))
-            metric = values[1]
-            tempdf = pd.DataFrame()
-            tempdf['timestamp'] = values[0]
-            tempdf[name] = pd.Series(metric)
-            tempdf[name] = tempdf[name].astype('float64')
-            tempdf.set_index('timestamp',inplace=True)
-            tempdfs.append(tempdf)
-
-        [handle(result, tempdfs, 'cpu_usage') for result in cpu_usage]
-        [handle(result, tempdfs, 'mem_usage') for result in mem_usage]
-        # [handle(result, tempdfs, 'cpu_limit') for result in cpu_limit]
-        # [handle(result, tempdfs, 'mem_limit') for result in mem_limit]
-
-
-        df = pd.concat(tempdfs, axis=1)
-        df = df.fillna(0)
-
-        # transform container-level metrics to service-level metrics
-        final_df = pd.DataFrame()
-        final_df['timestamp'] = df.index
-        final_df.set_index('timestamp',inplace=True)
-        col_list = list(df)
+        def pod_name_of(col):
+            return lambda metric: metric['pod'] + '&' + col
+
+        df = decode_results([(cpu_usage, pod_name_of('cpu_usage')),
+                             (mem_usage, pod_name_of('mem_usage'))])
+                             # (cpu_limit, pod_name_of('cpu_limit')),
+                             # (mem_limit, pod_name_of('mem_limit'))])
+
+        if df.empty:
+            return pd.DataFrame()
+
+        # transform container-level metrics to service-level metrics with one groupby over (deployment, metric)
+        pods, metrics = zip(*(col.split('&') for col in df.columns[1:]))
+        values = df.iloc[:, 1:].T
+        values.index = pd.MultiIndex.from_arrays([[strip_pod_suffix(pod) for pod in pods], metrics])
+        grouped = values.groupby(level=[0, 1])
+        mean_df, max_df = grouped.mean().T, grouped.max().T
+
+        final_cols = {'timestamp': df['timestamp']}
         for svc in deployments:
-            cols = [col for col in col_list if col.endswith('cpu_usage') and svc==self.strip_pod_suffix(col.replace('&cpu_usage', ''))]
-            final_df[svc + '&cpu_usage_mean'] = df[cols].mean(axis=1)
-            final_df[svc + '&cpu_usage_max'] = df[cols].max(axis=1)
-            cols = [col for col in col_list if col.endswith('mem_usage') and svc==self.strip_pod_suffix(col.replace('&mem_usage', ''))]
-            final_df[svc + '&mem_usage_mean'] = df[cols].mean(axis=1)
-            final_df[svc + '&mem_usage_max'] = df[cols].max(axis=1)
-            # cols = [col for col in col_list if col.startswith(svc) and col.endswith('cpu_limit')]
-            # final_df[svc + '&cpu_limit'] = df[cols].max(axis=1)
-            # cols = [col for col in col_list if col.startswith(svc) and col.endswith('mem_limit')]
-            # final_df[svc + '&mem_limit'] = df[cols].max(axis=1)
-
-
-        final_df.reset_index(inplace=True)
-        final_df['timestamp'] = final_df['timestamp'].astype('datetime64[s]')
-        return final_df
+            for metric in ['cpu_usage', 'mem_usage']:
+                final_cols[f'{svc}&{metric}_mean'] = mean_df[(svc, metric)] if (svc, metric) in mean_df.columns else np.nan
+                final_cols[f'{svc}&{metric}_max'] = max_df[(svc, metric)] if (svc, metric) in max_df.columns else np.nan
+            # final_cols[svc + '&cpu_limit'] = max_df[(svc, 'cpu_limit')]
+            # final_cols[svc + '&mem_limit'] = max_df[(svc, 'mem_limit')]
+
+        return pd.DataFrame(final_cols)
     
     def get_node_metric(self, range=True):
         cpu_sql = '100 - (sum by (job) (rate(node_cpu_seconds_total{mode="idle"}[1m])) * 100 /count by (job) (node_cpu_seconds_total{mode="idle"}))'
-        cpu_response = self.execute_prom(cpu_sql, range)
         mem_sql = '(node_memory_MemTotal_bytes - node_memory_MemFree_bytes - node_memory_Buffers_bytes - node_memory_Cached_bytes) / node_memory_MemTotal_bytes * 100'
-        mem_response = self.execute_prom(mem_sql, range)
-        node_df = pd.DataFrame()
+        cpu_response, mem_response = self.execute_proms([cpu_sql, mem_sql], range)
 
-        def handle(result, qps_df, col):
-            name = result['metric']['job']
-            if 'values' in result.keys():
-                values = result['values']
-            else:
-                values = [[result['value'][0], result['value'][1]]]
-            values = list(zip(*values))
-            if 'timestamp' not in qps_df:
-                timestamp = values[0]
-                qps_df['timestamp'] = timestamp
-                qps_df['timestamp'] = qps_df['timestamp'].astype('datetime64[s]')
-            metric = values[1]
-            col_name = name + '&' + col
-            qps_df[col_name] = pd.Series(metric)
-            qps_df[col_name] = qps_df[col_name].astype('float64')
-            qps_df[col_name] = qps_df[col_name].fillna(0.0)
-
-        [handle(result, node_df, 'node_cpu_usage') for result in cpu_response]
-        [handle(result, node_df, 'node_mem_usage') for result in mem_response]
-        return node_df
+        def job_name_of(col):
+            return lambda metric: metric['job'] + '&' + col
+
+        return decode_results([(cpu_response, job_name_of('node_cpu_usage')),
+                               (mem_response, job_name_of('node_mem_usage'))])
 
     def strip_pod_suffix(self, pod_name):
-        # This pattern matches a hyphen followed by one or more word characters (letters, digits, and underscores)
-        # at the end of the string. The pattern assumes that the deployment name does not end with a digit or letter
+        # Remove the last part (instance identifier) and the second last part (replicaset hash).
+        # The pattern assumes that the deployment name does not end with a digit or letter
         # immediately before the last two hyphens.
-        pattern = r'-([a-zA-Z0-9]+)$'
-        
-        # Remove the last part (instance identifier)
-        deployment_name = re.sub(pattern, '', pod_name)
-        
-        # Remove the second last part (replicaset hash)
-        deployment_name = re.sub(pattern, '', deployment_name)
-
-        return deployment_name
+        return strip_pod_suffix(pod_name)
 
     def get_resource_metric(self, namespace, range=True):
-        metric_df = pd.DataFrame()
         vCPU_sql = 'sum(rate(container_cpu_usage_seconds_total{container!~\'POD|istio-proxy|\',namespace="%s"}[1m]))' % namespace
         mem_sql = 'sum(rate(container_memory_usage_bytes{container!~\'POD|istio-proxy|\', namespace="%s"}[1m])) / (1024*1024)' % namespace
-        vCPU = self.execute_prom(vCPU_sql, range)
-        mem = self.execute_prom(mem_sql, range)
-
-        def handle(result, metric_df, col):
-            values = result['values']
-            values = list(zip(*values))
-            if 'timestamp' not in metric_df:
-                timestamp = values[0]
-                metric_df['timestamp'] = timestamp
-                metric_df['timestamp'] = metric_df['timestamp'].astype('datetime64[s]')
-            metric = values[1]
-            metric_df[col] = pd.Series(metric)
-            metric_df[col] = metric_df[col].fillna(0)
-            metric_df[col] = metric_df[col].astype('float64')
-
-        [handle(result, metric_df, 'namespace_vCPU') for result in vCPU]
-        [handle(result, metric_df, 'namespace_memory') for result in mem]
-
-        return metric_df
+        vCPU, mem = self.execute_proms([vCPU_sql, mem_sql], range)
 
+        return decode_results([(vCPU, lambda metric: 'namespace_vCPU'),
+                               (mem, lambda metric: 'namespace_memory')])
 
     # def get_success_rate(self, deployments, namespace, range=True):
     #     success_df = pd.DataFrame()
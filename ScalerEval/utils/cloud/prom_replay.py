@@ -0,0 +1,286 @@
+'''
+    offline stand-in of prometheus that replays a recorded run (tmp/<benchmark>/.../record.csv),
+    it implements /api/v1/query and /api/v1/query_range for the PromQL shapes sent by PrometheusClient
+
+    usage: python -m utils.cloud.prom_replay --record tmp/sockshop/dist1/wiki/None/record.csv --port 9090 --speedup 10
+    and set Config.prom_url to http://127.0.0.1:9090
+'''
+import argparse
+import gzip
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+# default buckets (ms) of istio_request_duration_milliseconds
+ISTIO_LATENCY_BUCKETS = [0.5, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000,
+                         30000, 60000, 300000, 600000, 1800000, 3600000, float('inf')]
+GATEWAY = 'istio-ingressgateway'
+MAX_POINTS = 11000
+# a term tagged by the query planner of PrometheusClient: label_replace(<query>, "<label>", "<value>", "", "")
+TAGGED_TERM = re.compile(r'^label_replace\((.*), "([a-zA-Z_][a-zA-Z0-9_]*)", "([^"]*)", "", ""\)$', re.S)
+
+
+def split_top_level_or(query: str):
+    '''
+        split `a or b or c` on the `or` operators that are not nested in parentheses or strings
+    '''
+    terms, depth, quote, last = [], 0, None, 0
+    for i, char in enumerate(query):
+        if quote is not None:
+            if char == quote and query[i - 1] != '\\':
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char in '([{':
+            depth += 1
+        elif char in ')]}':
+            depth -= 1
+        elif depth == 0 and query.startswith(' or ', i):
+            terms.append(query[last:i])
+            last = i + len(' or ')
+    terms.append(query[last:])
+    return [term.strip() for term in terms]
+
+
+class RecordReplay:
+    '''
+        map wall-clock time to the rows of record.csv and build the series of a PromQL query
+        speedup: seconds of the record replayed per wall-clock second
+        start_time: wall-clock time replaying the first row (default: now)
+    '''
+    def __init__(self, record_path: str, speedup: float = 1.0, start_time: float = None, loop: bool = True):
+        record = pd.read_csv(record_path)
+        self.timestamps = ((pd.to_datetime(record['timestamp']) - pd.Timestamp(0)) // pd.Timedelta('1s')).to_numpy(dtype=np.float64)
+        self.record = record.drop(columns=['timestamp']).apply(pd.to_numeric, errors='coerce')
+        self.speedup = speedup
+        self.start_time = start_time if start_time is not None else time.time()
+        self.loop = loop
+        self.deployments = sorted({col.split('&')[0] for col in self.record.columns
+                                   if col.endswith('&count')})
+        self.jobs = sorted({col.split('&')[0] for col in self.record.columns if col.endswith('&node_cpu_usage')})
+
+    def rows(self, times: np.ndarray):
+        '''
+            index of the record row replayed at each wall-clock time
+        '''
+        t0, t1 = self.timestamps[0], self.timestamps[-1]
+        offset = (times - self.start_time) * self.speedup
+        duration = max(t1 - t0, 1)
+        offset = np.mod(offset, duration + 1) if self.loop else np.clip(offset, 0, duration)
+        return np.clip(np.searchsorted(self.timestamps, t0 + offset, side='right') - 1, 0, len(self.timestamps) - 1)
+
+    def column(self, col: str, rows: np.ndarray):
+        if col not in self.record.columns:
+            return np.full(len(rows), np.nan)
+        return self.record[col].to_numpy(dtype=np.float64)[rows]
+
+    def quantile_columns(self, name: str):
+        qs = []
+        for col in self.record.columns:
+            prefix, _, suffix = col.rpartition('&')
+            if prefix == name:
+                try:
+                    qs.append((float(suffix), col))
+                except ValueError:
+                    continue
+        return sorted(qs)
+
+    def quantile(self, name: str, p: float, rows: np.ndarray):
+        '''
+            recorded quantile, or interpolated between the recorded ones
+        '''
+        qs = self.quantile_columns(name)
+        if len(qs) == 0:
+            return None
+        values = np.stack([self.column(col, rows) for _, col in qs], axis=1)
+        return np.array([np.interp(p, [q for q, _ in qs], row) for row in values])
+
+    def buckets(self, name: str, rows: np.ndarray):
+        '''
+            synthesize cumulative bucket rates from the recorded quantiles and qps
+            return {le: values}
+        '''
+        qs = self.quantile_columns(name)
+        if len(qs) == 0:
+            return {}
+        points = np.maximum.accumulate(np.nan_to_num(np.stack([self.column(col, rows) for _, col in qs], axis=1)), axis=1)
+        probs = [q for q, _ in qs]
+        qps = np.nan_to_num(self.column(name + '&qps', rows), nan=1.0)
+        buckets = {}
+        for le in ISTIO_LATENCY_BUCKETS:
+            if np.isposinf(le):
+                cdf = np.ones(len(rows))
+            else:
+                cdf = np.array([np.interp(le, np.concatenate([[0.0], row]), [0.0] + probs, right=1.0) for row in points])
+            buckets[le] = cdf * qps
+        return buckets
+
+    def pod_name(self, svc: str, i: int):
+        replicaset_hash = hashlib.md5(svc.encode()).hexdigest()[:10]
+        return f'{svc}-{replicaset_hash}-pod{i}'
+
+    def per_pod(self, col_suffix: str, rows: np.ndarray):
+        '''
+            split a service-level mean into `count` identical pods
+        '''
+        series = []
+        for svc in self.deployments:
+            counts = np.nan_to_num(self.column(svc + '&count', rows))
+            values = self.column(f'{svc}&{col_suffix}', rows)
+            for i in range(int(counts.max()) if len(counts) > 0 else 0):
+                series.append(({'pod': self.pod_name(svc, i)}, np.where(counts > i, values, np.nan)))
+        return series
+
+    def resolve(self, query: str, rows: np.ndarray):
+        '''
+            return [(labels, values), ...] for the PromQL shapes of PrometheusClient
+        '''
+        terms = split_top_level_or(query)
+        if len(terms) > 1 or TAGGED_TERM.match(terms[0]):
+            series = []
+            for term in terms:
+                match = TAGGED_TERM.match(term)
+                if match is None:
+                    series.extend(self.resolve(term, rows))
+                    continue
+                inner, label, value = match.groups()
+                series.extend(({**labels, label: value}, values) for labels, values in self.resolve(inner, rows))
+            return series
+        if 'istio_request_duration_milliseconds_bucket' in query:
+            if 'destination_workload, source_workload' in query:
+                return []  # the latency of calls is not recorded
+            is_gateway = 'source_workload="istio-ingressgateway"' in query
+            names = [GATEWAY] if is_gateway else self.deployments
+            label = 'source_workload' if is_gateway else 'destination_workload'
+            match = re.match(r'\s*histogram_quantile\(\s*([0-9.]+)', query)
+            series = []
+            for name in names:
+                if match is not None:
+                    values = self.quantile(name, float(match.group(1)), rows)
+                    if values is not None:
+                        series.append(({label: name}, values))
+                else:
+                    for le, values in self.buckets(name, rows).items():
+                        series.append(({label: name, 'le': '+Inf' if np.isposinf(le) else str(le)}, values))
+            return series
+        if 'kube_pod_info' in query:
+            return [({'created_by_name': self.pod_name(svc, 0).rsplit('-', 1)[0]}, self.column(svc + '&count', rows))
+                    for svc in self.deployments]
+        for metric, col_suffix in [('istio_requests_total', 'qps'),
+                                   ('istio_tcp_received_bytes_total', 'tcp_recv'),
+                                   ('istio_tcp_sent_bytes_total', 'tcp_sent'),
+                                   ('istio_tcp_connections_opened_total', 'tcp_conn')]:
+            if metric in query:
+                if 'source_workload="istio-ingressgateway"' in query:
+                    return [({'source_workload': GATEWAY}, self.column(f'{GATEWAY}&{col_suffix}', rows))]
+                return [({'destination_workload': svc}, self.column(f'{svc}&{col_suffix}', rows))
+                        for svc in self.deployments]
+        if 'container_cpu_usage_seconds_total' in query:
+            if 'by(pod)' in query.replace(' ', ''):
+                return self.per_pod('cpu_usage_mean', rows)
+            return [({}, self.column('namespace_vCPU', rows))]
+        if 'container_memory_usage_bytes' in query:
+            if 'by(pod)' in query.replace(' ', ''):
+                return self.per_pod('mem_usage_mean', rows)
+            return [({}, self.column('namespace_memory', rows))]
+        if 'node_cpu_seconds_total' in query:
+            return [({'job': job}, self.column(job + '&node_cpu_usage', rows)) for job in self.jobs]
+        if 'node_memory_MemTotal_bytes' in query:
+            return [({'job': job}, self.column(job + '&node_mem_usage', rows)) for job in self.jobs]
+        print(f'[PromReplay] unsupported query, return empty result: {query}')
+        return []
+
+    def query_range(self, query: str, start: float, end: float, step: float):
+        times = start + step * np.arange(int(np.floor((end - start) / step)) + 1)
+        result = []
+        for labels, values in self.resolve(query, self.rows(times)):
+            samples = [[float(t), repr(float(v))] for t, v in zip(times, values) if not np.isnan(v)]
+            if len(samples) > 0:
+                result.append({'metric': labels, 'values': samples})
+        return {'resultType': 'matrix', 'result': result}
+
+    def query(self, query: str, at: float):
+        result = []
+        for labels, values in self.resolve(query, self.rows(np.array([at]))):
+            if not np.isnan(values[0]):
+                result.append({'metric': labels, 'value': [at, repr(float(values[0]))]})
+        return {'resultType': 'vector', 'result': result}
+
+
+class PromReplayHandler(BaseHTTPRequestHandler):
+    replay: RecordReplay = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.handle_query(url.path, {k: v[0] for k, v in parse_qs(url.query).items()})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        params = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()}
+        self.handle_query(urlparse(self.path).path, params)
+
+    def handle_query(self, path: str, params: dict):
+        try:
+            if path == '/api/v1/query_range':
+                start, end, step = float(params['start']), float(params['end']), float(params['step'])
+                if (end - start) / step + 1 > MAX_POINTS:
+                    return self.reply(400, {'status': 'error', 'errorType': 'bad_data',
+                                            'error': 'exceeded maximum resolution of 11,000 points per timeseries. Try decreasing the query resolution (?step=XX)'})
+                data = self.replay.query_range(params['query'], start, end, step)
+            elif path == '/api/v1/query':
+                data = self.replay.query(params['query'], float(params.get('time', time.time())))
+            else:
+                return self.reply(404, {'status': 'error', 'errorType': 'not_found', 'error': path})
+        except (KeyError, ValueError) as e:
+            return self.reply(400, {'status': 'error', 'errorType': 'bad_data', 'error': str(e)})
+        self.reply(200, {'status': 'success', 'data': data})
+
+    def reply(self, status: int, body: dict):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            payload = gzip.compress(payload)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def serve(record_path: str, host: str = '127.0.0.1', port: int = 9090, speedup: float = 1.0,
+          start_time: float = None, loop: bool = True, background: bool = False):
+    '''
+        start the replay server, return the server when background=True (stop it with server.shutdown())
+    '''
+    handler = type('Handler', (PromReplayHandler,), {'replay': RecordReplay(record_path, speedup, start_time, loop)})
+    server = ThreadingHTTPServer((host, port), handler)
+    print(f'[PromReplay] replaying {record_path} at http://{host}:{server.server_port} (speedup x{speedup})')
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='replay a recorded run as a prometheus server')
+    parser.add_argument('--record', required=True, help='path of record.csv')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9090)
+    parser.add_argument('--speedup', type=float, default=1.0, help='seconds of the record replayed per second')
+    parser.add_argument('--start', type=float, default=None, help='unix time replaying the first row (default: now)')
+    parser.add_argument('--no-loop', action='store_true', help='hold the last row instead of replaying from the beginning')
+    args = parser.parse_args()
+    serve(args.record, args.host, args.port, args.speedup, args.start, not args.no_loop)
@@ -0,0 +1,116 @@
+import threading
+import numpy as np
+import pandas as pd
+from kubernetes.utils import parse_quantity
+
+
+RESOURCE_KEYS = ['cpu_limit', 'mem_limit', 'cpu_request', 'mem_request']
+
+
+def cpu_millicores(quantity):
+    '''
+        any kubernetes quantity ('250m', '1', '1.5', '2e3', ...) in millicores, None stays None
+    '''
+    if quantity is None:
+        return None
+    return float(parse_quantity(quantity) * 1000)
+
+
+def mem_mebibytes(quantity):
+    '''
+        any kubernetes quantity ('128Mi', '1Gi', '512Ki', '1G', '129M', '1e9', ...) in MiB, None stays None
+    '''
+    if quantity is None:
+        return None
+    return float(parse_quantity(quantity) / (1024 * 1024))
+
+
+def container_resources(container):
+    resources = container.resources
+    limits = (resources.limits if resources is not None else None) or {}
+    requests = (resources.requests if resources is not None else None) or {}
+    return {
+        'cpu_limit': cpu_millicores(limits.get('cpu')),
+        'mem_limit': mem_mebibytes(limits.get('memory')),
+        'cpu_request': cpu_millicores(requests.get('cpu')),
+        'mem_request': mem_mebibytes(requests.get('memory'))
+    }
+
+
+def pod_resources(deployment):
+    '''
+        resources of every container of the pod template and their per-pod totals,
+        a total is None when one of the containers has no such limit/request (unbounded)
+    '''
+    containers = {c.name: container_resources(c) for c in deployment.spec.template.spec.containers}
+    res = {'containers': containers}
+    for key in RESOURCE_KEYS:
+        values = [c[key] for c in containers.values()]
+        res[key] = None if len(values) == 0 or None in values else sum(values)
+    return res
+
+
+class ResourceSnapshot:
+    '''
+        limits/requests of the deployments of a namespace (cpu in millicores, memory in MiB),
+        taken from one list of the deployments, or from the deployment informer when the
+        snapshot watches (the informer keeps it current). Deployments are parsed again only
+        when their resourceVersion changes
+    '''
+    def __init__(self, kube_client, namespace: str, watch=False):
+        self.kube_client = kube_client
+        self.namespace = namespace
+        self.watch = watch
+        self.parsed = {}  # name -> (resource_version, resources)
+        self.lock = threading.Lock()
+
+    def close(self):
+        '''
+            stop watching: the deployment informer is stopped as well, unless the client
+            serves all of its reads from informers (then others use it too)
+        '''
+        if self.watch:
+            self.watch = False
+            if not self.kube_client.informer:
+                self.kube_client.stop_informer('deployment', self.namespace)
+
+    def deployments(self):
+        informer = self.kube_client.get_informer('deployment', self.namespace, force=self.watch)
+        if informer is not None:
+            return informer.list()
+        return self.kube_client.list_deployment_objects(self.namespace)
+
+    def get(self, deployments: list = None):
+        '''
+            deployment -> pod_resources, restricted to `deployments` if given
+        '''
+        snapshot = {}
+        with self.lock:
+            for item in self.deployments():
+                name = item.metadata.name
+                if deployments is not None and name not in deployments:
+                    continue
+                version = item.metadata.resource_version
+                cached = self.parsed.get(name)
+                if cached is None or cached[0] != version:
+                    cached = (version, pod_resources(item))
+                    self.parsed[name] = cached
+                snapshot[name] = cached[1]
+        return {name: snapshot[name] for name in sorted(snapshot)}
+
+
+def attach_limits(data_df: pd.DataFrame, snapshot: dict):
+    '''
+        add the per-pod `svc&cpu_limit` (millicores) and `svc&mem_limit` (MiB) columns of a
+        ResourceSnapshot to a metrics frame, NaN for the containers without limits
+    '''
+    columns = {}
+    for svc, res in snapshot.items():
+        columns[f'{svc}&cpu_limit'] = np.nan if res['cpu_limit'] is None else res['cpu_limit']
+        columns[f'{svc}&mem_limit'] = np.nan if res['mem_limit'] is None else res['mem_limit']
+    if len(columns) == 0:
+        return data_df
+    data_df = data_df.drop(columns=[col for col in columns if col in data_df.columns])
+    limits_df = pd.DataFrame(np.broadcast_to(np.array(list(columns.values()), dtype=float), (len(data_df), len(columns))),
+                             columns=list(columns.keys()), index=data_df.index)
+    return pd.concat([data_df, limits_df], axis=1)
@@ -0,0 +1,481 @@
+import copy
+import datetime
+import hashlib
+import threading
+import time
+from types import SimpleNamespace
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+from utils.cloud.applier import load_documents, manifest_files
+from utils.cloud.executor import KubernetesClient
+
+
+class SimClock:
+    '''
+        simulated time: `speedup` simulated seconds per wall-clock second, waits skip forward
+        to the next state change instead of sleeping. With speedup=0 the time only moves
+        through the waits, which makes a run fully reproducible
+    '''
+    def __init__(self, speedup=60.0, start=None):
+        self.speedup = speedup
+        self.start = time.time() if start is None else start
+        self.origin = time.monotonic()
+        self.offset = 0.0
+
+    def now(self):
+        return self.start + self.offset + (time.monotonic() - self.origin) * self.speedup
+
+    def skip(self, seconds: float):
+        self.offset += max(0.0, seconds)
+
+
+class SimPod:
+    def __init__(self, name, created, ready_at):
+        self.name = name
+        self.created = created
+        self.ready_at = ready_at
+        self.deleted = None  # deletion timestamp
+        self.gone_at = None
+
+
+class SimDeployment:
+    def __init__(self, doc: dict, namespace: str):
+        self.doc = doc
+        self.name = doc['metadata']['name']
+        self.namespace = namespace
+        self.replicas = doc.get('spec', {}).get('replicas', 1)
+        self.generation = 1
+        self.revision = 0
+        self.pods = []
+        self.pod_index = 0
+        self.restarted_at = None
+
+    def containers(self):
+        return self.doc.get('spec', {}).get('template', {}).get('spec', {}).get('containers', [])
+
+
+class SimCluster:
+    '''
+        In-process cluster state: namespaces, deployments with their pods, HPAs and other
+        manifests. Pods start `startup_delay` and stop `termination_delay` simulated seconds
+        after a change, every read derives the state at the current simulated time, so the
+        same sequence of calls at the same simulated times always gives the same state.
+        HPAs are stored but not reconciled, there is no metrics pipeline behind the simulator.
+    '''
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, speedup=60.0, startup_delay=20.0, termination_delay=10.0, namespace_delay=5.0, start=None):
+        self.clock = SimClock(speedup, start)
+        self.startup_delay = startup_delay
+        self.termination_delay = termination_delay
+        self.namespace_delay = namespace_delay
+        self.namespaces = {'default': {'labels': {}, 'created': self.clock.start, 'gone_at': None},
+                           'istio-system': {'labels': {}, 'created': self.clock.start, 'gone_at': None}}
+        self.deployments = {}  # (namespace, name) -> SimDeployment
+        self.hpas = {}  # (namespace, name) -> V1HorizontalPodAutoscaler
+        self.others = {}  # (namespace, kind, name) -> manifest
+        self.resource_version = 0
+        self.lock = threading.RLock()
+        # prometheus is restarted by init_env
+        self.add_deployment({'metadata': {'name': 'prometheus'},
+                             'spec': {'replicas': 1, 'template': {'spec': {'containers': [{'name': 'prometheus'}]}}}},
+                            'istio-system')
+
+    @classmethod
+    def shared(cls, **options):
+        '''
+            one cluster per process, every simulated client of the process sees the same state
+        '''
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(**options)
+            return cls._shared
+
+    def next_version(self):
+        self.resource_version += 1
+        return str(self.resource_version)
+
+    # ---- state changes ----
+    def gc(self, now):
+        for name in [name for name, ns in self.namespaces.items() if ns['gone_at'] is not None and ns['gone_at'] <= now]:
+            del self.namespaces[name]
+            for key in [key for key in self.deployments if key[0] == name]:
+                del self.deployments[key]
+            for key in [key for key in self.hpas if key[0] == name]:
+                del self.hpas[key]
+            for key in [key for key in self.others if key[0] == name]:
+                del self.others[key]
+        for deployment in self.deployments.values():
+            deployment.pods = [pod for pod in deployment.pods if pod.gone_at is None or pod.gone_at > now]
+
+    def pod_name(self, deployment: SimDeployment):
+        deployment.pod_index += 1
+        rs_hash = hashlib.md5(f'{deployment.name}/{deployment.revision}'.encode()).hexdigest()[:10]
+        pod_hash = hashlib.md5(f'{deployment.name}/{deployment.pod_index}'.encode()).hexdigest()[:5]
+        return f'{deployment.name}-{rs_hash}-{pod_hash}'
+
+    def scale_pods(self, deployment: SimDeployment, now):
+        live = [pod for pod in deployment.pods if pod.deleted is None]
+        for _ in range(deployment.replicas - len(live)):
+            deployment.pods.append(SimPod(self.pod_name(deployment), now, now + self.startup_delay))
+        if len(live) > deployment.replicas:
+            # like the replicaset controller, pods that are not ready and the youngest pods go first
+            victims = sorted(live, key=lambda pod: (pod.ready_at <= now, -pod.created))
+            for pod in victims[:len(live) - deployment.replicas]:
+                pod.deleted = now
+                pod.gone_at = now + self.termination_delay
+
+    def add_deployment(self, doc: dict, namespace: str):
+        now = self.clock.now()
+        key = (namespace, doc['metadata']['name'])
+        deployment = self.deployments.get(key)
+        if deployment is None:
+            deployment = SimDeployment(doc, namespace)
+            self.deployments[key] = deployment
+        else:
+            deployment.doc = doc
+            deployment.replicas = doc.get('spec', {}).get('replicas', deployment.replicas)
+            deployment.generation += 1
+        self.scale_pods(deployment, now)
+
+    def set_replicas(self, namespace: str, name: str, replicas: int):
+        with self.lock:
+            deployment = self.get_deployment(namespace, name)
+            deployment.replicas = replicas
+            deployment.generation += 1
+            self.scale_pods(deployment, self.clock.now())
+
+    def restart(self, namespace: str, name: str):
+        '''
+            the pods are replaced at once (Recreate), not rolled
+        '''
+        with self.lock:
+            now = self.clock.now()
+            deployment = self.get_deployment(namespace, name)
+            for pod in deployment.pods:
+                if pod.deleted is None:
+                    pod.deleted = now
+                    pod.gone_at = now + self.termination_delay
+            deployment.revision += 1
+            deployment.generation += 1
+            deployment.restarted_at = now
+            self.scale_pods(deployment, now)
+
+    def get_deployment(self, namespace: str, name: str):
+        self.gc(self.clock.now())
+        deployment = self.deployments.get((namespace, name))
+        if deployment is None:
+            raise ApiException(status=404, reason=f'deployments.apps "{name}" not found')
+        return deployment
+
+    def apply(self, docs: list, namespace: str):
+        with self.lock:
+            self.require_namespace(namespace)
+            for doc in docs:
+                if doc.get('kind') == 'Deployment':
+                    self.add_deployment(copy.deepcopy(doc), namespace)
+                else:
+                    self.others[(namespace, doc.get('kind'), doc['metadata']['name'])] = copy.deepcopy(doc)
+
+    def require_namespace(self, namespace: str):
+        self.gc(self.clock.now())
+        ns = self.namespaces.get(namespace)
+        if ns is None or ns['gone_at'] is not None:
+            raise ApiException(status=404, reason=f'namespaces "{namespace}" not found')
+
+    def next_change(self):
+        '''
+            simulated time of the next pod/namespace state change, None if the state is settled
+        '''
+        now = self.clock.now()
+        times = [ns['gone_at'] for ns in self.namespaces.values() if ns['gone_at'] is not None]
+        for deployment in self.deployments.values():
+            for pod in deployment.pods:
+                times.append(pod.ready_at)
+                if pod.gone_at is not None:
+                    times.append(pod.gone_at)
+        times = [t for t in times if t > now]
+        return min(times) if len(times) > 0 else None
+
+    # ---- views as kubernetes models ----
+    def timestamp(self, t):
+        return datetime.datetime.fromtimestamp(t, tz=datetime.timezone.utc)
+
+    def deployment_object(self, deployment: SimDeployment, now):
+        live = [pod for pod in deployment.pods if pod.deleted is None]
+        ready = [pod for pod in live if pod.ready_at <= now]
+        doc = deployment.doc
+        containers = [client.V1Container(name=c.get('name', deployment.name), image=c.get('image'),
+                                         resources=client.V1ResourceRequirements(
+                                             limits=c.get('resources', {}).get('limits'),
+                                             requests=c.get('resources', {}).get('requests')))
+                      for c in deployment.containers()]
+        annotations = None
+        if deployment.restarted_at is not None:
+            annotations = {'kubectl.kubernetes.io/restartedAt': self.timestamp(deployment.restarted_at).isoformat()}
+        labels = doc.get('spec', {}).get('selector', {}).get('matchLabels', {'app': deployment.name})
+        return client.V1Deployment(
+            api_version='apps/v1', kind='Deployment',
+            metadata=client.V1ObjectMeta(name=deployment.name, namespace=deployment.namespace,
+                                         labels=doc['metadata'].get('labels'),
+                                         generation=deployment.generation,
+                                         resource_version=str(self.resource_version)),
+            spec=client.V1DeploymentSpec(
+                replicas=deployment.replicas,
+                selector=client.V1LabelSelector(match_labels=labels),
+                template=client.V1PodTemplateSpec(metadata=client.V1ObjectMeta(labels=labels, annotations=annotations),
+                                                  spec=client.V1PodSpec(containers=containers))),
+            status=client.V1DeploymentStatus(observed_generation=deployment.generation,
+                                             replicas=len(deployment.pods),
+                                             updated_replicas=len(live),
+                                             ready_replicas=len(ready) or None,
+                                             available_replicas=len(ready) or None))
+
+    def pod_object(self, deployment: SimDeployment, pod: SimPod, now):
+        ready = pod.deleted is None and pod.ready_at <= now
+        names = [c.get('name', deployment.name) for c in deployment.containers()]
+        if self.namespaces[deployment.namespace]['labels'].get('istio-injection') == 'enabled':
+            names.append('istio-proxy')
+        labels = deployment.doc.get('spec', {}).get('selector', {}).get('matchLabels', {'app': deployment.name})
+        template_hash = pod.name.rsplit('-', 2)[1]
+        labels = dict(labels, **{'pod-template-hash': template_hash})
+        return client.V1Pod(
+            api_version='v1', kind='Pod',
+            metadata=client.V1ObjectMeta(name=pod.name, namespace=deployment.namespace, labels=labels,
+                                         creation_timestamp=self.timestamp(pod.created),
+                                         deletion_timestamp=None if pod.deleted is None else self.timestamp(pod.deleted),
+                                         resource_version=str(self.resource_version),
+                                         owner_references=[client.V1OwnerReference(
+                                             api_version='apps/v1', kind='ReplicaSet', uid=pod.name,
+                                             name=pod.name.rsplit('-', 1)[0])]),
+            spec=client.V1PodSpec(containers=[client.V1Container(name=name) for name in names], node_name='sim-node'),
+            status=client.V1PodStatus(
+                phase='Running' if pod.ready_at <= now else 'Pending',
+                host_ip='10.0.0.1',
+                pod_ip=None if pod.ready_at > now else '10.1.0.%d' % (int(hashlib.md5(pod.name.encode()).hexdigest(), 16) % 250 + 2),
+                conditions=[client.V1PodCondition(type='Ready', status='True' if ready else 'False')],
+                container_statuses=[client.V1ContainerStatus(name=name, ready=ready, image='', image_id='',
+                                                             restart_count=0) for name in names]))
+
+    def list_deployments(self, namespace: str):
+        with self.lock:
+            now = self.clock.now()
+            self.gc(now)
+            return [self.deployment_object(d, now) for (ns, _), d in sorted(self.deployments.items()) if ns == namespace]
+
+    def list_pods(self, namespace: str):
+        with self.lock:
+            now = self.clock.now()
+            self.gc(now)
+            return [self.pod_object(d, pod, now)
+                    for (ns, _), d in sorted(self.deployments.items()) if ns == namespace
+                    for pod in d.pods]
+
+    def list_namespaces(self):
+        with self.lock:
+            now = self.clock.now()
+            self.gc(now)
+            return [client.V1Namespace(metadata=client.V1ObjectMeta(name=name, labels=ns['labels'] or None,
+                                                                    creation_timestamp=self.timestamp(ns['created'])),
+                                       status=client.V1NamespaceStatus(
+                                           phase='Active' if ns['gone_at'] is None else 'Terminating'))
+                    for name, ns in sorted(self.namespaces.items())]
+
+
+def object_list(items, cluster: SimCluster):
+    return SimpleNamespace(items=items, metadata=SimpleNamespace(resource_version=str(cluster.resource_version)))
+
+
+class SimAppsApi:
+    def __init__(self, cluster: SimCluster):
+        self.cluster = cluster
+
+    def list_namespaced_deployment(self, namespace, **kwargs):
+        return object_list(self.cluster.list_deployments(namespace), self.cluster)
+
+    def read_namespaced_deployment(self, name, namespace, **kwargs):
+        with self.cluster.lock:
+            deployment = self.cluster.get_deployment(namespace, name)
+            return self.cluster.deployment_object(deployment, self.cluster.clock.now())
+
+    def read_namespaced_deployment_scale(self, name, namespace, **kwargs):
+        deployment = self.read_namespaced_deployment(name, namespace)
+        return client.V1Scale(metadata=client.V1ObjectMeta(name=name, namespace=namespace),
+                              spec=client.V1ScaleSpec(replicas=deployment.spec.replicas))
+
+    def patch_namespaced_deployment_scale(self, name, namespace, body, async_req=False, **kwargs):
+        self.cluster.set_replicas(namespace, name, int(body['spec']['replicas']))
+        self.cluster.next_version()
+
+    def patch_namespaced_deployment(self, name, namespace, body, async_req=False, **kwargs):
+        # only the restart annotation of restart_deployment is understood
+        self.cluster.restart(namespace, name)
+        self.cluster.next_version()
+        return self.read_namespaced_deployment(name, namespace)
+
+    def list_namespaced_stateful_set(self, namespace, **kwargs):
+        return object_list([], self.cluster)
+
+
+class SimCoreApi:
+    def __init__(self, cluster: SimCluster):
+        self.cluster = cluster
+
+    def list_namespaced_pod(self, namespace, **kwargs):
+        return object_list(self.cluster.list_pods(namespace), self.cluster)
+
+    def read_namespaced_pod(self, name, namespace, **kwargs):
+        for pod in self.cluster.list_pods(namespace):
+            if pod.metadata.name == name:
+                return pod
+        raise ApiException(status=404, reason=f'pods "{name}" not found')
+
+    def read_namespaced_pod_log(self, name, namespace, **kwargs):
+        return ''
+
+    def list_namespace(self, field_selector=None, **kwargs):
+        items = self.cluster.list_namespaces()
+        if field_selector is not None and field_selector.startswith('metadata.name='):
+            name = field_selector.split('=', 1)[1]
+            items = [item for item in items if item.metadata.name == name]
+        return object_list(items, self.cluster)
+
+    def read_namespace(self, name, **kwargs):
+        items = self.list_namespace(field_selector=f'metadata.name={name}').items
+        if len(items) == 0:
+            raise ApiException(status=404, reason=f'namespaces "{name}" not found')
+        return items[0]
+
+    def create_namespace(self, body, **kwargs):
+        cluster = self.cluster
+        with cluster.lock:
+            cluster.gc(cluster.clock.now())
+            name = body.metadata.name
+            if name in cluster.namespaces:
+                raise ApiException(status=409, reason=f'namespaces "{name}" already exists')
+            cluster.namespaces[name] = {'labels': dict(body.metadata.labels or {}),
+                                        'created': cluster.clock.now(), 'gone_at': None}
+            cluster.next_version()
+        return self.read_namespace(name)
+
+    def patch_namespace(self, name, body, **kwargs):
+        cluster = self.cluster
+        with cluster.lock:
+            cluster.require_namespace(name)
+            cluster.namespaces[name]['labels'].update(body.get('metadata', {}).get('labels', {}))
+            cluster.next_version()
+        return self.read_namespace(name)
+
+    def delete_namespace(self, name, **kwargs):
+        cluster = self.cluster
+        with cluster.lock:
+            now = cluster.clock.now()
+            cluster.require_namespace(name)
+            for deployment in cluster.deployments.values():
+                if deployment.namespace == name:
+                    deployment.replicas = 0
+                    cluster.scale_pods(deployment, now)
+            cluster.namespaces[name]['gone_at'] = now + max(cluster.namespace_delay, cluster.termination_delay)
+            cluster.next_version()
+
+
+class SimAutoscalingApi:
+    def __init__(self, cluster: SimCluster):
+        self.cluster = cluster
+
+    def list_namespaced_horizontal_pod_autoscaler(self, namespace, **kwargs):
+        with self.cluster.lock:
+            self.cluster.gc(self.cluster.clock.now())
+            items = [hpa for (ns, _), hpa in sorted(self.cluster.hpas.items()) if ns == namespace]
+        return object_list(items, self.cluster)
+
+    def create_namespaced_horizontal_pod_autoscaler(self, namespace, body, **kwargs):
+        with self.cluster.lock:
+            self.cluster.require_namespace(namespace)
+            key = (namespace, body.metadata.name)
+            if key in self.cluster.hpas:
+                raise ApiException(status=409, reason=f'horizontalpodautoscalers "{key[1]}" already exists')
+            self.cluster.hpas[key] = body
+            self.cluster.next_version()
+        return body
+
+    def replace_namespaced_horizontal_pod_autoscaler(self, name, namespace, body, **kwargs):
+        with self.cluster.lock:
+            self.cluster.require_namespace(namespace)
+            if (namespace, name) not in self.cluster.hpas:
+                raise ApiException(status=404, reason=f'horizontalpodautoscalers "{name}" not found')
+            self.cluster.hpas[(namespace, name)] = body
+            self.cluster.next_version()
+        return body
+
+    def delete_collection_namespaced_horizontal_pod_autoscaler(self, namespace, label_selector=None, **kwargs):
+        selector = dict(term.split('=', 1) for term in label_selector.split(',')) if label_selector else {}
+        with self.cluster.lock:
+            for key, hpa in list(self.cluster.hpas.items()):
+                labels = hpa.metadata.labels or {}
+                if key[0] == namespace and all(labels.get(k) == v for k, v in selector.items()):
+                    del self.cluster.hpas[key]
+            self.cluster.next_version()
+
+    def delete_namespaced_horizontal_pod_autoscaler(self, name, namespace, body=None, **kwargs):
+        with self.cluster.lock:
+            if self.cluster.hpas.pop((namespace, name), None) is None:
+                raise ApiException(status=404, reason=f'horizontalpodautoscalers "{name}" not found')
+            self.cluster.next_version()
+
+
+class SimKubernetesClient(KubernetesClient):
+    '''
+        KubernetesClient backed by the in-process SimCluster instead of a real cluster,
+        the scalers, base_module and the dashboard run unchanged against it.
+    '''
+    def __init__(self, speedup=60.0, startup_delay=20.0, termination_delay=10.0, namespace_delay=5.0, **kwargs):
+        self.k8s_yaml = None
+        self.cluster = SimCluster.shared(speedup=speedup, startup_delay=startup_delay,
+                                         termination_delay=termination_delay, namespace_delay=namespace_delay)
+        self.core_api = SimCoreApi(self.cluster)
+        self.apps_api = SimAppsApi(self.cluster)
+        self.scale_api = SimAutoscalingApi(self.cluster)
+        self.hpa_api = self.scale_api  # autoscaling v1 and v2 share the stored HPAs
+        self.api_client = None
+        self.informer = False
+        self.informer_sync_timeout = 0
+        self.applier = None
+        self.snapshots = {}
+
+    def get_informer(self, kind: str, namespace: str, force=False):
+        # reads of the simulator are in-memory already
+        return None
+
+    def stop_informer(self, kind: str, namespace: str):
+        pass
+
+    def stop_informers(self):
+        pass
+
+    def watch_until(self, list_func, condition, timeout=600, **kwargs):
+        '''
+            no watch in the simulator: check the condition at every state change,
+            skipping the simulated clock forward in between
+        '''
+        deadline = self.cluster.clock.now() + timeout
+        while True:
+            objects = {i.metadata.name: i for i in list_func(**kwargs).items}
+            if condition(objects):
+                return True
+            now = self.cluster.clock.now()
+            if now >= deadline:
+                return False
+            next_change = self.cluster.next_change()
+            self.cluster.clock.skip((deadline if next_change is None else min(next_change, deadline)) - now)
+
+    def create_from_yaml(self, deploy_path: str, namespace: str):
+        files = manifest_files(deploy_path)
+        for f in files:
+            print(f"Processing file: {f}")
+        self.cluster.apply(load_documents(files), namespace)
+        self.cluster.next_version()
+
+    def create_istio_resource(self, yaml_pth: str, namespace: str):
+        self.create_from_yaml(yaml_pth, namespace)
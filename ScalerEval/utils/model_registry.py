@@ -0,0 +1,86 @@
+import hashlib
+import os
+import threading
+import joblib
+from utils.io_util import load_pkl
+
+
+class ModelRegistry:
+    '''
+        Process-wide cache of models loaded from disk. A model is loaded once and shared by
+        every caller; it is reloaded only when the file changes (mtime/size, then content hash).
+        transform(model) turns the unpickled model into the object that is cached, e.g. a compiled
+        form of it. With mmap=True a transformed model is dumped once with joblib in cache_dir, named
+        by the content hash, and loaded with mmap_mode='r': its numpy arrays are mapped from the
+        page cache, so several scaler processes share one copy in memory. Untransformed models are
+        always unpickled: sklearn trees copy their node arrays out of a memory map, nothing would be shared.
+        Models are shared, callers must not modify them.
+    '''
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, cache_dir='./tmp/models', mmap=False):
+        self.cache_dir = cache_dir
+        self.mmap = mmap
+        self.models = {}  # (path, transform name) -> (signature, digest, model)
+        self.path_locks = {}
+        self.lock = threading.Lock()
+        self.loads = 0
+
+    @classmethod
+    def shared(cls, cache_dir='./tmp/models', mmap=False):
+        '''
+            the registry of (cache_dir, mmap) shared by the whole process
+        '''
+        key = (os.path.abspath(cache_dir), mmap)
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(cache_dir, mmap)
+            return cls._shared[key]
+
+    def get(self, path: str, transform=None):
+        path = os.path.abspath(path)
+        key = (path, None if transform is None else transform.__qualname__)
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            path_lock = self.path_locks.setdefault(key, threading.Lock())
+        # concurrent callers of the same model wait for one load
+        with path_lock:
+            entry = self.models.get(key)
+            if entry is not None and entry[0] == signature:
+                return entry[2]
+            digest = self.digest(path)
+            if entry is not None and entry[1] == digest:
+                # touched but not changed
+                self.models[key] = (signature, digest, entry[2])
+                return entry[2]
+            if self.mmap and transform is not None:
+                model = self.load_mmap(path, digest, transform)
+            else:
+                model = load_pkl(path) if transform is None else transform(load_pkl(path))
+            self.models[key] = (signature, digest, model)
+            self.loads += 1
+            return model
+
+    def digest(self, path: str):
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def load_mmap(self, path: str, digest: str, transform):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        name = os.path.splitext(os.path.basename(path))[0]
+        cache_path = os.path.join(self.cache_dir, f'{name}.{transform.__qualname__}.{digest[:16]}.joblib')
+        if not os.path.exists(cache_path):
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+            joblib.dump(transform(load_pkl(path)), tmp_path)
+            # other processes see either no dump or a complete one
+            os.replace(tmp_path, cache_path)
+        return joblib.load(cache_path, mmap_mode='r')
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
@@ -1,39 +1,158 @@
+import socket
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import paramiko
 
 
+# exit_code is None when the command could not be run or timed out, error tells why
+SSHResult = namedtuple('SSHResult', ['hostname', 'exit_code', 'output', 'error', 'elapsed'])
+
+
+def print_output(hostname, line):
+    print(f"[{hostname}] {line}", end='' if line.endswith('\n') else '\n')
+
+
+class SSHExecutor:
+    '''
+        Run commands on remote servers: the connections are pooled per (host, port, user) and
+        reused by the next commands, a command fans out over the servers concurrently and the
+        output is streamed line by line to on_output(hostname, line) while it is collected.
+        server: {"hostname": ..., "username": ..., "password": ..., "port": 22 (optional)}
+    '''
+    def __init__(self, max_workers=8, connect_timeout=10, command_timeout=300,
+                 on_output=print_output, client_factory=paramiko.SSHClient, poll_interval=0.1):
+        self.max_workers = max_workers
+        self.connect_timeout = connect_timeout
+        self.command_timeout = command_timeout
+        self.poll_interval = poll_interval
+        self.on_output = on_output
+        self.client_factory = client_factory
+        self.connections = {}
+        self.host_locks = {}
+        self.lock = threading.Lock()
+
+    def key_of(self, server):
+        return (server['hostname'], server.get('port', 22), server['username'])
+
+    def connect(self, server):
+        key = self.key_of(server)
+        with self.lock:
+            host_lock = self.host_locks.setdefault(key, threading.Lock())
+        with host_lock:
+            ssh = self.connections.get(key)
+            transport = ssh.get_transport() if ssh is not None else None
+            if transport is not None and transport.is_active():
+                return ssh
+            print(f"connecting {server['hostname']}...")
+            ssh = self.client_factory()
+            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            ssh.connect(
+                server["hostname"],
+                port=server.get("port", 22),
+                username=server["username"],
+                password=server["password"],
+                timeout=self.connect_timeout,
+                banner_timeout=self.connect_timeout,
+                auth_timeout=self.connect_timeout
+            )
+            self.connections[key] = ssh
+            return ssh
+
+    def discard(self, server):
+        with self.lock:
+            ssh = self.connections.pop(self.key_of(server), None)
+        if ssh is not None:
+            ssh.close()
+
+    def execute(self, server, command, timeout=None):
+        '''
+            run the command on one server, the command fails with a timeout when it runs longer
+            than `timeout` seconds, whether it prints or not
+        '''
+        timeout = self.command_timeout if timeout is None else timeout
+        hostname = server['hostname']
+        begin = time.time()
+        deadline = begin + timeout
+        lines = []
+        try:
+            ssh = self.connect(server)
+            stdin, stdout, _ = ssh.exec_command(command, get_pty=True, timeout=timeout)
+            # sudo reads the password from the pty
+            if "sudo" in command:
+                stdin.write(server["password"] + "\n")
+                stdin.flush()
+            channel = stdout.channel
+            # reads never block past the poll interval, the deadline is checked between them
+            channel.settimeout(self.poll_interval)
+            pending = ''
+            while True:
+                if channel.recv_ready():
+                    pending += channel.recv(32768).decode('utf-8', errors='replace')
+                    *complete, pending = pending.split('\n')
+                    for line in complete:
+                        self.emit(hostname, line + '\n', lines)
+                elif channel.exit_status_ready():
+                    break
+                else:
+                    time.sleep(self.poll_interval)
+                if time.time() > deadline:
+                    channel.close()
+                    raise socket.timeout()
+            if pending:
+                self.emit(hostname, pending, lines)
+            exit_code = channel.recv_exit_status()
+            return SSHResult(hostname, exit_code, ''.join(lines), None, time.time() - begin)
+        except socket.timeout:
+            # the channel is dead, a new command gets a fresh connection
+            self.discard(server)
+            return SSHResult(hostname, None, ''.join(lines), f'timeout after {timeout}s', time.time() - begin)
+        except Exception as e:
+            self.discard(server)
+            return SSHResult(hostname, None, ''.join(lines), str(e), time.time() - begin)
+
+    def emit(self, hostname, line, lines):
+        lines.append(line)
+        if self.on_output is not None:
+            self.on_output(hostname, line)
+
+    def execute_all(self, servers: list, command, timeout=None):
+        '''
+            run the command on all servers concurrently, the results keep the order of the servers
+        '''
+        if len(servers) == 0:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(servers))) as pool:
+            return list(pool.map(lambda server: self.execute(server, command, timeout), servers))
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, {}
+        for ssh in connections.values():
+            ssh.close()
+
+
+def summarize_results(results: list):
+    '''
+        print one line per host, return True if the command succeeded everywhere
+    '''
+    for result in results:
+        if result.exit_code == 0:
+            print(f"{result.hostname}: done in {result.elapsed:.1f}s")
+        else:
+            print(f"{result.hostname}: failed ({result.error or f'exit code {result.exit_code}'}) after {result.elapsed:.1f}s")
+    return all(result.exit_code == 0 for result in results)
+
+
 def ssh_execute_command(server, command):
+    executor = SSHExecutor()
     try:
-        # initialize ssh client
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        
-        # connect server
-        print(f"connecting {server['hostname']}...")
-        ssh.connect(
-            server["hostname"],
-            username=server["username"],
-            password=server["password"]
-        )
-        
-        # sudo
         print(f"execute {command} in {server['hostname']}:")
-        stdin, stdout, stderr = ssh.exec_command(command, get_pty=True)
-        
-        # input passwd
-        if "sudo" in command:
-            stdin.write(server["password"] + "\n")
-            stdin.flush()
-        
-        # output results
-        output = stdout.read().decode()
-        error = stderr.read().decode()
-        if output:
-            print(f"{server['hostname']} output:\n{output}")
-        if error:
-            print(f"{server['hostname']} error:\n{error}")
-        
-        # 关闭连接
-        ssh.close()
+        result = executor.execute(server, command)
+        if result.error is not None:
+            print(f"incur error when executing ssh command.: {result.error}")
+        return result
+    finally:
+        executor.close()
         print(f"close the connection to {server['hostname']}.")
-    except Exception as e:
-        print(f"incur error when executing ssh command.: {e}")
\ No newline at end of file